@@ -0,0 +1,647 @@
+"""
+Асинхронный запуск бота: python async_bot.py
+
+Использует те же обработчики, клавиатуру, кэши и преобразования, что и bot.py,
+но работает на asyncio с пулом keep-alive соединений aiohttp. Скачивания и отправки
+разных чатов идут параллельно, а преобразования выполняются в пуле процессов,
+поэтому один процесс обслуживает сотни одновременных диалогов.
+"""
+import asyncio
+import functools
+import io
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+import bot as app
+from bot import (
+    ASCII_MAX_MESSAGES,
+    ASCII_MAX_WIDTH,
+    ASCII_MIN_WIDTH,
+    ASCII_PROMPT_TEXT,
+    BUSY_TEXT,
+    CANCEL_RENDER_TEXT,
+    COLORMAP_ACTIONS,
+    CPU_WORKERS,
+    DOWNLOAD_CHUNK_BYTES,
+    JOKES,
+    MAX_QUEUE,
+    METRICS_HOST,
+    METRICS_PORT,
+    NO_PHOTO_TEXT,
+    OUTBOUND_BURST,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_GROUP_RATE,
+    OUTBOUND_MAX_RETRIES,
+    OUTBOUND_MAX_RETRY_AFTER,
+    PIPELINE_STEPS,
+    PREVIEW_CANCELLED_CAPTION,
+    PREVIEW_CAPTION,
+    PREVIEW_SIDE,
+    RENDER_DONE_TEXT,
+    TOO_LARGE_TEXT,
+    TOO_SMALL_TEXT,
+    add_pipeline_step,
+    album_media_group,
+    album_operations,
+    ascii_charset,
+    ascii_image_operation,
+    ascii_messages,
+    cache_metrics,
+    cancel_render,
+    choose_photo_size,
+    get_options_keyboard,
+    get_pipeline_keyboard,
+    get_preview_keyboard,
+    get_state,
+    metrics,
+    observe_encoded,
+    outbound_metrics,
+    photo_operation,
+    photo_size,
+    photo_state,
+    photo_too_small,
+    pipeline_operation,
+    preview_size,
+    remember_album_photo,
+    render_cancels,
+)
+from image_guard import ImageBudgetError, ImageTooLargeError
+from outbound import AsyncOutboundScheduler
+from image_processing import (
+    PHOTO_JPEG_OPTIONS,
+    ascii_size,
+    ascii_source_size,
+    image_to_ascii,
+    preview_image,
+    transform_and_encode,
+)
+
+# Максимальное количество одновременных соединений с Bot API в общем пуле aiohttp
+CONNECTION_LIMIT = 100
+asyncio_helper.REQUEST_LIMIT = CONNECTION_LIMIT
+
+# Бот и пул процессов создаются при запуске (main), а не при импорте модуля: процессы пула (spawn)
+# заново импортируют главный модуль
+bot = None
+cpu_pool = None
+store_pool = None
+outbound = None
+chat_locks = {}  # chat_id -> [asyncio.Lock, число задач чата]: обработка одного чата идет по очереди
+downloads = {}  # file_unique_id -> asyncio.Task: одно скачивание на фото, даже при параллельных запросах
+active_tasks = 0
+
+# callback_data операций над фото -> ответ на нажатие
+PHOTO_ACTIONS = {
+    "pixelate": "Pixelating your image...",
+    "invert": "Inverting colors of your image...",
+    "mirror_horizontal": "Reflecting your image horizontally...",
+    "mirror_vertical": "Reflecting your image vertically...",
+    "heatmap": "Converting your image to a heatmap...",
+    "resize_for_sticker": "Resizing your image for sticker...",
+    **{action: f"Applying the {title} palette..." for action, title in COLORMAP_ACTIONS.items()},
+}
+
+
+async def run_cpu(func, *args):
+    """
+    Выполняет CPU-нагрузку в пуле процессов, не блокируя цикл событий.
+
+    :param func: Функция уровня модуля.
+    :return: Результат функции.
+    """
+    return await asyncio.get_running_loop().run_in_executor(cpu_pool, func, *args)
+
+
+async def run_store(func, *args, **kwargs):
+    """
+    Выполняет обращение к хранилищу состояний (или функцию bot.py, которая к нему обращается)
+    в потоке хранилища, не блокируя цикл событий: SQLite пишет на диск, а при занятой базе
+    ждет ее до 30 секунд.
+
+    Поток хранилища один, поэтому обращения выполняются в порядке вызова: нажатие кнопки видит
+    состояние, записанное при получении фото.
+
+    :param func: Функция хранилища, например user_states.get.
+    :return: Результат функции.
+    """
+    return await asyncio.get_running_loop().run_in_executor(store_pool, functools.partial(func, *args, **kwargs))
+
+
+async def run_in_chat(chat_id, coro_func, *args):
+    """
+    Выполняет обработчик под блокировкой чата и с ограничением общего числа задач.
+
+    :param chat_id: Идентификатор чата.
+    :param coro_func: Асинхронная функция-обработчик.
+    :return: True, если задача выполнена, False, если бот перегружен.
+    """
+    global active_tasks
+    if active_tasks >= MAX_QUEUE:
+        return False
+    active_tasks += 1
+    entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    queued_at = time.perf_counter()
+    try:
+        async with entry[0]:
+            metrics.queue_wait(time.perf_counter() - queued_at)
+            try:
+                await coro_func(*args)
+            except ImageTooLargeError:
+                await bot.send_message(chat_id, TOO_LARGE_TEXT)
+            except ImageBudgetError:
+                await bot.send_message(chat_id, BUSY_TEXT)
+    finally:
+        active_tasks -= 1
+        entry[1] -= 1
+        if entry[1] == 0:
+            del chat_locks[chat_id]
+    return True
+
+
+async def load_photo(chat_id, target_size=None):
+    """
+    Возвращает последнюю присланную пользователем фотографию из кэша или из Telegram.
+
+    :param chat_id: Идентификатор чата.
+    :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+    :return: Декодированное изображение (PIL.Image).
+    """
+    return await fetch_photo(await run_store(get_state, chat_id), target_size)
+
+
+async def fetch_photo(record, target_size=None):
+    """
+    Возвращает фотографию, описанную записью состояния, из кэша или из Telegram.
+
+    :param record: Состояние пользователя или запись фото альбома.
+    :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+    :return: Декодированное изображение (PIL.Image).
+    """
+    file_id, key = choose_photo_size(record, target_size)
+    # Декодирование тоже занимает CPU, поэтому выполняем его вне цикла событий
+    with metrics.stage("decode"):
+        image = await asyncio.to_thread(app.photo_cache.get, key, target_size)
+    if image is None:
+        data = await _shared_download(key, file_id)
+        with metrics.stage("decode"):
+            image = await asyncio.to_thread(app.photo_cache.put, key, data, target_size)
+    metrics.image("input", image.size)
+    return image
+
+
+async def load_photo_data(chat_id):
+    """
+    Возвращает байты последней присланной фотографии в полном размере, не декодируя ее.
+
+    :param chat_id: Идентификатор чата.
+    :return: Байты изображения.
+    """
+    file_id, key = choose_photo_size(await run_store(get_state, chat_id))
+    data = await asyncio.to_thread(app.photo_cache.get_data, key)
+    if data is None:
+        data = await _shared_download(key, file_id)
+        await asyncio.to_thread(app.photo_cache.put_data, key, data)
+    return data
+
+
+async def _shared_download(key, file_id):
+    # Параллельные запросы одной фотографии ждут одно скачивание
+    task = downloads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_download_photo(file_id))
+        downloads[key] = task
+        task.add_done_callback(lambda _: downloads.pop(key, None))
+    return await task
+
+
+async def _download_photo(file_id):
+    with metrics.stage("get_file"):
+        file_info = await bot.get_file(file_id)
+    app.image_guard.check_file_size(file_info.file_size)
+    with metrics.stage("download"):
+        data = await download_file(file_info.file_path)
+    metrics.transfer("in", len(data))
+    return data
+
+
+async def download_file(file_path):
+    """
+    Асинхронный аналог bot.download_file: скачивает файл потоком через общий пул aiohttp.
+
+    :param file_path: file_path из getFile.
+    :return: Байты изображения.
+    :raises ImageTooLargeError: Если файл или изображение больше лимитов image_guard.
+    """
+    url = (asyncio_helper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(bot.token, file_path)
+    download = app.image_guard.download()
+    try:
+        session = await asyncio_helper.session_manager.get_session()
+        async with session.get(url, proxy=asyncio_helper.proxy) as response:
+            if response.status != 200:
+                raise asyncio_helper.ApiHTTPException('Download file', response)
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+                download.write(chunk)
+    except BaseException:
+        download.close()
+        raise
+    return download.finish()
+
+
+async def send_processed_image(chat_id, operation):
+    """
+    Асинхронный аналог bot.send_processed_image: обрабатывает фото и отправляет результат,
+    используя общий кэш file_id.
+
+    :param chat_id: Идентификатор чата.
+    :param operation: Описание операции (bot.PhotoOperation).
+    """
+    state = await run_store(get_state, chat_id)
+    cache_key = (state.get('photo_unique_id', state['photo']), operation.name, operation.params)
+    file_name = operation.file_name
+
+    file_id = app.result_cache.get(cache_key)
+    if file_id is not None:
+        try:
+            with metrics.stage("send"):
+                if file_name:
+                    await bot.send_document(chat_id, file_id)
+                else:
+                    await bot.send_photo(chat_id, file_id)
+            return
+        except asyncio_helper.ApiTelegramException:
+            app.result_cache.discard(cache_key)
+
+    preview_target = None if file_name else preview_size(state, operation)
+    source = asyncio.ensure_future(load_source(chat_id, operation))
+    preview_id = None
+    try:
+        if preview_target:
+            # Полное фото скачивается, пока готовится и отправляется превью
+            preview_id = await send_preview(chat_id, state, operation, preview_target)
+        source = await source
+        if preview_id and await render_cancelled(chat_id, preview_id):
+            return
+        encoded = None
+        if operation.lossless:
+            # Без jpegtran lossless декодирует файл в пуле процессов, поэтому память резервируется заранее
+            reserved = await asyncio.to_thread(app.image_guard.reserve_decoding, source)
+            try:
+                encoded = await run_cpu(operation.lossless, source)
+            finally:
+                app.image_guard.budget.release(reserved)
+            if encoded is None:
+                source = await load_photo(chat_id, operation.target_size)
+        if encoded is None:
+            encoded = await run_cpu(transform_and_encode, operation.transform, source, operation.image_format,
+                                    operation.encoder_options)
+        observe_encoded(encoded)
+        if preview_id and await render_cancelled(chat_id, preview_id):
+            return
+        output_stream = io.BytesIO(encoded.data)
+
+        with metrics.stage("send"):
+            if file_name:
+                sent = await bot.send_document(chat_id, output_stream, visible_file_name=file_name)
+                app.result_cache.put(cache_key, sent.document.file_id)
+                return
+            sent = None
+            if preview_id:
+                try:
+                    sent = await bot.edit_message_media(types.InputMediaPhoto(output_stream), chat_id, preview_id)
+                except asyncio_helper.ApiTelegramException:
+                    output_stream.seek(0)
+            if not isinstance(sent, types.Message):
+                sent = await bot.send_photo(chat_id, output_stream)
+            app.result_cache.put(cache_key, sent.photo[-1].file_id)
+    finally:
+        if preview_id:
+            render_cancels.pop((chat_id, preview_id), None)
+
+
+async def load_source(chat_id, operation):
+    """
+    Асинхронный аналог bot.load_source: байты файла для operation.lossless, иначе декодированное изображение.
+
+    :param chat_id: Идентификатор чата.
+    :param operation: Описание операции (bot.PhotoOperation).
+    :return: Байты изображения или изображение (PIL.Image).
+    """
+    if operation.lossless:
+        return await load_photo_data(chat_id)
+    return await load_photo(chat_id, operation.target_size)
+
+
+async def send_preview(chat_id, state, operation, target_size):
+    """
+    Асинхронный аналог bot.send_preview: отправляет превью из маленького варианта фото.
+
+    :param chat_id: Идентификатор чата.
+    :param state: Состояние пользователя.
+    :param operation: Описание операции (bot.PhotoOperation).
+    :param target_size: Размер варианта фото для превью (см. bot.preview_size).
+    :return: message_id превью.
+    """
+    with metrics.stage("preview"):
+        image = await fetch_photo(state, target_size)
+        encoded = await asyncio.to_thread(
+            transform_and_encode,
+            functools.partial(preview_image, transform=operation.transform, max_side=PREVIEW_SIDE),
+            image, "JPEG", PHOTO_JPEG_OPTIONS)
+        message = await bot.send_photo(chat_id, io.BytesIO(encoded.data), caption=PREVIEW_CAPTION,
+                                       reply_markup=get_preview_keyboard())
+    metrics.transfer("out", len(encoded.data))
+    render_cancels[(chat_id, message.message_id)] = asyncio.Event()
+    return message.message_id
+
+
+async def render_cancelled(chat_id, preview_id):
+    """
+    Асинхронный аналог bot.render_cancelled.
+
+    :param chat_id: Идентификатор чата.
+    :param preview_id: message_id превью.
+    :return: True, если обработку нужно прекратить.
+    """
+    if not render_cancels[(chat_id, preview_id)].is_set():
+        return False
+    await bot.edit_message_caption(PREVIEW_CANCELLED_CAPTION, chat_id, preview_id)
+    return True
+
+
+async def photo_and_send(chat_id, operation):
+    """
+    Обрабатывает фото и отправляет результат, учитывая метрики под именем операции.
+
+    :param chat_id: Идентификатор чата.
+    :param operation: Описание операции (bot.PhotoOperation).
+    """
+    with metrics.request(operation.name):
+        await send_processed_image(chat_id, operation)
+
+
+@metrics.track("album")
+async def album_and_send(chat_id, action):
+    """
+    Асинхронный аналог bot.album_and_send: обрабатывает все фото альбома параллельно
+    и отправляет результаты одним альбомом.
+
+    :param chat_id: Идентификатор чата.
+    :param action: callback_data операции над фото или "pipeline_run".
+    """
+    state = await run_store(get_state, chat_id)
+    await send_album(chat_id, state['album'], album_operations(state, action))
+
+
+async def send_album(chat_id, records, operations):
+    """
+    Обрабатывает и отправляет фото альбома группами по 10 (ограничение Telegram), как bot.send_album:
+    после отказа из-за сохраненных file_id заново отправляется только эта группа.
+    """
+    cache_keys = [(record['photo_unique_id'], op.name, op.params) for record, op in zip(records, operations)]
+    media = [app.result_cache.get(key) for key in cache_keys]
+
+    async def render(i):
+        image = await fetch_photo(records[i], operations[i].target_size)
+        encoded = await run_cpu(transform_and_encode, operations[i].transform, image, operations[i].image_format,
+                                operations[i].encoder_options)
+        observe_encoded(encoded)
+        media[i] = encoded.data
+
+    await asyncio.gather(*[render(i) for i, item in enumerate(media) if item is None])
+
+    for start in range(0, len(media), 10):
+        indexes = range(start, min(start + 10, len(media)))
+        cached = [i for i in indexes if isinstance(media[i], str)]
+        try:
+            with metrics.stage("send"):
+                sent = await bot.send_media_group(chat_id, album_media_group(media, operations, indexes))
+        except asyncio_helper.ApiTelegramException as e:
+            if not cached or e.error_code != 400:
+                raise
+            for i in cached:
+                app.result_cache.discard(cache_keys[i])
+            await asyncio.gather(*[render(i) for i in cached])
+            with metrics.stage("send"):
+                sent = await bot.send_media_group(chat_id, album_media_group(media, operations, indexes))
+        for i, sent_message in zip(indexes, sent):
+            if sent_message.document:
+                app.result_cache.put(cache_keys[i], sent_message.document.file_id)
+            elif sent_message.photo:
+                app.result_cache.put(cache_keys[i], sent_message.photo[-1].file_id)
+
+
+@metrics.track("ascii")
+async def ascii_and_send(message):
+    """
+    Преобразует изображение в ASCII-арт и отправляет его пользователю.
+
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
+    """
+    image = await load_photo(message.chat.id, ascii_source_size(ASCII_MAX_WIDTH))
+    ascii_chars = ascii_charset(await run_store(get_state, message.chat.id))
+    width, height = ascii_size(image.size, ASCII_MAX_WIDTH, ASCII_MIN_WIDTH, max_messages=ASCII_MAX_MESSAGES)
+    with metrics.stage("transform"):
+        ascii_art = await run_cpu(functools.partial(image_to_ascii, new_width=width, new_height=height,
+                                                    ascii_chars=ascii_chars), image)
+    with metrics.stage("send"):
+        for text in ascii_messages(ascii_art):
+            await bot.send_message(message.chat.id, text, parse_mode="MarkdownV2")
+
+
+@metrics.track("ascii_image")
+async def ascii_image_and_send(message):
+    """
+    Рисует ASCII-арт картинкой и отправляет его пользователю файлом PNG.
+
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
+    """
+    await send_processed_image(message.chat.id, ascii_image_operation(ascii_charset(await run_store(get_state, message.chat.id))))
+
+
+@metrics.track("random_joke")
+async def random_joke_and_send(call):
+    """
+    Отправляет случайную шутку пользователю.
+
+    :param call: Объект callback-запроса.
+    """
+    with metrics.stage("send"):
+        await bot.send_message(call.message.chat.id, random.choice(JOKES))
+
+
+async def send_welcome(message):
+    """
+    Обрабатывает команды /start и /help. Отправляет приветственное сообщение.
+
+    :param message: Объект сообщения от пользователя.
+    """
+    await bot.reply_to(message, "Send me an image, and I'll provide options for you!")
+
+
+async def send_stats(message):
+    """
+    Обрабатывает команду /stats. Отправляет количество задач в обработке.
+
+    :param message: Объект сообщения от пользователя.
+    """
+    await bot.reply_to(message, f"Active tasks: {active_tasks}, chats in progress: {len(chat_locks)}")
+
+
+async def handle_photo(message):
+    """
+    Обрабатывает получение фотографии от пользователя. Предлагает варианты действий.
+
+    :param message: Объект сообщения с фотографией.
+    """
+    if not message.media_group_id:
+        await run_store(app.user_states.set, message.chat.id, photo_state(message.photo))
+        await bot.reply_to(message, "I got your photo! Please choose what you'd like to do with it.",
+                           reply_markup=get_options_keyboard())
+    elif await run_store(remember_album_photo, message):
+        await bot.reply_to(message, "I got your album! Please choose what you'd like to do with all of its photos.",
+                           reply_markup=get_options_keyboard())
+
+
+@metrics.track("callback_query")
+async def callback_query(call):
+    """
+    Обрабатывает нажатие на кнопки встроенной клавиатуры.
+
+    :param call: Объект callback-запроса.
+    """
+    chat_id = call.message.chat.id
+    if call.data == "cancel_render":
+        cancelled = cancel_render(chat_id, call.message.message_id)
+        await bot.answer_callback_query(call.id, CANCEL_RENDER_TEXT if cancelled else RENDER_DONE_TEXT)
+        return
+
+    state = await run_store(app.user_states.get, chat_id)
+    if call.data != "random_joke" and state is None:
+        await bot.answer_callback_query(call.id, NO_PHOTO_TEXT)
+        return
+
+    if state and len(state.get('album', [])) > 1 and (
+            call.data in PIPELINE_STEPS or (call.data == "pipeline_run" and state.get('pipeline'))):
+        if active_tasks >= MAX_QUEUE:
+            await bot.answer_callback_query(call.id, BUSY_TEXT)
+            return
+        await bot.answer_callback_query(call.id, "Processing all photos of your album...")
+        await run_in_chat(chat_id, album_and_send, chat_id, call.data)
+        return
+
+    if call.data in ("ascii", "ascii_image"):
+        await bot.answer_callback_query(call.id, ASCII_PROMPT_TEXT)
+        await run_store(app.user_states.update, chat_id, waiting_for_chars=True,
+                        ascii_output="image" if call.data == "ascii_image" else "text")
+        return
+    if call.data == "pipeline":
+        await run_store(app.user_states.update, chat_id, pipeline=[])
+        await bot.answer_callback_query(call.id, "Add steps to your pipeline, then press Run.")
+        await bot.send_message(chat_id, "Choose the steps of your pipeline:", reply_markup=get_pipeline_keyboard())
+        return
+    if call.data.startswith("pipeline_add:"):
+        await bot.answer_callback_query(call.id, await run_store(add_pipeline_step, chat_id,
+                                                                 call.data.split(":", 1)[1]))
+        return
+    if call.data == "pipeline_clear":
+        await run_store(app.user_states.update, chat_id, pipeline=[])
+        await bot.answer_callback_query(call.id, "Pipeline cleared.")
+        return
+
+    if call.data in PHOTO_ACTIONS:
+        text = PHOTO_ACTIONS[call.data]
+        source_size = await run_store(photo_size, chat_id)
+        if photo_too_small(call.data, source_size):
+            await bot.answer_callback_query(call.id, TOO_SMALL_TEXT)
+            return
+        operation = photo_operation(call.data, source_size)
+        coro_func = functools.partial(photo_and_send, chat_id, operation)
+    elif call.data == "pipeline_run":
+        steps = (await run_store(get_state, chat_id)).get('pipeline')
+        if not steps:
+            await bot.answer_callback_query(call.id, "Your pipeline is empty, add some steps first.")
+            return
+        text = "Running your pipeline..."
+        coro_func = functools.partial(photo_and_send, chat_id, pipeline_operation(steps))
+    elif call.data == "random_joke":
+        text, coro_func = "Here's a random joke for you!", functools.partial(random_joke_and_send, call)
+    else:
+        return
+
+    if active_tasks >= MAX_QUEUE:
+        await bot.answer_callback_query(call.id, BUSY_TEXT)
+        return
+    await bot.answer_callback_query(call.id, text)
+    await run_in_chat(chat_id, coro_func)
+
+
+async def waiting_for_chars(message):
+    """
+    Фильтр обработчика handle_ascii_chars: ждет ли бот от этого чата набор символов.
+
+    :param message: Объект сообщения.
+    :return: True, если сообщение — набор символов для ASCII-арта.
+    """
+    state = await run_store(app.user_states.get, message.chat.id, {})
+    return state.get('waiting_for_chars', False)
+
+
+async def handle_ascii_chars(message):
+    """
+    Обрабатывает ввод пользовательского набора символов для ASCII-арта.
+
+    :param message: Объект сообщения с набором символов.
+    """
+    state = await run_store(app.user_states.update, message.chat.id, ascii_chars=message.text,
+                            waiting_for_chars=False) or {}
+    func = ascii_image_and_send if state.get('ascii_output') == "image" else ascii_and_send
+    if not await run_in_chat(message.chat.id, func, message):
+        await bot.reply_to(message, BUSY_TEXT)
+
+
+async def main():
+    """
+    Запускает асинхронный опрос Telegram.
+    """
+    global bot, cpu_pool, store_pool, outbound
+    app.create_stores()
+    # Те же лимиты Telegram, что у bot.py: сообщения ждут своей очереди, не останавливая цикл событий
+    outbound = AsyncOutboundScheduler(global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                                      chat_burst=OUTBOUND_BURST, group_rate=OUTBOUND_GROUP_RATE,
+                                      group_burst=OUTBOUND_BURST, max_retries=OUTBOUND_MAX_RETRIES,
+                                      max_retry_after=OUTBOUND_MAX_RETRY_AFTER,
+                                      on_wait=metrics.api_wait, on_retry=metrics.api_retry)
+    outbound.install()
+    bot = AsyncTeleBot(app.read_token_from_file(app.TOKEN_FILE))
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(send_stats, commands=['stats'])
+    bot.register_message_handler(handle_photo, content_types=['photo'])
+    bot.register_message_handler(handle_ascii_chars, func=waiting_for_chars)
+    bot.register_callback_query_handler(callback_query, func=lambda call: True)
+    store_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot-store")
+    cpu_pool = None
+    if CPU_WORKERS != 0:
+        cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    if METRICS_PORT:
+        metrics.add_collector(cache_metrics)
+        metrics.add_collector(functools.partial(outbound_metrics, outbound))
+        metrics.add_collector(lambda: {"bot_active_tasks": active_tasks, "bot_chats_in_progress": len(chat_locks)})
+        metrics.serve(METRICS_HOST, METRICS_PORT)
+    try:
+        await bot.infinity_polling()
+    finally:
+        await bot.close_session()
+        store_pool.shutdown()
+        if cpu_pool is not None:
+            cpu_pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,209 @@
+"""
+Бенчмарк обработчиков *_and_send целиком: python benchmarks/bench_handlers.py
+
+Бот работает с локальным фейковым Bot API (fake_telegram.py): getFile, скачивание,
+преобразование в пуле процессов, кодирование и отправка проходят так же, как в
+проде, но без сети. Каждый обработчик измеряется в трех режимах:
+    cold — пустые кэши: фото скачивается и декодируется заново;
+    warm — фото уже в кэше, результат обрабатывается и загружается заново;
+    hot  — результат есть в кэше результатов и отправляется по file_id.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_transforms import SIZES, SOURCES, make_image  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+# Размеры вариантов фото, которые присылает Telegram (по большей стороне)
+PHOTO_VARIANTS = (90, 320, 800, 1280, 2560)
+HANDLERS = ["pixelate", "ascii", "ascii_image", "invert", "mirror", "heatmap", "colormap", "resize_for_sticker", "pipeline"]
+CACHE_MODES = ["cold", "warm", "hot"]
+
+
+def photo_variants(image):
+    """
+    Кодирует изображение в JPEG во всех размерах, которые прислал бы Telegram.
+
+    :param image: Исходное изображение (PIL.Image).
+    :return: Список байтов JPEG от меньшего размера к большему.
+    """
+    image = image.convert("RGB")
+    widths = [width for width in PHOTO_VARIANTS if width < image.width] + [image.width]
+    variants = []
+    for width in widths:
+        variant = image.resize((width, max(1, image.height * width // image.width)))
+        output = io.BytesIO()
+        variant.save(output, "JPEG", quality=87)
+        variants.append(output.getvalue())
+    return variants
+
+
+def import_bot(workdir):
+    """
+    Импортирует bot.py с тестовым токеном; файлы бота (токен, база состояний) создаются в workdir.
+    """
+    with open(os.path.join(workdir, "teletoken.txt"), "w") as f:
+        f.write("123456:BENCHMARK")
+    os.chdir(workdir)
+    import bot
+    from telebot import apihelper
+
+    bot.create_app()
+    # Бенчмарк измеряет сами обработчики, а фейковый API не ограничивает частоту, поэтому
+    # планировщик исходящих запросов отключается (его проверяет bench_outbound.py)
+    apihelper.CUSTOM_REQUEST_SENDER = None
+    return bot
+
+
+def handler_call(bot, name):
+    """
+    Возвращает функцию, вызывающую обработчик для сообщения из указанного чата.
+    """
+    if name == "pixelate":
+        return lambda message: bot.pixelate_and_send(message)
+    if name == "ascii":
+        return lambda message: bot.ascii_and_send(message)
+    if name == "ascii_image":
+        return lambda message: bot.ascii_image_and_send(message)
+    if name == "invert":
+        return lambda message: bot.invert_and_send(message)
+    if name == "mirror":
+        return lambda message: bot.mirror_and_send(message, direction="horizontal")
+    if name == "heatmap":
+        return lambda message: bot.heatmap_and_send(message)
+    if name == "colormap":
+        return lambda message: bot.colormap_and_send(message, "colormap_viridis")
+    if name == "resize_for_sticker":
+        return lambda message: bot.resize_for_sticker_and_send(message)
+    return lambda message: bot.pipeline_and_send(message)
+
+
+def reset_caches(bot, cache_mode):
+    """
+    Сбрасывает кэши бота перед запуском в соответствии с режимом.
+    """
+    if cache_mode == "cold":
+        bot.photo_cache = bot.PhotoCache(max_bytes=bot.PHOTO_CACHE_MAX_BYTES, max_items=bot.PHOTO_CACHE_MAX_ITEMS)
+    if cache_mode in ("cold", "warm"):
+        bot.result_cache = bot.ResultCache(ttl=bot.RESULT_CACHE_TTL, max_items=bot.RESULT_CACHE_MAX_ITEMS)
+
+
+def run_case(bot, server, handler_name, source, size_name, cache_mode, repeat, concurrency):
+    """
+    Измеряет один обработчик на одной фотографии.
+
+    :param concurrency: Количество чатов, обрабатываемых одновременно.
+    :return: Словарь с результатами.
+    """
+    photo = server.photo_sizes(photo_variants(make_image(source, SIZES[size_name], "RGB")))
+    sizes = [SimpleNamespace(**size) for size in photo]
+    chats = [SimpleNamespace(chat=SimpleNamespace(id=1000 + i)) for i in range(concurrency)]
+    for message in chats:
+        state = bot.photo_state(sizes)
+        state['pipeline'] = ["mirror_horizontal", "invert"]
+        bot.user_states.set(message.chat.id, state)
+
+    call = handler_call(bot, handler_name)
+    for message in chats:
+        reset_caches(bot, "cold")
+        call(message)  # прогрев: пул процессов, кодеки и, для hot/warm, кэши
+
+    def timed(message):
+        t0 = time.perf_counter()
+        call(message)
+        return time.perf_counter() - t0
+
+    server.reset_stats()
+    timings = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(repeat):
+            reset_caches(bot, cache_mode)
+            timings.extend(pool.map(timed, chats))
+    total = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "handler": handler_name, "source": source, "size": size_name, "cache": cache_mode,
+        "concurrency": concurrency, "runs": len(timings),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        "ops_per_s": len(timings) / total,
+        "calls_per_op": sum(server.calls.values()) / len(timings),
+        # Со стороны сервера: bytes_in — загрузки бота, bytes_out — скачивания и ответы API
+        "upload_kb_per_op": server.bytes_in / len(timings) / 1024,
+        "download_kb_per_op": server.bytes_out / len(timings) / 1024,
+    }
+
+
+def format_row(result):
+    """
+    Форматирует результат одного случая для таблицы.
+    """
+    return (f"{result['handler']:<19}{result['source']:<10}{result['size']:<6}{result['cache']:<6}"
+            f"{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['ops_per_s']:>9.1f}"
+            f"{result['calls_per_op']:>7.1f}{result['upload_kb_per_op']:>10.1f}{result['download_kb_per_op']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков с фейковым Bot API")
+    parser.add_argument("--handlers", nargs="+", choices=HANDLERS, default=HANDLERS)
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--sources", nargs="+", choices=SOURCES, default=SOURCES)
+    parser.add_argument("--cache", nargs="+", choices=CACHE_MODES, default=CACHE_MODES)
+    parser.add_argument("--repeat", type=int, default=10, help="число запусков на случай для каждого чата")
+    parser.add_argument("--concurrency", type=int, default=1, help="число одновременно обрабатываемых чатов")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа фейкового API, секунд")
+    parser.add_argument("--bandwidth", type=float, default=None, help="пропускная способность сети, МБ/с")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    server = FakeTelegramServer(latency=args.latency,
+                                bandwidth=args.bandwidth * 1024 * 1024 if args.bandwidth else None).start()
+    server.configure_telebot()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_bot(workdir)
+        print(f"{'handler':<19}{'source':<10}{'size':<6}{'cache':<6}"
+              f"{'p50 ms':>9}{'p99 ms':>9}{'ops/s':>9}{'calls':>7}{'up KB':>10}{'down KB':>10}")
+        results = []
+        for handler_name in args.handlers:
+            for source in args.sources:
+                for size_name in args.sizes:
+                    for cache_mode in args.cache:
+                        result = run_case(bot, server, handler_name, source, size_name, cache_mode,
+                                          args.repeat, args.concurrency)
+                        results.append(result)
+                        print(format_row(result), flush=True)
+        bot.engine.shutdown()
+        os.chdir(ROOT)
+
+    # ru_maxrss в Linux — в килобайтах; память процессов-обработчиков учитывается в RUSAGE_CHILDREN
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"\nPeak RSS: bot {peak_rss:.1f} MB, largest worker {peak_children:.1f} MB")
+    server.stop()
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "peak_rss_mb": peak_rss, "peak_worker_rss_mb": peak_children}, f,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Бенчмарк исходящих запросов под нагрузкой: python benchmarks/bench_outbound.py
+
+Много потоков одновременно отправляют в разные чаты текстовые ответы, фото и ответы
+на callback через синхронный telebot. Фейковый Bot API (fake_telegram.py) ограничивает
+частоту сообщений, как настоящий, и отвечает 429 с retry_after. Сравниваются режимы
+без планировщика (как telebot по умолчанию), с OutboundScheduler из outbound.py и
+асинхронный AsyncTeleBot с AsyncOutboundScheduler: доля ошибок, итоговая пропускная
+способность и задержка текстовых ответов и загрузок.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_transforms import make_image  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+TOKEN = "123456:OUTBOUND"
+
+
+def chat_jobs(chat_id, messages, photo):
+    """
+    Запросы одного чата: ответ на callback, затем чередование текста и фото.
+
+    :return: Список (вид запроса, функция (bot) -> None).
+    """
+    jobs = [("answer", lambda bot: bot.answer_callback_query(f"{chat_id}-0", "ok")),
+            ("answer", lambda bot: bot.answer_callback_query(f"{chat_id}-0", "ok"))]  # повторный ответ
+    for i in range(messages):
+        if i % 2:
+            jobs.append(("upload", lambda bot: bot.send_photo(chat_id, io.BytesIO(photo))))
+        else:
+            jobs.append(("text", lambda bot: bot.send_message(chat_id, f"message {i}")))
+    return jobs
+
+
+def run(api, scheduler, args, photo):
+    """
+    Отправляет нагрузку и возвращает результаты режима.
+    """
+    import telebot
+    from telebot import apihelper
+
+    apihelper.CUSTOM_REQUEST_SENDER = scheduler.send if scheduler else None
+    bot = telebot.TeleBot(TOKEN, threaded=False)
+    api.reset_stats()
+    latencies = {"text": [], "upload": [], "answer": []}
+    failed = {"text": 0, "upload": 0, "answer": 0}
+
+    def run_chat(chat_id):
+        for kind, job in chat_jobs(chat_id, args.messages, photo):
+            t0 = time.perf_counter()
+            try:
+                job(bot)
+            except apihelper.ApiTelegramException:
+                failed[kind] += 1
+            else:
+                latencies[kind].append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(run_chat, range(1000, 1000 + args.chats)))
+    elapsed = time.perf_counter() - started
+    apihelper.CUSTOM_REQUEST_SENDER = None
+    return summarize(api, "scheduler" if scheduler else "direct", elapsed, latencies, failed)
+
+
+def run_async(api, args, photo):
+    """
+    Отправляет ту же нагрузку через AsyncTeleBot с AsyncOutboundScheduler: все чаты в одном цикле событий.
+    """
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    from outbound import AsyncOutboundScheduler
+
+    latencies = {"text": [], "upload": [], "answer": []}
+    failed = {"text": 0, "upload": 0, "answer": 0}
+    process_request = asyncio_helper._process_request
+
+    async def run_chat(bot, chat_id):
+        for kind, job in chat_jobs(chat_id, args.messages, photo):
+            t0 = time.perf_counter()
+            try:
+                await job(bot)
+            except asyncio_helper.ApiTelegramException:
+                failed[kind] += 1
+            else:
+                latencies[kind].append(time.perf_counter() - t0)
+
+    async def main():
+        AsyncOutboundScheduler(global_rate=args.global_limit).install()
+        bot = AsyncTeleBot(TOKEN)
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*[run_chat(bot, chat_id) for chat_id in range(1000, 1000 + args.chats)])
+        finally:
+            await bot.close_session()
+        return time.perf_counter() - started
+
+    api.reset_stats()
+    try:
+        elapsed = asyncio.run(main())
+    finally:
+        asyncio_helper._process_request = process_request
+    return summarize(api, "async", elapsed, latencies, failed)
+
+
+def summarize(api, mode, elapsed, latencies, failed):
+    """
+    Сводит результаты режима: пропускная способность, ошибки и перцентили задержки по видам запросов.
+    """
+    sent = sum(len(values) for kind, values in latencies.items() if kind != "answer")
+    result = {"mode": mode, "elapsed_s": elapsed, "messages_sent": sent,
+              "messages_per_s": sent / elapsed, "failed": failed, "flood_errors": api.flood_errors,
+              "answers_sent": api.calls.get("answerCallbackQuery", 0)}
+    for kind, values in latencies.items():
+        if values:
+            values.sort()
+            result[f"{kind}_p50_ms"] = statistics.median(values) * 1000
+            result[f"{kind}_p99_ms"] = values[int(len(values) * 0.99)] * 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк исходящих запросов с лимитами Telegram")
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--messages", type=int, default=4, help="сообщений в каждый чат")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--global-limit", type=int, default=30, help="лимит фейкового API, сообщений в секунду")
+    parser.add_argument("--chat-limit", type=int, default=4,
+                        help="лимит одного чата, сообщений в секунду (всплеск 3 + 1 в секунду)")
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    from outbound import OutboundScheduler
+
+    api = FakeTelegramServer(latency=args.latency, flood_limits=(args.global_limit, args.chat_limit)).start()
+    api.configure_telebot()
+    photo = io.BytesIO()
+    make_image("synthetic", 640, "RGB").save(photo, "JPEG", quality=75)
+
+    results = []
+    for scheduler in (None, OutboundScheduler(global_rate=args.global_limit), "async"):
+        if scheduler == "async":
+            result = run_async(api, args, photo.getvalue())
+        else:
+            result = run(api, scheduler, args, photo.getvalue())
+        results.append(result)
+        print(f"{result['mode']:>9}: {result['messages_sent']} sent in {result['elapsed_s']:.2f} s "
+              f"({result['messages_per_s']:.1f}/s), failed {result['failed']}, 429 from API: {result['flood_errors']}, "
+              f"answerCallbackQuery sent: {result['answers_sent']}")
+        print(f"{'':>9}  text p50 {result.get('text_p50_ms', 0):.0f} ms p99 {result.get('text_p99_ms', 0):.0f} ms, "
+              f"upload p50 {result.get('upload_p50_ms', 0):.0f} ms p99 {result.get('upload_p99_ms', 0):.0f} ms")
+    api.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "args": vars(args)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
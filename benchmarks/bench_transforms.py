@@ -0,0 +1,207 @@
+"""
+Бенчмарк преобразований изображений без сети: python benchmarks/bench_transforms.py
+
+Каждое преобразование запускается на синтетических изображениях и на telebot.png
+в нескольких разрешениях (от 640px до 4K) и режимах (RGB, RGBA, L, P). Для каждого
+случая выводятся пропускная способность, задержка p50/p99 и пиковая память.
+Каждый случай выполняется в отдельном процессе, а пиковая память измеряется на первом
+вызове в полном размере: прогрев идет на маленьком изображении, поэтому память под
+полное изображение еще не выделена и не переиспользуется из предыдущих вызовов.
+"""
+import argparse
+import functools
+import gc
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+
+import image_processing  # noqa: E402
+
+FIXTURE = os.path.join(ROOT, "telebot.png")
+
+# Ширина изображения -> название; высота получается из соотношения сторон 16:9
+SIZES = {"640": 640, "1280": 1280, "1920": 1920, "4k": 3840}
+MODES = ["RGB", "RGBA", "L", "P"]
+SOURCES = ["synthetic", "fixture"]
+
+
+def _grayscale_pixels_to_ascii(image):
+    return image_processing.pixels_to_ascii(image.convert("L"), image_processing.ASCII_CHARS)
+
+
+TRANSFORMS = {
+    "pixelate": functools.partial(image_processing.pixelate_image, pixel_size=20),
+    "image_to_ascii": image_processing.image_to_ascii,
+    "pixels_to_ascii": _grayscale_pixels_to_ascii,
+    "ascii_image": image_processing.image_to_ascii_image,
+    "invert": image_processing.invert_colors,
+    "mirror": image_processing.mirror_image,
+    "heatmap": image_processing.convert_to_heatmap,
+    "colormap": functools.partial(image_processing.apply_colormap, colormap="viridis"),
+    "resize_for_sticker": image_processing.resize_for_sticker,
+}
+
+
+def make_image(source, width, mode):
+    """
+    Создает тестовое изображение.
+
+    :param source: "synthetic" — фрактал с плавными переходами и мелкими деталями,
+        "fixture" — telebot.png из репозитория, растянутый до нужного размера.
+    :param width: Ширина изображения; высота — по соотношению сторон 16:9.
+    :param mode: Режим изображения PIL.
+    :return: Загруженное изображение (PIL.Image).
+    """
+    size = (width, width * 9 // 16)
+    if source == "fixture":
+        image = Image.open(FIXTURE).convert("RGBA").resize(size)
+    else:
+        gray = Image.effect_mandelbrot(size, (-2.2, -1.2, 1.0, 1.2), 64)
+        image = Image.merge("RGB", (gray, Image.linear_gradient("L").resize(size), gray.transpose(Image.FLIP_LEFT_RIGHT)))
+    if mode == "P":
+        return image.convert("RGB").convert("P", palette=Image.Palette.ADAPTIVE)
+    return image.convert(mode)
+
+
+def _proc_status(field):
+    # Поле /proc/self/status в килобайтах (VmRSS — текущий RSS, VmHWM — пик); None вне Linux
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Запись "5" в clear_refs сбрасывает VmHWM до текущего RSS (Linux 4.0+)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def measure_peak_rss(func, *args):
+    """
+    Вызывает func и возвращает, на сколько RSS процесса поднимался выше уровня до вызова.
+
+    В отличие от tracemalloc учитывается и память, которую выделяют Pillow и кодеки на C.
+    Вне Linux пик берется из ru_maxrss и не учитывается, если не превысил прежний пик процесса.
+
+    :return: Мегабайты.
+    """
+    gc.collect()
+    if _reset_peak_rss():
+        before = _proc_status("VmRSS")
+        func(*args)
+        return max(0, _proc_status("VmHWM") - before) / 1024
+    # ru_maxrss в Linux и BSD — в килобайтах
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(*args)
+    return max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+
+
+def run_case(transform_name, source, size_name, mode, repeat, min_time):
+    """
+    Измеряет одно преобразование на одном изображении. Выполняется в отдельном процессе.
+
+    :return: Словарь с результатами.
+    """
+    image = make_image(source, SIZES[size_name], mode)
+    image.load()
+    transform = TRANSFORMS[transform_name]
+    result = {"transform": transform_name, "source": source, "size": size_name, "mode": mode,
+              "width": image.width, "height": image.height}
+
+    try:
+        # Прогрев на маленьком изображении: загружаются модули, кодеки и палитры, но память
+        # под полный размер остается невыделенной до измерения пика
+        transform(make_image(source, 64, mode))
+    except ValueError as e:
+        result["error"] = str(e)
+        return result
+
+    peak_rss_mb = measure_peak_rss(transform, image)
+    # tracemalloc видит выделения Python и NumPy (но не Pillow) и замедляет вызов, поэтому — отдельный вызов
+    tracemalloc.start()
+    transform(image)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat or time.perf_counter() - started < min_time:
+        t0 = time.perf_counter()
+        transform(image)
+        timings.append(time.perf_counter() - t0)
+
+    timings.sort()
+    total = sum(timings)
+    megapixels = image.width * image.height / 1e6
+    result.update({
+        "runs": len(timings),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        "images_per_s": len(timings) / total,
+        "mpix_per_s": megapixels * len(timings) / total,
+        "peak_rss_mb": peak_rss_mb,
+        "peak_traced_mb": traced_peak / 1024 / 1024,
+    })
+    return result
+
+
+def format_row(result):
+    """
+    Форматирует результат одного случая для таблицы.
+    """
+    name = f"{result['transform']:<19}{result['source']:<10}{result['size']:<6}{result['mode']:<5}"
+    if "error" in result:
+        return f"{name}unsupported: {result['error']}"
+    return (f"{name}{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['images_per_s']:>9.1f}"
+            f"{result['mpix_per_s']:>9.1f}{result['peak_rss_mb']:>9.1f}{result['peak_traced_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк преобразований изображений")
+    parser.add_argument("--transforms", nargs="+", choices=sorted(TRANSFORMS), default=list(TRANSFORMS))
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--sources", nargs="+", choices=SOURCES, default=SOURCES)
+    parser.add_argument("--repeat", type=int, default=10, help="минимальное число запусков на случай")
+    parser.add_argument("--min-time", type=float, default=0.5, help="минимальное время на случай, секунд")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    cases = [(t, src, size, mode, args.repeat, args.min_time)
+             for t in args.transforms for src in args.sources for size in args.sizes for mode in args.modes]
+
+    print(f"{'transform':<19}{'source':<10}{'size':<6}{'mode':<5}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'img/s':>9}{'Mpix/s':>9}{'RSS MB':>9}{'py MB':>9}")
+    results = []
+    # Один процесс на случай: пик RSS не наследуется от предыдущих случаев
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+        for result in pool.map(run_case, *zip(*cases)):
+            results.append(result)
+            print(format_row(result), flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
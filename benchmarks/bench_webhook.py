@@ -0,0 +1,174 @@
+"""
+Проверка и бенчмарк режима webhook с фейковым Bot API: python benchmarks/bench_webhook.py
+
+Для каждого чата отправляет на webhook фото и цепочку нажатий (сборка и запуск
+pipeline), причем каждое обновление доставляется дважды, как при повторной доставке
+Telegram. Затем проверяет по журналу фейкового API, что дубликаты отброшены, а ответы
+каждого чата пришли в порядке нажатий, и выводит задержку приема и пропускную способность.
+С --instances N запускается N экземпляров, как за балансировщиком: каждое обновление
+доставляется на случайный экземпляр и пересылается экземпляру, которому принадлежит чат.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_handlers import photo_variants  # noqa: E402
+from bench_transforms import make_image  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+TOKEN = "123456:WEBHOOK"
+STEPS = ["invert", "mirror_horizontal", "heatmap"]
+
+
+def chat_updates(chat_id, photo, update_ids):
+    """
+    Возвращает обновления одного чата в порядке отправки.
+
+    :param chat_id: Идентификатор чата.
+    :param photo: Список PhotoSize (словари) присланной фотографии.
+    :param update_ids: Итератор update_id.
+    """
+    user = {"id": chat_id, "is_bot": False, "first_name": "User"}
+    chat = {"id": chat_id, "type": "private"}
+    updates = [{"update_id": next(update_ids),
+                "message": {"message_id": 1, "date": 0, "chat": chat, "from": user, "photo": photo}}]
+    for i, data in enumerate(["pipeline"] + [f"pipeline_add:{step}" for step in STEPS] + ["pipeline_run"]):
+        updates.append({"update_id": next(update_ids),
+                        "callback_query": {"id": f"{chat_id}-{i}", "from": user, "chat_instance": "bench",
+                                           "data": data,
+                                           "message": {"message_id": 2, "date": 0, "chat": chat, "from": user}}})
+    return updates
+
+
+def post(url, secret, update):
+    """
+    Доставляет обновление на webhook.
+
+    :return: Время ответа в секундах.
+    """
+    request = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), method="POST",
+                                     headers={"Content-Type": "application/json",
+                                              "X-Telegram-Bot-Api-Secret-Token": secret})
+    t0 = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        assert response.status == 200, response.status
+    return time.perf_counter() - t0
+
+
+def expected_answers():
+    """
+    Ответы на нажатия одного чата в порядке нажатий.
+    """
+    import bot
+
+    answers = ["Add steps to your pipeline, then press Run."]
+    for i in range(1, len(STEPS) + 1):
+        answers.append(f"Pipeline: {bot.describe_pipeline(STEPS[:i])}")
+    answers.append("Running your pipeline...")
+    return answers
+
+
+def sent_results(api):
+    """
+    Считает отправленные результаты: готовое фото приходит новым сообщением или заменяет превью.
+    """
+    return sum(1 for method, params in list(api.log)
+               if method == "editMessageMedia" or (method == "sendPhoto" and "caption" not in params))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка и бенчмарк режима webhook")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2, help="процессов-обработчиков (0 — в процессе сервера)")
+    parser.add_argument("--instances", type=int, default=1, help="экземпляров webhook за балансировщиком")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа фейкового API, секунд")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    api = FakeTelegramServer(latency=args.latency).start()
+    api.configure_telebot()
+    photo = api.photo_sizes(photo_variants(make_image("synthetic", 1280, "RGB")))
+
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "teletoken.txt"), "w") as f:
+        f.write(TOKEN)
+    os.chdir(workdir)  # обработчики создают базу состояний в текущем каталоге
+
+    import webhook_server
+
+    servers = [webhook_server.WebhookServer(TOKEN, "127.0.0.1", 0, workers=args.workers, instance=i,
+                                            api_url=api.url)
+               for i in range(args.instances)]
+    peers = [f"http://127.0.0.1:{server.port}" for server in servers]
+    if args.instances > 1:
+        for server in servers:
+            server.peers = peers
+    urls = [peer + webhook_server.WEBHOOK_PATH for peer in peers]
+    secret = servers[0].secret
+    serving = ThreadPoolExecutor(max_workers=len(servers))
+    for server in servers:
+        serving.submit(server.serve_forever)
+
+    update_ids = itertools.count(1)
+    chats = {chat_id: chat_updates(chat_id, photo, update_ids) for chat_id in range(1000, 1000 + args.chats)}
+
+    def deliver(updates):
+        timings = []
+        for update in updates:
+            timings.append(post(random.choice(urls), secret, update))
+            timings.append(post(random.choice(urls), secret, update))  # повторная доставка
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(args.chats, 32)) as pool:
+        timings = sorted(itertools.chain.from_iterable(pool.map(deliver, chats.values())))
+    accepted = time.perf_counter() - started
+
+    deadline = time.monotonic() + args.timeout
+    while sent_results(api) < args.chats and time.monotonic() < deadline:
+        time.sleep(0.05)
+    finished = time.perf_counter() - started
+
+    answers = expected_answers()
+    by_chat = {}
+    for method, params in api.log:
+        if method == "answerCallbackQuery":
+            by_chat.setdefault(int(params["callback_query_id"].split("-")[0]), []).append(params.get("text"))
+    errors = 0
+    for chat_id in chats:
+        if by_chat.get(chat_id) != answers:
+            errors += 1
+            if errors <= 3:
+                print(f"chat {chat_id}: {by_chat.get(chat_id)}")
+    photos = sent_results(api)
+
+    total_updates = sum(len(updates) for updates in chats.values())
+    print(f"Updates: {total_updates} (+{total_updates} duplicates), instances: {args.instances}, "
+          f"workers: {args.workers}")
+    print(f"Webhook response p50 {statistics.median(timings) * 1000:.2f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1000:.2f} ms, accepted {2 * total_updates / accepted:.0f} req/s")
+    print(f"All chats processed in {finished:.2f} s ({total_updates / finished:.0f} updates/s)")
+    print(f"Results sent: {photos}/{args.chats}, chats with wrong or reordered answers: {errors}")
+
+    for server in servers:
+        server.shutdown()
+    serving.shutdown()
+    api.stop()
+    sys.exit(1 if errors or photos != args.chats else 0)
+
+
+if __name__ == "__main__":
+    main()
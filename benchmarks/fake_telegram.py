@@ -0,0 +1,300 @@
+"""
+Локальный фейковый сервер Telegram Bot API для бенчмарков и проверки бота без сети.
+
+Поддерживает методы, которыми пользуется бот (getFile, скачивание файлов, sendPhoto,
+sendDocument, sendMessage, sendMediaGroup, answerCallbackQuery и др.), хранит загруженные
+файлы в памяти и может имитировать задержку и пропускную способность сети.
+
+Пример:
+    server = FakeTelegramServer(latency=0.05)
+    server.start()
+    server.configure_telebot()
+    file_id = server.add_file(jpeg_bytes)
+"""
+import email
+import email.policy
+import io
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from PIL import Image
+
+
+class FakeTelegramServer:
+    """
+    Фейковый Bot API на http://127.0.0.1:<port>.
+
+    :param latency: Задержка ответа на каждый запрос, секунд.
+    :param bandwidth: Пропускная способность для загрузки и скачивания файлов, байт/с (None — без ограничения).
+    :param flood_limits: (сообщений в секунду на бота, сообщений в секунду на чат): при превышении
+        методы отправки сообщений отвечают 429 с retry_after, как настоящий API (None — без ограничения).
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, bandwidth=None, flood_limits=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_limits = flood_limits
+        self.flood_errors = 0
+        self._sent = deque()  # время отправки сообщений за последнюю секунду
+        self._sent_by_chat = {}  # chat_id -> deque времени отправки
+        self.files = {}  # file_id -> байты
+        self.calls = {}  # метод -> количество вызовов
+        self.log = []  # (метод, параметры) всех вызовов по порядку, для проверки ответов
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler(), bind_and_activate=False)
+        self._httpd.daemon_threads = True
+        self._httpd.request_queue_size = 128  # очередь по умолчанию (5) сбрасывает соединения под нагрузкой
+        self._httpd.server_bind()
+        self._httpd.server_activate()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Запускает сервер в фоновом потоке.
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Останавливает сервер.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def configure_telebot(self):
+        """
+        Направляет запросы telebot (синхронного и асинхронного) на этот сервер.
+        """
+        from telebot import apihelper, asyncio_helper
+
+        apihelper.API_URL = self.url + "/bot{0}/{1}"
+        apihelper.FILE_URL = self.url + "/file/bot{0}/{1}"
+        asyncio_helper.API_URL = self.url + "/bot{0}/{1}"
+        asyncio_helper.FILE_URL = self.url + "/file/bot{0}/{1}"
+
+    def add_file(self, data):
+        """
+        Регистрирует файл, который бот сможет скачать.
+
+        :param data: Байты файла.
+        :return: file_id (он же file_unique_id и file_path).
+        """
+        file_id = f"file{next(self._ids)}"
+        with self._lock:
+            self.files[file_id] = data
+        return file_id
+
+    def photo_sizes(self, variants):
+        """
+        Регистрирует варианты одной фотографии и возвращает их в формате message.photo.
+
+        :param variants: Байты JPEG от меньшего размера к большему.
+        :return: Список словарей PhotoSize.
+        """
+        sizes = []
+        for data in variants:
+            file_id = self.add_file(data)
+            width, height = Image.open(io.BytesIO(data)).size
+            sizes.append({"file_id": file_id, "file_unique_id": file_id, "width": width, "height": height,
+                          "file_size": len(data)})
+        return sizes
+
+    def reset_stats(self):
+        """
+        Обнуляет счетчики вызовов, журнал и счетчики переданных байтов.
+        """
+        with self._lock:
+            self.calls = {}
+            self.log = []
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.flood_errors = 0
+
+    # --- обработка методов Bot API ---
+
+    def _flood(self, method, chat_id):
+        # Скользящее окно в одну секунду; возвращает True, если сообщение превышает лимит
+        if not self.flood_limits or not method.startswith(("send", "edit", "copy", "forward")):
+            return False
+        now = time.monotonic()
+        chat_sent = self._sent_by_chat.setdefault(chat_id, deque())
+        with self._lock:
+            for sent in (self._sent, chat_sent):
+                while sent and sent[0] <= now - 1:
+                    sent.popleft()
+            if len(self._sent) >= self.flood_limits[0] or len(chat_sent) >= self.flood_limits[1]:
+                self.flood_errors += 1
+                return True
+            self._sent.append(now)
+            chat_sent.append(now)
+        return False
+
+    def _message(self, chat_id, **fields):
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}}
+        message.update(fields)
+        return message
+
+    def _stored_photo(self, data):
+        file_id = self.add_file(data)
+        try:
+            width, height = Image.open(io.BytesIO(data)).size
+        except OSError:
+            width = height = 0
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": width, "height": height,
+                 "file_size": len(data)}]
+
+    def _stored_document(self, data, file_name):
+        file_id = self.add_file(data)
+        return {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "file_size": len(data)}
+
+    def _media(self, value, files):
+        # Значение параметра — file_id, attach://имя или сам загруженный файл
+        if isinstance(value, tuple):
+            return value
+        if value.startswith("attach://"):
+            return files[value[len("attach://"):]]
+        return value, self.files.get(value, b"")
+
+    def call(self, method, params, files):
+        """
+        Выполняет метод Bot API.
+
+        :return: Поле result ответа.
+        """
+        chat_id = params.get("chat_id", 0)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.log.append((method, params))
+
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        if method == "getFile":
+            data = self.files.get(params["file_id"], b"")
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                    "file_size": len(data), "file_path": params["file_id"]}
+        if method == "sendPhoto":
+            _, data = self._media(files.get("photo") or params["photo"], files)
+            return self._message(chat_id, photo=self._stored_photo(data))
+        if method == "sendDocument":
+            name, data = self._media(files.get("document") or params["document"], files)
+            return self._message(chat_id, document=self._stored_document(data, name))
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendMediaGroup":
+            messages = []
+            for item in json.loads(params["media"]):
+                name, data = self._media(item["media"], files)
+                if item["type"] == "document":
+                    messages.append(self._message(chat_id, document=self._stored_document(data, name)))
+                else:
+                    messages.append(self._message(chat_id, photo=self._stored_photo(data)))
+            return messages
+        if method == "editMessageMedia":
+            item = json.loads(params["media"])
+            name, data = self._media(item["media"], files)
+            return self._message(chat_id, photo=self._stored_photo(data))
+        # answerCallbackQuery, deleteMessage, setWebhook, deleteWebhook и прочие методы без результата
+        return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+            # Заголовки и тело пишутся отдельно; без этого алгоритм Нагла добавляет ~40 мс к ответу
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with server._lock:
+                    server.bytes_in += len(body)
+                server._throttle(len(body))
+                path = urlsplit(self.path)
+                parts = path.path.strip("/").split("/")
+
+                if parts[0] == "file":
+                    data = server.files.get("/".join(parts[2:]))
+                    if data is None:
+                        self._send(404, b"Not Found", "text/plain")
+                    else:
+                        server._throttle(len(data))
+                        self._send(200, data, "application/octet-stream")
+                    return
+
+                params = dict(parse_qsl(path.query))
+                files = {}
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    params_from_form, files = _parse_multipart(content_type, body)
+                    params.update(params_from_form)
+                elif body:
+                    params.update(parse_qsl(body.decode("utf-8")))
+
+                try:
+                    if server._flood(parts[1], params.get("chat_id")):
+                        result = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}}
+                        status = 429
+                    else:
+                        result = {"ok": True, "result": server.call(parts[1], params, files)}
+                        status = 200
+                except (KeyError, ValueError) as e:
+                    result = {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+                    status = 400
+                time.sleep(server.latency)
+                self._send(status, json.dumps(result).encode("utf-8"), "application/json")
+
+            def _send(self, status, data, content_type):
+                with server._lock:
+                    server.bytes_out += len(data)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _throttle(self, size):
+        if self.bandwidth and size:
+            time.sleep(size / self.bandwidth)
+
+
+def _parse_multipart(content_type, body):
+    message = email.message_from_bytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("ascii") + body, policy=email.policy.HTTP)
+    params, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        data = part.get_payload(decode=True) or b""
+        file_name = part.get_filename()
+        if file_name is None:
+            params[name] = data.decode("utf-8")
+        else:
+            files[name] = (file_name, data)
+    return params, files
@@ -1,9 +1,43 @@
 import telebot
-from PIL import Image, ImageOps
+import functools
 import io
-from telebot import types
+from collections import namedtuple
+from telebot import apihelper, types
 import os
 import random
+import threading
+import time
+
+from image_processing import (
+    ASCII_CHARS,
+    ASCII_MESSAGE_LIMIT,
+    PHOTO_JPEG_OPTIONS,
+    STICKER_PNG_OPTIONS,
+    apply_colormap,
+    apply_pipeline,
+    ascii_size,
+    ascii_source_size,
+    convert_to_heatmap,
+    image_to_ascii,
+    image_to_ascii_image,
+    invert_colors,
+    mirror_image,
+    mirror_jpeg,
+    pixelate_image,
+    preview_image,
+    pixelate_source_size,
+    resize_for_sticker,
+    sort_ascii_chars,
+    sticker_size,
+    transform_and_encode,
+)
+from image_guard import ImageBudgetError, ImageGuard, ImageTooLargeError
+from metrics import Metrics, SamplingProfiler
+from outbound import OutboundScheduler
+from photo_cache import PhotoCache
+from result_cache import ResultCache
+from state_store import MemoryStateStore, SQLiteStateStore
+from task_engine import TaskEngine
 
 TOKEN_FILE = "teletoken.txt"
 JOKES = [
@@ -33,128 +67,657 @@ def read_token_from_file(filename):
     return token
 
 
-# Считываем токен из файла
-TOKEN = read_token_from_file(TOKEN_FILE)
+# Токен, бот, хранилище состояний, кэши, очередь обработки и планировщик запросов создаются
+# при запуске (create_app), а не при импорте модуля
+TOKEN = None
+bot = None
+user_states = None
+image_guard = None
+photo_cache = None
+result_cache = None
+engine = None
+outbound = None
+
+# тут будем хранить информацию о действиях пользователя
+STATE_DB_FILE = "user_states.sqlite3"  # None — хранить состояние только в памяти процесса
+STATE_TTL = 7 * 24 * 60 * 60
+STATE_MAX_ITEMS = 100000
+NO_PHOTO_TEXT = "Please send me a photo first."
+
+# Шаги, из которых пользователь собирает цепочку операций: callback_data -> название кнопки
+PIPELINE_STEPS = {
+    "pixelate": "Pixelate",
+    "invert": "Invert Colors",
+    "mirror_horizontal": "Mirror Horizontally",
+    "mirror_vertical": "Mirror Vertically",
+    "heatmap": "Heatmap",
+    "resize_for_sticker": "Resize for Sticker",
+}
+MAX_PIPELINE_STEPS = 8
+PIXELATE_PIXEL_SIZE = 20  # размер блока пикселизации; фото меньше блока получает TOO_SMALL_TEXT
+
+# Дополнительные палитры тепловой карты: callback_data -> название кнопки (палитры — image_processing.COLORMAPS)
+COLORMAP_ACTIONS = {
+    "colormap_jet": "Jet",
+    "colormap_viridis": "Viridis",
+    "colormap_inferno": "Inferno",
+    "colormap_fire": "Fire",
+    "colormap_ocean": "Ocean",
+}
+PIPELINE_STEPS.update({action: f"Heatmap ({title})" for action, title in COLORMAP_ACTIONS.items()})
+
+# ASCII-арт текстом подбирается по пропорциям фото: наибольшая ширина выводится из лимита сообщения
+# (ASCII_MESSAGE_LIMIT), поэтому горизонтальные фото получаются шире вертикальных; очень вытянутые по
+# высоте фото занимают до ASCII_MAX_MESSAGES сообщений при ширине ASCII_MIN_WIDTH.
+# ASCII_MAX_WIDTH ограничивает только панорамы: более длинные строки блока кода клиенты Telegram
+# переносят или прокручивают, и рисунок разваливается.
+# ASCII-арт картинкой (PNG) рисуется моноширинным шрифтом шириной ASCII_IMAGE_WIDTH символов.
+ASCII_MAX_WIDTH = 120
+ASCII_MIN_WIDTH = 24
+ASCII_MAX_MESSAGES = 3
+ASCII_IMAGE_WIDTH = 100
+ASCII_PROMPT_TEXT = "Please send me the characters you want to use for ASCII art."
+
+# Лимиты загрузки: файл скачивается потоком и отклоняется, если он больше MAX_DOWNLOAD_BYTES,
+# изображение больше MAX_IMAGE_PIXELS декодируется уменьшенным, а все декодированные
+# изображения вместе занимают не больше IMAGE_MEMORY_BUDGET (должен быть больше PHOTO_CACHE_MAX_BYTES)
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+MAX_IMAGE_PIXELS = 16_000_000
+IMAGE_MEMORY_BUDGET = 256 * 1024 * 1024
+IMAGE_BUDGET_WAIT = 10  # секунд ожидания свободной памяти, после — ответ BUSY_TEXT
+TOO_LARGE_TEXT = "This image is too large for me, please send a smaller one."
+TOO_SMALL_TEXT = "This image is too small to pixelate, please send a larger one."
+
+# Кэш скачанных фотографий: повторные операции над одним фото не ходят в Telegram
+PHOTO_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PHOTO_CACHE_MAX_ITEMS = 128
+PHOTO_CACHE_DIR = None  # например "photo_cache", чтобы включить дисковый уровень кэша
+
+# Кэш готовых результатов: повторная операция над тем же фото отправляется по file_id
+RESULT_CACHE_TTL = 24 * 60 * 60
+RESULT_CACHE_MAX_ITEMS = 4096
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108  # None — не запускать HTTP-сервер метрик
+SLOW_REQUEST_SECONDS = 5.0  # запросы дольше порога записываются в лог
+PROFILE_SLOW_REQUESTS = False  # True — добавлять в лог самые частые стеки медленных запросов
+
+metrics = Metrics(slow_request_seconds=SLOW_REQUEST_SECONDS,
+                  profiler=SamplingProfiler() if PROFILE_SLOW_REQUESTS else None)
+
+# Обработка идет в фоне: потоки для скачивания и отправки, процессы для преобразований
+IO_WORKERS = 8
+CPU_WORKERS = None  # None — по числу ядер, 0 — без пула процессов
+MAX_QUEUE = 100
+BUSY_TEXT = "I'm busy right now, please retry in a moment."
+
+# Прогрессивная отправка: для больших фото сначала приходит превью из маленького варианта фото,
+# а готовый результат заменяет его (edit_message_media). Полную обработку можно отменить кнопкой под превью.
+PREVIEW_SIDE = 320  # большая сторона превью в пикселях; None — не отправлять превью
+PREVIEW_MIN_SIDE = 1280  # превью отправляется для фото, у которых большая сторона не меньше
+PREVIEW_CAPTION = "Preview: the full-resolution result is on the way..."
+PREVIEW_CANCELLED_CAPTION = "Preview only: the full-resolution render was cancelled."
+CANCEL_RENDER_TEXT = "Cancelling the full-resolution render..."
+RENDER_DONE_TEXT = "The full-resolution render is already finished."
+
+render_cancels = {}  # (chat_id, message_id превью) -> threading.Event, пока идет полная обработка
+
+# Исходящие запросы идут через планировщик с лимитами Telegram: запрос ждет своей очереди,
+# а не получает ошибку 429; текстовые ответы обгоняют загрузку файлов
+OUTBOUND_GLOBAL_RATE = 30  # сообщений в секунду на бота (делится между процессами webhook)
+OUTBOUND_CHAT_RATE = 1  # сообщений в секунду в личный чат
+OUTBOUND_GROUP_RATE = 20 / 60  # сообщений в секунду в группу
+OUTBOUND_BURST = 3  # сообщений подряд в один чат без паузы
+OUTBOUND_MAX_RETRIES = 5
+OUTBOUND_MAX_RETRY_AFTER = 30  # если Telegram просит ждать дольше, обработчик получает ошибку сразу
 
-bot = telebot.TeleBot(TOKEN)
 
-user_states = {}  # тут будем хранить информацию о действиях пользователя
+def send_welcome(message):
+    """
+    Обрабатывает команды /start и /help. Отправляет приветственное сообщение.
 
-# набор символов из которых составляем изображение
-ASCII_CHARS = '@%#*+=-:. '
+    :param message: Объект сообщения от пользователя.
+    """
+    send_in_chat(message.chat.id, bot.reply_to, message, "Send me an image, and I'll provide options for you!")
 
 
-def resize_image(image, new_width=100):
+def send_stats(message):
     """
-    Изменяет размер изображения, сохраняя соотношение сторон.
+    Обрабатывает команду /stats. Отправляет состояние очереди обработки.
 
-    :param image: Исходное изображение (PIL.Image).
-    :param new_width: Новая ширина изображения.
-    :return: Изображение с измененным размером (PIL.Image).
+    :param message: Объект сообщения от пользователя.
     """
-    width, height = image.size
-    ratio = height / width
-    new_height = int(new_width * ratio)
-    return image.resize((new_width, new_height))
+    stats = engine.stats()
+    send_in_chat(message.chat.id, bot.reply_to, message,
+                 f"Queue depth: {stats['queue_depth']}, running: {stats['running']}, "
+                 f"rejected: {stats['rejected']}\n"
+                 f"Wait avg: {stats['wait_avg']:.2f}s, max: {stats['wait_max']:.2f}s")
 
 
-def grayify(image):
+def handle_photo(message):
     """
-    Преобразует изображение в оттенки серого.
+    Обрабатывает получение фотографии от пользователя. Предлагает варианты действий.
 
-    :param image: Исходное изображение (PIL.Image).
-    :return: Изображение в оттенках серого (PIL.Image).
+    :param message: Объект сообщения с фотографией.
+    """
+    if not message.media_group_id:
+        user_states.set(message.chat.id, photo_state(message.photo))
+        send_in_chat(message.chat.id, bot.reply_to, message,
+                     "I got your photo! Please choose what you'd like to do with it.",
+                     reply_markup=get_options_keyboard())
+    elif remember_album_photo(message):
+        # Клавиатуру предлагаем один раз, на первое фото альбома
+        send_in_chat(message.chat.id, bot.reply_to, message,
+                     "I got your album! Please choose what you'd like to do with all of its photos.",
+                     reply_markup=get_options_keyboard())
+
+
+def send_in_chat(chat_id, func, *args, **kwargs):
     """
-    return image.convert("L")
+    Отправляет ответ пользователю из очереди чата, а не из потока опроса.
 
+    Отправка может ждать лимитов Telegram (см. outbound), и поток опроса, ожидая их, задержал бы
+    обновления всех чатов. В очереди чата ответ уходит после уже поставленных задач этого чата;
+    ответ принимается в очередь, даже если она заполнена (в том числе ответ BUSY_TEXT).
 
-def image_to_ascii(image_stream, new_width=40, ascii_chars=ASCII_CHARS):
+    :param chat_id: Идентификатор чата.
+    :param func: Метод отправки, например bot.reply_to.
     """
-    Преобразует изображение в ASCII-арт.
+    engine.post(chat_id, func, *args, **kwargs)
 
-    :param image_stream: Поток байтов изображения.
-    :param new_width: Ширина ASCII-арта (количество символов в строке).
-    :param ascii_chars: Набор символов для создания ASCII-арта.
-    :return: Строка, содержащая ASCII-арт.
+
+def remember_album_photo(message):
     """
-    # Переводим в оттенки серого
-    image = Image.open(image_stream).convert('L')
+    Добавляет фото из альбома в состояние пользователя.
 
-    # меняем размер сохраняя отношение сторон
-    width, height = image.size
-    aspect_ratio = height / float(width)
-    new_height = int(
-        aspect_ratio * new_width * 0.55)  # 0,55 так как буквы выше чем шире
-    img_resized = image.resize((new_width, new_height))
+    Фото одного альбома (media_group_id) приходят отдельными сообщениями, возможно
+    одновременно; они собираются в список state['album'] в порядке сообщений.
+    Одиночные операции (например, ASCII-арт) применяются к первому фото альбома.
 
-    img_str = pixels_to_ascii(img_resized, ascii_chars)
-    img_width = img_resized.width
+    :param message: Объект сообщения с фотографией из альбома.
+    :return: True, если это первое полученное фото альбома.
+    """
+    record = photo_state(message.photo)
+    record['message_id'] = message.message_id
+    first = []
+
+    def add(state):
+        if state.get('media_group_id') == message.media_group_id:
+            state['album'].append(record)
+            state['album'].sort(key=lambda item: item['message_id'])
+        else:
+            state.clear()
+            state.update(media_group_id=message.media_group_id, album=[record])
+            first.append(True)
+        state.update({key: state['album'][0][key] for key in ('photo', 'photo_unique_id', 'sizes')})
 
-    max_characters = 4000 - (new_width + 1)
-    max_rows = max_characters // (new_width + 1)
+    user_states.modify(message.chat.id, add, default={})
+    return bool(first)
 
-    ascii_art = ""
-    for i in range(0, min(max_rows * img_width, len(img_str)), img_width):
-        ascii_art += img_str[i:i + img_width] + "\n"
 
-    return ascii_art
+def get_state(chat_id):
+    """
+    Возвращает состояние пользователя.
 
+    :param chat_id: Идентификатор чата.
+    :return: Словарь состояния.
+    :raises KeyError: Если состояния нет: фото еще не присылали или оно устарело.
+    """
+    state = user_states.get(chat_id)
+    if state is None:
+        raise KeyError(f"Нет состояния для чата {chat_id}")
+    return state
 
-def pixels_to_ascii(image, ascii_chars):
+
+def photo_state(photo_sizes):
+    """
+    Создает запись состояния пользователя для присланной фотографии.
+
+    Запоминаются все размеры, которые прислал Telegram, чтобы операции, которым не нужно
+    полное разрешение, скачивали и декодировали уменьшенный вариант.
+
+    :param photo_sizes: Список PhotoSize из message.photo (от меньшего к большему).
+    :return: Словарь состояния.
+    """
+    largest = photo_sizes[-1]
+    return {'photo': largest.file_id,
+            'photo_unique_id': largest.file_unique_id,
+            'sizes': [[size.file_id, size.file_unique_id, size.width, size.height] for size in photo_sizes]}
+
+
+def photo_size(chat_id):
     """
-    Преобразует пиксели изображения в символы ASCII.
+    Возвращает полный размер последней фотографии пользователя.
 
-    :param image: Изображение в оттенках серого (PIL.Image).
-    :param ascii_chars: Набор символов для преобразования.
-    :return: Строка символов, представляющая изображение.
+    :param chat_id: Идентификатор чата.
+    :return: Размер (ширина, высота) или None, если он неизвестен.
     """
-    pixels = image.getdata()
-    characters = ""
-    for pixel in pixels:
-        characters += ascii_chars[pixel * len(ascii_chars) // 256]
-    return characters
+    return record_size(get_state(chat_id))
 
 
-# Огрубляем изображение
-def pixelate_image(image, pixel_size):
+def record_size(record):
     """
-    Огрубляет изображение, создавая эффект пикселизации.
+    Возвращает полный размер фотографии из записи состояния.
 
-    :param image: Исходное изображение (PIL.Image).
-    :param pixel_size: Размер пикселя для огрубления.
-    :return: Пикселизированное изображение (PIL.Image).
+    :param record: Состояние пользователя или запись фото альбома.
+    :return: Размер (ширина, высота) или None, если он неизвестен.
     """
-    image = image.resize(
-        (image.size[0] // pixel_size, image.size[1] // pixel_size),
-        Image.NEAREST
-    )
-    image = image.resize(
-        (image.size[0] * pixel_size, image.size[1] * pixel_size),
-        Image.NEAREST
-    )
+    sizes = record.get('sizes')
+    return tuple(sizes[-1][2:4]) if sizes else None
+
+
+def choose_photo_size(state, target_size=None):
+    """
+    Выбирает наименьший вариант фотографии, который не меньше target_size.
+
+    :param state: Состояние пользователя.
+    :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+    :return: Пара (file_id, file_unique_id).
+    """
+    if target_size:
+        for file_id, file_unique_id, width, height in state.get('sizes', []):
+            if width >= target_size[0] and height >= target_size[1]:
+                return file_id, file_unique_id
+    return state['photo'], state.get('photo_unique_id', state['photo'])
+
+
+def load_photo(chat_id, target_size=None):
+    """
+    Возвращает последнюю присланную пользователем фотографию.
+
+    Фотография берется из кэша по file_unique_id, а при промахе скачивается из Telegram.
+    Если указан target_size, скачивается наименьший подходящий вариант фотографии и
+    декодируется сразу в уменьшенном разрешении, но не меньше target_size.
+    Возвращаемое изображение общее для всех обработчиков и не должно изменяться на месте.
+
+    :param chat_id: Идентификатор чата.
+    :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+    :return: Декодированное изображение (PIL.Image).
+    """
+    return fetch_photo(get_state(chat_id), target_size)
+
+
+def fetch_photo(record, target_size=None):
+    """
+    Возвращает фотографию, описанную записью состояния, из кэша или из Telegram.
+
+    :param record: Состояние пользователя или запись фото альбома.
+    :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+    :return: Декодированное изображение (PIL.Image).
+    """
+    file_id, file_unique_id = choose_photo_size(record, target_size)
+    download_seconds = []
+
+    def download():
+        started = time.perf_counter()
+        data = download_photo(file_id)
+        download_seconds.append(time.perf_counter() - started)
+        return data
+
+    started = time.perf_counter()
+    image = photo_cache.get_or_load(file_unique_id, download, target_size)
+    # Этап decode — поиск в кэше и декодирование, без времени скачивания
+    metrics.observe_stage("decode", time.perf_counter() - started - sum(download_seconds))
+    metrics.image("input", image.size)
     return image
 
 
-@bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
+def load_photo_data(chat_id):
     """
-    Обрабатывает команды /start и /help. Отправляет приветственное сообщение.
+    Возвращает байты последней присланной фотографии в полном размере, не декодируя ее.
 
-    :param message: Объект сообщения от пользователя.
+    :param chat_id: Идентификатор чата.
+    :return: Байты изображения.
     """
-    bot.reply_to(message, "Send me an image, and I'll provide options for you!")
+    file_id, file_unique_id = choose_photo_size(get_state(chat_id))
+    return photo_cache.get_or_load_data(file_unique_id, functools.partial(download_photo, file_id))
 
 
-@bot.message_handler(content_types=['photo'])
-def handle_photo(message):
+def download_photo(file_id):
     """
-    Обрабатывает получение фотографии от пользователя. Предлагает варианты действий.
+    Скачивает фотографию из Telegram.
 
-    :param message: Объект сообщения с фотографией.
+    :param file_id: file_id фотографии.
+    :return: Байты изображения.
+    """
+    with metrics.stage("get_file"):
+        file_info = bot.get_file(file_id)  # Запрашиваем информацию о файле
+    image_guard.check_file_size(file_info.file_size)
+    with metrics.stage("download"):
+        data = download_file(file_info.file_path)  # Скачиваем изображение
+    metrics.transfer("in", len(data))
+    return data
+
+
+def file_url(file_path):
+    """
+    Возвращает адрес файла на серверах Telegram (с учетом apihelper.FILE_URL).
+
+    :param file_path: file_path из getFile.
+    :return: URL файла.
+    """
+    return (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file_path)
+
+
+def download_file(file_path):
+    """
+    Скачивает файл потоком и прерывает скачивание, как только файл превысил лимит размера.
+
+    :param file_path: file_path из getFile.
+    :return: Байты изображения.
+    :raises ImageTooLargeError: Если файл или изображение больше лимитов image_guard.
+    """
+    download = image_guard.download()
+    try:
+        with apihelper._get_req_session().get(file_url(file_path), proxies=apihelper.proxy, stream=True,
+                                              timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)) as response:
+            if response.status_code != 200:
+                raise apihelper.ApiHTTPException('Download file', response)
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                download.write(chunk)
+    except BaseException:
+        download.close()
+        raise
+    return download.finish()
+
+
+# Описание операции над фото:
+# name и params — часть ключа кэша результатов, transform выполняется в пуле процессов,
+# file_name задан для результатов, которые отправляются документом,
+# target_size — минимальное разрешение исходника, которого достаточно операции (None — полное),
+# encoder_options — настройки кодировщика результата,
+# lossless — функция, которая обрабатывает байты исходного файла без декодирования и возвращает
+# EncodedImage или None, если для этого файла нужна обычная обработка
+PhotoOperation = namedtuple('PhotoOperation', ['name', 'transform', 'params', 'image_format', 'file_name',
+                                               'target_size', 'encoder_options', 'lossless'],
+                            defaults=(None, None))
+
+
+def photo_too_small(action, source_size):
+    """
+    Проверяет, что фото слишком маленькое для операции: пикселизация огрубляет его
+    блоками PIXELATE_PIXEL_SIZE, и у фото меньше блока не остается деталей.
+
+    :param action: callback_data кнопки.
+    :param source_size: Полный размер фотографии (ширина, высота) или None, если он неизвестен.
+    :return: True, если операцию к этому фото применять не нужно.
     """
-    bot.reply_to(message, "I got your photo! Please choose what you'd like to do with it.",
-                 reply_markup=get_options_keyboard())
-    user_states[message.chat.id] = {'photo': message.photo[-1].file_id}
+    return action == "pixelate" and source_size is not None and min(source_size) < PIXELATE_PIXEL_SIZE
+
+
+def photo_operation(action, source_size=None):
+    """
+    Возвращает описание операции над фото по callback_data кнопки.
+
+    :param action: callback_data кнопки, например "pixelate" или "mirror_vertical".
+    :param source_size: Полный размер фотографии (ширина, высота), если он известен.
+    :return: PhotoOperation или None, если это не операция над фото.
+    """
+    if action == "pixelate":
+        pixel_size = PIXELATE_PIXEL_SIZE
+        return PhotoOperation("pixelate",
+                              functools.partial(pixelate_image, pixel_size=pixel_size, source_size=source_size),
+                              (pixel_size,), "JPEG", None,
+                              pixelate_source_size(source_size, pixel_size) if source_size else None,
+                              PHOTO_JPEG_OPTIONS)
+    if action == "invert":
+        return PhotoOperation("invert", invert_colors, (), "JPEG", None, None, PHOTO_JPEG_OPTIONS)
+    if action in ("mirror_horizontal", "mirror_vertical"):
+        direction = action[len("mirror_"):]
+        # Отражение JPEG не требует декодирования и повторного сжатия (см. mirror_jpeg)
+        return PhotoOperation("mirror", functools.partial(mirror_image, direction=direction), (direction,),
+                              "JPEG", None, None, PHOTO_JPEG_OPTIONS,
+                              functools.partial(mirror_jpeg, direction=direction, max_pixels=MAX_IMAGE_PIXELS))
+    if action == "heatmap":
+        return PhotoOperation("heatmap", convert_to_heatmap, (), "JPEG", None, None, PHOTO_JPEG_OPTIONS)
+    if action in COLORMAP_ACTIONS:
+        colormap = action[len("colormap_"):]
+        return PhotoOperation("colormap", functools.partial(apply_colormap, colormap=colormap), (colormap,),
+                              "JPEG", None, None, PHOTO_JPEG_OPTIONS)
+    if action == "resize_for_sticker":
+        # Стикер должен быть в формате PNG
+        return PhotoOperation("resize_for_sticker", resize_for_sticker, (), "PNG", "sticker_image.png",
+                              sticker_size(source_size) if source_size else None, STICKER_PNG_OPTIONS)
+    return None
+
+
+def ascii_image_operation(ascii_chars):
+    """
+    Возвращает операцию «ASCII-арт картинкой» для набора символов.
+
+    :param ascii_chars: Набор символов, от самого темного к самому светлому.
+    :return: PhotoOperation; результат отправляется файлом PNG, чтобы тонкие символы не размывались сжатием.
+    """
+    return PhotoOperation("ascii_image",
+                          functools.partial(image_to_ascii_image, new_width=ASCII_IMAGE_WIDTH, ascii_chars=ascii_chars),
+                          (ASCII_IMAGE_WIDTH, ascii_chars), "PNG", "ascii_art.png",
+                          ascii_source_size(ASCII_IMAGE_WIDTH))
+
+
+def pipeline_operation(steps):
+    """
+    Собирает цепочку операций в одну операцию над фото.
+
+    Все шаги выполняются над одним изображением в памяти: фото декодируется один раз,
+    результат кодируется и отправляется тоже один раз. Формат результата определяется
+    последним шагом.
+
+    :param steps: Список callback_data шагов из PIPELINE_STEPS.
+    :return: PhotoOperation.
+    """
+    # Шаги получают изображение того размера, который вернул предыдущий шаг,
+    # поэтому исходник декодируется в полном разрешении
+    operations = [photo_operation(step) for step in steps]
+    last = operations[-1]
+    return PhotoOperation("pipeline",
+                          functools.partial(apply_pipeline, transforms=tuple(op.transform for op in operations)),
+                          tuple(steps), last.image_format, last.file_name, None, last.encoder_options)
+
+
+def describe_pipeline(steps):
+    """
+    Возвращает текстовое описание цепочки операций.
+
+    :param steps: Список callback_data шагов.
+    :return: Строка вида "Mirror Horizontally → Invert Colors".
+    """
+    return " → ".join(PIPELINE_STEPS[step] for step in steps) or "empty"
+
+
+def add_pipeline_step(chat_id, step):
+    """
+    Добавляет шаг в цепочку операций пользователя.
+
+    :param chat_id: Идентификатор чата.
+    :param step: callback_data шага.
+    :return: Ответ на нажатие кнопки с текущей цепочкой.
+    """
+    def add(state):
+        pipeline = state.setdefault('pipeline', [])
+        if step in PIPELINE_STEPS and len(pipeline) < MAX_PIPELINE_STEPS:
+            pipeline.append(step)
+
+    state = user_states.modify(chat_id, add)
+    return f"Pipeline: {describe_pipeline(state['pipeline'])}"
+
+
+def send_processed_image(chat_id, operation):
+    """
+    Обрабатывает фотографию пользователя и отправляет результат.
+
+    Если эту операцию с теми же параметрами уже применяли к этому фото, результат
+    отправляется по сохраненному file_id без обработки и повторной загрузки.
+
+    :param chat_id: Идентификатор чата.
+    :param operation: Описание операции (PhotoOperation).
+    """
+    state = get_state(chat_id)
+    cache_key = (state.get('photo_unique_id', state['photo']), operation.name, operation.params)
+    file_name = operation.file_name
+
+    file_id = result_cache.get(cache_key)
+    if file_id is not None:
+        try:
+            with metrics.stage("send"):
+                if file_name:
+                    bot.send_document(chat_id, file_id)
+                else:
+                    bot.send_photo(chat_id, file_id)
+            return
+        except telebot.apihelper.ApiTelegramException:
+            result_cache.discard(cache_key)  # file_id больше не действителен, обрабатываем заново
+
+    preview_target = None if file_name else preview_size(state, operation)
+    source = None
+    preview_id = None
+    if preview_target:
+        # Полное фото скачивается, пока готовится и отправляется превью
+        source = engine.start_io(load_source, chat_id, operation)
+        preview_id = send_preview(chat_id, state, operation, preview_target)
+    try:
+        source = source.result() if source else load_source(chat_id, operation)
+        if preview_id and render_cancelled(chat_id, preview_id):
+            return
+        # Преобразуем и сохраняем результат в пуле процессов, чтобы не занимать GIL потоков бота
+        encoded = None
+        if operation.lossless:
+            # Без jpegtran lossless декодирует файл в пуле процессов, поэтому память резервируется заранее
+            reserved = image_guard.reserve_decoding(source)
+            try:
+                encoded = engine.run_cpu(operation.lossless, source)
+            finally:
+                image_guard.budget.release(reserved)
+            if encoded is None:
+                source = load_photo(chat_id, operation.target_size)
+        if encoded is None:
+            encoded = engine.run_cpu(transform_and_encode, operation.transform, source, operation.image_format,
+                                     operation.encoder_options)
+        observe_encoded(encoded)
+        if preview_id and render_cancelled(chat_id, preview_id):
+            return
+        output_stream = io.BytesIO(encoded.data)
+
+        with metrics.stage("send"):
+            if file_name:
+                sent = bot.send_document(chat_id, output_stream, visible_file_name=file_name)
+                result_cache.put(cache_key, sent.document.file_id)
+                return
+            sent = None
+            if preview_id:
+                try:
+                    sent = bot.edit_message_media(types.InputMediaPhoto(output_stream), chat_id, preview_id)
+                except telebot.apihelper.ApiTelegramException:
+                    output_stream.seek(0)  # Превью удалили, отправляем результат новым сообщением
+            if not isinstance(sent, types.Message):
+                sent = bot.send_photo(chat_id, output_stream)
+            result_cache.put(cache_key, sent.photo[-1].file_id)
+    finally:
+        if preview_id:
+            render_cancels.pop((chat_id, preview_id), None)
+
+
+def load_source(chat_id, operation):
+    """
+    Возвращает исходник для операции: байты файла, если операция умеет работать с ними
+    без декодирования (operation.lossless), иначе декодированное изображение.
+
+    :param chat_id: Идентификатор чата.
+    :param operation: Описание операции (PhotoOperation).
+    :return: Байты изображения или изображение (PIL.Image).
+    """
+    if operation.lossless:
+        return load_photo_data(chat_id)
+    return load_photo(chat_id, operation.target_size)
+
+
+def preview_size(state, operation):
+    """
+    Возвращает размер, в котором нужно скачать фото для превью, или None, если превью не нужно.
+
+    Превью отправляется только для больших фото и только если полная обработка скачивает
+    вариант фото крупнее, чем превью: пикселизации, например, и так хватает маленького варианта.
+
+    :param state: Состояние пользователя.
+    :param operation: Описание операции (PhotoOperation).
+    :return: Размер (ширина, высота) или None.
+    """
+    size = record_size(state)
+    if not PREVIEW_SIDE or not size or max(size) < PREVIEW_MIN_SIDE:
+        return None
+    scale = PREVIEW_SIDE / max(size)
+    target = (max(1, int(size[0] * scale)), max(1, int(size[1] * scale)))
+    if choose_photo_size(state, target) == choose_photo_size(state, operation.target_size):
+        return None
+    return target
+
+
+def send_preview(chat_id, state, operation, target_size):
+    """
+    Обрабатывает маленький вариант фото и отправляет результат как превью с кнопкой отмены.
+
+    Превью небольшое, поэтому обрабатывается прямо в потоке задачи, не дожидаясь пула процессов.
+
+    :param chat_id: Идентификатор чата.
+    :param state: Состояние пользователя.
+    :param operation: Описание операции (PhotoOperation).
+    :param target_size: Размер варианта фото для превью (см. preview_size).
+    :return: message_id превью.
+    """
+    with metrics.stage("preview"):
+        image = fetch_photo(state, target_size)
+        encoded = transform_and_encode(
+            functools.partial(preview_image, transform=operation.transform, max_side=PREVIEW_SIDE),
+            image, "JPEG", PHOTO_JPEG_OPTIONS)
+        message = bot.send_photo(chat_id, io.BytesIO(encoded.data), caption=PREVIEW_CAPTION,
+                                 reply_markup=get_preview_keyboard())
+    metrics.transfer("out", len(encoded.data))
+    render_cancels[(chat_id, message.message_id)] = threading.Event()
+    return message.message_id
+
+
+def render_cancelled(chat_id, preview_id):
+    """
+    Проверяет, отменил ли пользователь полную обработку, и если да — оставляет превью без кнопки.
+
+    :param chat_id: Идентификатор чата.
+    :param preview_id: message_id превью.
+    :return: True, если обработку нужно прекратить.
+    """
+    if not render_cancels[(chat_id, preview_id)].is_set():
+        return False
+    bot.edit_message_caption(PREVIEW_CANCELLED_CAPTION, chat_id, preview_id)
+    return True
+
+
+def cancel_render(chat_id, preview_id):
+    """
+    Отменяет полную обработку, для которой отправлено превью.
+
+    Обработка прекращается на ближайшем этапе: до скачивания полного фото или до отправки результата.
+
+    :param chat_id: Идентификатор чата.
+    :param preview_id: message_id превью.
+    :return: True, если обработка еще шла и отменена.
+    """
+    cancel = render_cancels.get((chat_id, preview_id))
+    if cancel is None:
+        return False
+    cancel.set()
+    return True
+
+
+def observe_encoded(encoded):
+    """
+    Записывает в метрики время преобразования и кодирования и размеры результата.
+
+    :param encoded: Результат transform_and_encode (EncodedImage).
+    """
+    metrics.observe_stage("transform", encoded.transform_seconds)
+    metrics.observe_stage("encode", encoded.encode_seconds)
+    metrics.image("output", encoded.size)
+    metrics.transfer("out", len(encoded.data))
 
 
 def get_options_keyboard():
@@ -166,159 +729,248 @@ def get_options_keyboard():
     keyboard = types.InlineKeyboardMarkup()
     pixelate_btn = types.InlineKeyboardButton("Pixelate", callback_data="pixelate")
     ascii_btn = types.InlineKeyboardButton("ASCII Art", callback_data="ascii")
+    ascii_image_btn = types.InlineKeyboardButton("ASCII Image", callback_data="ascii_image")
     invert_btn = types.InlineKeyboardButton("Invert Colors", callback_data="invert")
     horizontal_mirror_btn = types.InlineKeyboardButton("Mirror Horizontally", callback_data="mirror_horizontal")
     vertical_mirror_btn = types.InlineKeyboardButton("Mirror Vertically", callback_data="mirror_vertical")
     heatmap_btn = types.InlineKeyboardButton("Heatmap", callback_data="heatmap")
     sticker_btn = types.InlineKeyboardButton("Resize for Sticker", callback_data="resize_for_sticker")
     joke_btn = types.InlineKeyboardButton("Random Joke", callback_data="random_joke")
-    keyboard.add(pixelate_btn, ascii_btn, invert_btn)
+    pipeline_btn = types.InlineKeyboardButton("Build Pipeline", callback_data="pipeline")
+    keyboard.add(pixelate_btn, invert_btn)
+    keyboard.add(ascii_btn, ascii_image_btn)
     keyboard.add(horizontal_mirror_btn, vertical_mirror_btn)
     keyboard.add(heatmap_btn,sticker_btn)
-    keyboard.add(joke_btn)
+    keyboard.row(*[types.InlineKeyboardButton(title, callback_data=action)
+                   for action, title in COLORMAP_ACTIONS.items()])
+    keyboard.add(pipeline_btn, joke_btn)
+    return keyboard
+
+
+def get_preview_keyboard():
+    """
+    Создает клавиатуру под превью.
+
+    :return: Объект InlineKeyboardMarkup с кнопкой отмены полной обработки.
+    """
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(types.InlineKeyboardButton("Cancel full render", callback_data="cancel_render"))
+    return keyboard
+
+
+def get_pipeline_keyboard():
+    """
+    Создает клавиатуру для сборки цепочки операций.
+
+    :return: Объект InlineKeyboardMarkup с кнопками шагов, запуска и очистки.
+    """
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*[types.InlineKeyboardButton(f"+ {title}", callback_data=f"pipeline_add:{step}")
+                   for step, title in PIPELINE_STEPS.items()])
+    run_btn = types.InlineKeyboardButton("Run", callback_data="pipeline_run")
+    clear_btn = types.InlineKeyboardButton("Clear", callback_data="pipeline_clear")
+    keyboard.add(run_btn, clear_btn)
     return keyboard
 
 
-@bot.callback_query_handler(func=lambda call: True)
+@metrics.track("callback_query")
 def callback_query(call):
     """
     Обрабатывает нажатие на кнопки встроенной клавиатуры.
 
     :param call: Объект callback-запроса.
     """
+    if call.data == "cancel_render":
+        cancelled = cancel_render(call.message.chat.id, call.message.message_id)
+        bot.answer_callback_query(call.id, CANCEL_RENDER_TEXT if cancelled else RENDER_DONE_TEXT)
+        return
+
+    state = user_states.get(call.message.chat.id)
+    if call.data != "random_joke" and state is None:
+        # Состояние устарело или бот перезапускали без постоянного хранилища
+        bot.answer_callback_query(call.id, NO_PHOTO_TEXT)
+        return
+
+    if state and len(state.get('album', [])) > 1 and (
+            call.data in PIPELINE_STEPS or (call.data == "pipeline_run" and state.get('pipeline'))):
+        submit_callback(call, "Processing all photos of your album...", album_and_send, call.message, call.data)
+        return
+
     if call.data == "pixelate":
-        bot.answer_callback_query(call.id, "Pixelating your image...")
-        pixelate_and_send(call.message)
-    elif call.data == "ascii":
-        bot.answer_callback_query(call.id, "Please send me the characters you want to use for ASCII art.")
-        user_states[call.message.chat.id]['waiting_for_chars'] = True
+        if photo_too_small(call.data, record_size(state)):
+            bot.answer_callback_query(call.id, TOO_SMALL_TEXT)
+        else:
+            submit_callback(call, "Pixelating your image...", pixelate_and_send, call.message)
+    elif call.data in ("ascii", "ascii_image"):
+        bot.answer_callback_query(call.id, ASCII_PROMPT_TEXT)
+        user_states.update(call.message.chat.id, waiting_for_chars=True,
+                           ascii_output="image" if call.data == "ascii_image" else "text")
     elif call.data == "invert":  # Обработка нажатия кнопки "Invert Colors"
-        bot.answer_callback_query(call.id, "Inverting colors of your image...")
-        invert_and_send(call.message)
+        submit_callback(call, "Inverting colors of your image...", invert_and_send, call.message)
     elif call.data == "mirror_horizontal":
-        bot.answer_callback_query(call.id, "Reflecting your image horizontally...")
-        mirror_and_send(call.message, direction="horizontal")
+        submit_callback(call, "Reflecting your image horizontally...", mirror_and_send, call.message,
+                        direction="horizontal")
     elif call.data == "mirror_vertical":
-        bot.answer_callback_query(call.id, "Reflecting your image vertically...")
-        mirror_and_send(call.message, direction="vertical")
+        submit_callback(call, "Reflecting your image vertically...", mirror_and_send, call.message,
+                        direction="vertical")
     elif call.data == "heatmap":  # Новый случай для тепловой карты
-        bot.answer_callback_query(call.id, "Converting your image to a heatmap...")
-        heatmap_and_send(call.message)
+        submit_callback(call, "Converting your image to a heatmap...", heatmap_and_send, call.message)
+    elif call.data in COLORMAP_ACTIONS:
+        submit_callback(call, f"Applying the {COLORMAP_ACTIONS[call.data]} palette...", colormap_and_send,
+                        call.message, call.data)
     elif call.data == "resize_for_sticker":
-        bot.answer_callback_query(call.id, "Resizing your image for sticker...")
-        resize_for_sticker_and_send(call.message)
+        submit_callback(call, "Resizing your image for sticker...", resize_for_sticker_and_send, call.message)
     elif call.data == "random_joke":  # Событие для кнопки с шуткой
-        bot.answer_callback_query(call.id, "Here's a random joke for you!")
-        random_joke_and_send(call)
+        submit_callback(call, "Here's a random joke for you!", random_joke_and_send, call)
+    elif call.data == "pipeline":
+        user_states.update(call.message.chat.id, pipeline=[])
+        bot.answer_callback_query(call.id, "Add steps to your pipeline, then press Run.")
+        send_in_chat(call.message.chat.id, bot.send_message, call.message.chat.id,
+                     "Choose the steps of your pipeline:", reply_markup=get_pipeline_keyboard())
+    elif call.data.startswith("pipeline_add:"):
+        bot.answer_callback_query(call.id, add_pipeline_step(call.message.chat.id, call.data.split(":", 1)[1]))
+    elif call.data == "pipeline_clear":
+        user_states.update(call.message.chat.id, pipeline=[])
+        bot.answer_callback_query(call.id, "Pipeline cleared.")
+    elif call.data == "pipeline_run":
+        if not get_state(call.message.chat.id).get('pipeline'):
+            bot.answer_callback_query(call.id, "Your pipeline is empty, add some steps first.")
+        else:
+            submit_callback(call, "Running your pipeline...", pipeline_and_send, call.message)
+
+
+def submit_callback(call, text, func, *args, **kwargs):
+    """
+    Ставит обработку нажатия в очередь чата и отвечает на callback-запрос.
+
+    Если очередь заполнена, пользователь получает просьбу повторить позже.
+
+    :param call: Объект callback-запроса.
+    :param text: Текст ответа на callback-запрос, если задача принята.
+    :param func: Функция-обработчик.
+    """
+    if engine.submit(call.message.chat.id, run_guarded, call.message.chat.id, func, *args, **kwargs):
+        bot.answer_callback_query(call.id, text)
+    else:
+        bot.answer_callback_query(call.id, BUSY_TEXT)
 
 
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id, {}).get('waiting_for_chars', False))
 def handle_ascii_chars(message):
     """
     Обрабатывает ввод пользовательского набора символов для ASCII-арта.
 
     :param message: Объект сообщения с набором символов.
     """
-    user_states[message.chat.id]['ascii_chars'] = message.text
-    user_states[message.chat.id]['waiting_for_chars'] = False
-    ascii_and_send(message)
+    state = user_states.update(message.chat.id, ascii_chars=message.text, waiting_for_chars=False) or {}
+    func = ascii_image_and_send if state.get('ascii_output') == "image" else ascii_and_send
+    if not engine.submit(message.chat.id, run_guarded, message.chat.id, func, message):
+        send_in_chat(message.chat.id, bot.reply_to, message, BUSY_TEXT)
 
 
+def run_guarded(chat_id, func, *args, **kwargs):
+    """
+    Выполняет обработчик и сообщает пользователю, если фото отклонено из-за лимитов image_guard.
+
+    :param chat_id: Идентификатор чата.
+    :param func: Функция-обработчик.
+    """
+    try:
+        func(*args, **kwargs)
+    except ImageTooLargeError:
+        bot.send_message(chat_id, TOO_LARGE_TEXT)
+    except ImageBudgetError:
+        bot.send_message(chat_id, BUSY_TEXT)
+
+
+@metrics.track("pixelate")
 def pixelate_and_send(message):
     """
     Пикселизирует изображение и отправляет его пользователю.
 
     :param message: Объект сообщения, содержащий идентификатор фотографии.
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
-    pixelated = pixelate_image(image, 20)
-
-    output_stream = io.BytesIO()
-    pixelated.save(output_stream, format="JPEG")
-    output_stream.seek(0)
-    bot.send_photo(message.chat.id, output_stream)
+    send_processed_image(message.chat.id, photo_operation("pixelate", photo_size(message.chat.id)))
 
 
+@metrics.track("ascii")
 def ascii_and_send(message):
     """
     Преобразует изображение в ASCII-арт и отправляет его пользователю.
 
     :param message: Объект сообщения, содержащий идентификатор фотографии.
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-
-    image_stream = io.BytesIO(downloaded_file)
-    ascii_chars = user_states[message.chat.id].get('ascii_chars', ASCII_CHARS)
-    ascii_art = image_to_ascii(image_stream, ascii_chars=ascii_chars)
-    bot.send_message(message.chat.id, f"```\n{ascii_art}\n```", parse_mode="MarkdownV2")
-
-def invert_colors(image):
+    image = load_photo(message.chat.id, ascii_source_size(ASCII_MAX_WIDTH))
+    ascii_chars = ascii_charset(get_state(message.chat.id))
+    width, height = ascii_size(image.size, ASCII_MAX_WIDTH, ASCII_MIN_WIDTH, max_messages=ASCII_MAX_MESSAGES)
+    with metrics.stage("transform"):
+        ascii_art = engine.run_cpu(functools.partial(image_to_ascii, new_width=width, new_height=height,
+                                                     ascii_chars=ascii_chars), image)
+    with metrics.stage("send"):
+        for text in ascii_messages(ascii_art):
+            bot.send_message(message.chat.id, text, parse_mode="MarkdownV2")
+
+
+@metrics.track("ascii_image")
+def ascii_image_and_send(message):
     """
-    Инвертирует цвета изображения.
+    Рисует ASCII-арт картинкой и отправляет его пользователю файлом PNG.
 
-    :param image: Исходное изображение (PIL.Image).
-    :return: Изображение с инвертированными цветами (PIL.Image).
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
     """
-    if image.mode == 'RGBA':
-        # Для прозрачных изображений обработка немного отличается
-        r, g, b, a = image.split()
-        rgb_image = Image.merge("RGB", (r, g, b))
-        inverted = ImageOps.invert(rgb_image)
-        r, g, b = inverted.split()
-        return Image.merge("RGBA", (r, g, b, a))
-    elif image.mode == 'RGB':
-        return ImageOps.invert(image)
-    else:
-        raise ValueError("Unsupported image mode for inversion!")  # Обработка других режимов изображения
+    send_processed_image(message.chat.id, ascii_image_operation(ascii_charset(get_state(message.chat.id))))
 
-def invert_and_send(message):
-    """
-    Инвертирует цвета изображения и отправляет пользователю.
 
-    :param message: Объект сообщения, содержащий идентификатор фотографии.
+def ascii_charset(state):
     """
-    photo_id = user_states[message.chat.id]['photo']  # Получаем ID фото
-    file_info = bot.get_file(photo_id)  # Запрашиваем информацию о файле
-    downloaded_file = bot.download_file(file_info.file_path)  # Скачиваем изображение
+    Возвращает набор символов ASCII-арта из состояния чата.
 
-    # Открываем изображение как поток байтов
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
+    :param state: Состояние чата.
+    :return: Набор пользователя, упорядоченный по плотности символов, или ASCII_CHARS.
+    """
+    ascii_chars = state.get('ascii_chars')
+    return sort_ascii_chars(ascii_chars) if ascii_chars else ASCII_CHARS
 
-    # Инвертируем изображение с помощью нашей функции invert_colors
-    inverted_image = invert_colors(image)
 
-    # Сохраняем результат в поток байтов
-    output_stream = io.BytesIO()
-    inverted_image.save(output_stream, format="JPEG")
-    output_stream.seek(0)
+def ascii_messages(ascii_art, limit=ASCII_MESSAGE_LIMIT):
+    """
+    Разбивает ASCII-арт на сообщения MarkdownV2 с блоком кода, не разрывая строки.
 
-    # Отправляем инвертированное изображение обратно пользователю
-    bot.send_photo(message.chat.id, output_stream)
+    Внутри блока кода MarkdownV2 экранировать нужно только ` и \\; остальные символы
+    пользовательского набора отправляются как есть.
 
-def mirror_image(image, direction="horizontal"):
+    :param ascii_art: ASCII-арт (строки, разделенные переводом строки).
+    :param limit: Сколько символов арта помещается в одно сообщение; разметка блока кода
+        укладывается в запас ASCII_MESSAGE_LIMIT до предела Telegram (4096 символов).
+    :return: Список текстов сообщений.
     """
-    Создает отражение изображения.
+    messages = []
+    rows = []
+    size = 0
+    for row in ascii_art.splitlines():
+        row = row.replace("\\", "\\\\").replace("`", "\\`") + "\n"
+        if rows and size + len(row) > limit:
+            messages.append("```\n" + "".join(rows) + "```")
+            rows = []
+            size = 0
+        rows.append(row)
+        size += len(row)
+    if rows:
+        messages.append("```\n" + "".join(rows) + "```")
+    return messages
+
+
+@metrics.track("invert")
+def invert_and_send(message):
+    """
+    Инвертирует цвета изображения и отправляет пользователю.
 
-    :param image: Исходное изображение (PIL.Image).
-    :param direction: Направление: 'horizontal' или 'vertical'.
-    :return: Отраженное изображение (PIL.Image).
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
     """
-    if direction == "horizontal":
-        return image.transpose(Image.FLIP_LEFT_RIGHT)
-    elif direction == "vertical":
-        return image.transpose(Image.FLIP_TOP_BOTTOM)
-    else:
-        raise ValueError("Invalid direction! Use 'horizontal' or 'vertical'.")
+    # Инвертируем изображение с помощью нашей функции invert_colors
+    send_processed_image(message.chat.id, photo_operation("invert"))
 
 
+@metrics.track("mirror")
 def mirror_and_send(message, direction):
     """
     Отражает изображение и отправляет пользователю.
@@ -326,123 +978,160 @@ def mirror_and_send(message, direction):
     :param message: Объект сообщения, содержащий идентификатор фотографии.
     :param direction: Направление: 'horizontal' или 'vertical'.
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
-
     # Отражаем изображение
-    mirrored_image = mirror_image(image, direction)
+    send_processed_image(message.chat.id, photo_operation(f"mirror_{direction}"))
+
 
-    # Сохраняем результат в поток байтов
-    output_stream = io.BytesIO()
-    mirrored_image.save(output_stream, format="JPEG")
-    output_stream.seek(0)
+@metrics.track("heatmap")
+def heatmap_and_send(message):
+    """
+    Преобразовывает изображение в тепловую карту и отправляет его пользователю.
 
-    # Отправляем отражённое изображение
-    bot.send_photo(message.chat.id, output_stream)
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
+    """
+    # Применяем тепловую карту через нашу функцию
+    send_processed_image(message.chat.id, photo_operation("heatmap"))
 
 
-def convert_to_heatmap(image):
+@metrics.track("colormap")
+def colormap_and_send(message, action):
     """
-    Преобразовывает изображение в тепловую карту.
+    Раскрашивает изображение выбранной палитрой и отправляет его пользователю.
 
-    :param image: Исходное изображение (PIL.Image).
-    :return: Изображение в виде тепловой карты (PIL.Image).
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
+    :param action: callback_data палитры из COLORMAP_ACTIONS.
     """
-    # Преобразуем изображение в оттенки серого
-    grayscale = image.convert("L")
+    send_processed_image(message.chat.id, photo_operation(action))
 
-    # Применяем цветовую карту через ImageOps.colorize
-    # Синий для холодных областей, оранжевый для теплых
-    heatmap = ImageOps.colorize(
-        grayscale,
-        black="blue",  # Цвет для "темных" (холодных) областей
-        white="red"  # Цвет для "светлых" (теплых) областей
-    )
-    return heatmap
 
-def heatmap_and_send(message):
+@metrics.track("resize_for_sticker")
+def resize_for_sticker_and_send(message):
     """
-    Преобразовывает изображение в тепловую карту и отправляет его пользователю.
+    Изменяет размер изображения для стикера и отправляет его пользователю.
 
     :param message: Объект сообщения, содержащий идентификатор фотографии.
     """
-    photo_id = user_states[message.chat.id]['photo']  # Получаем ID фото
-    file_info = bot.get_file(photo_id)  # Запрашиваем информацию о файле
-    downloaded_file = bot.download_file(file_info.file_path)  # Скачиваем изображение
+    # Изменяем размер изображения для стикера
+    send_processed_image(message.chat.id, photo_operation("resize_for_sticker", photo_size(message.chat.id)))
 
-    # Открываем изображение как поток байтов
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
+@metrics.track("pipeline")
+def pipeline_and_send(message):
+    """
+    Применяет к изображению цепочку операций пользователя и отправляет один результат.
 
-    # Применяем тепловую карту через нашу функцию
-    heatmap_image = convert_to_heatmap(image)
+    :param message: Объект сообщения, содержащий идентификатор фотографии.
+    """
+    steps = get_state(message.chat.id).get('pipeline')
+    if steps:
+        send_processed_image(message.chat.id, pipeline_operation(steps))
 
-    # Сохраняем результат в поток байтов
-    output_stream = io.BytesIO()
-    heatmap_image.save(output_stream, format="JPEG")
-    output_stream.seek(0)
 
-    # Отправляем изображение тепловой карты обратно пользователю
-    bot.send_photo(message.chat.id, output_stream)
+def album_operations(state, action):
+    """
+    Возвращает операции для каждого фото альбома.
 
+    :param state: Состояние пользователя с альбомом.
+    :param action: callback_data операции над фото или "pipeline_run".
+    :return: Список PhotoOperation в порядке фото альбома.
+    """
+    if action == "pipeline_run":
+        return [pipeline_operation(state['pipeline'])] * len(state['album'])
+    return [photo_operation(action, record_size(record)) for record in state['album']]
 
-def resize_for_sticker(image, max_size=512):
+
+@metrics.track("album")
+def album_and_send(message, action):
     """
-    Изменяет размер изображения до максимально допустимого размера для стикеров Telegram.
+    Применяет операцию ко всем фото альбома и отправляет результаты одним альбомом.
+
+    Фото скачиваются параллельно, преобразуются параллельно в пуле процессов и
+    отправляются одним вызовом send_media_group. Уже обработанные ранее фото
+    отправляются по сохраненному file_id.
 
-    :param image: Исходное изображение (PIL.Image).
-    :param max_size: Максимальная длина одной из сторон (по умолчанию 512 пикселей).
-    :return: Изображение подходящего размера (PIL.Image).
+    :param message: Объект сообщения из чата с альбомом.
+    :param action: callback_data операции над фото или "pipeline_run".
     """
-    # Получаем текущий размер изображения
-    width, height = image.size
+    state = get_state(message.chat.id)
+    send_album(message.chat.id, state['album'], album_operations(state, action))
 
-    # Пропорциональное изменение сторон
-    if width > max_size or height > max_size:
-        if width > height:
-            new_width = max_size
-            new_height = int((height / width) * new_width)
-        else:
-            new_height = max_size
-            new_width = int((width / height) * new_height)
 
-        # Меняем размер изображения
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    return image
+def send_album(chat_id, records, operations):
+    """
+    Обрабатывает и отправляет фото альбома группами по 10 (ограничение Telegram).
 
-def resize_for_sticker_and_send(message):
+    Если Telegram отклонил группу с сохраненными file_id (file_id больше не действителен),
+    заново обрабатываются и отправляются только фото этой группы; остальные ошибки API
+    не повторяются, чтобы пользователь не получил уже отправленные группы еще раз.
+
+    :param chat_id: Идентификатор чата.
+    :param records: Записи фото альбома.
+    :param operations: Операция (PhotoOperation) для каждого фото.
     """
-    Изменяет размер изображения для стикера и отправляет его пользователю.
+    cache_keys = [(record['photo_unique_id'], op.name, op.params) for record, op in zip(records, operations)]
+    media = [result_cache.get(key) for key in cache_keys]
+    render_album(media, records, operations, [i for i, item in enumerate(media) if item is None])
+
+    for start in range(0, len(media), 10):
+        indexes = range(start, min(start + 10, len(media)))
+        cached = [i for i in indexes if isinstance(media[i], str)]
+        try:
+            with metrics.stage("send"):
+                sent = bot.send_media_group(chat_id, album_media_group(media, operations, indexes))
+        except telebot.apihelper.ApiTelegramException as e:
+            if not cached or e.error_code != 400:
+                raise
+            for i in cached:
+                result_cache.discard(cache_keys[i])
+            render_album(media, records, operations, cached)
+            with metrics.stage("send"):
+                sent = bot.send_media_group(chat_id, album_media_group(media, operations, indexes))
+        for i, sent_message in zip(indexes, sent):
+            if sent_message.document:
+                result_cache.put(cache_keys[i], sent_message.document.file_id)
+            elif sent_message.photo:
+                result_cache.put(cache_keys[i], sent_message.photo[-1].file_id)
+
+
+def render_album(media, records, operations, indexes):
+    """
+    Скачивает и обрабатывает фото альбома с номерами indexes и записывает результаты в media.
 
-    :param message: Объект сообщения, содержащий идентификатор фотографии.
+    :param media: file_id или байты результата для каждого фото; изменяется на месте.
+    :param records: Записи фото альбома.
+    :param operations: Операция (PhotoOperation) для каждого фото.
+    :param indexes: Номера фото, которые нужно обработать.
     """
-    photo_id = user_states[message.chat.id]['photo']  # Получаем ID фото
-    file_info = bot.get_file(photo_id)  # Запрашиваем информацию о файле
-    downloaded_file = bot.download_file(file_info.file_path)  # Скачиваем изображение
+    images = engine.map_io(fetch_photo, [records[i] for i in indexes],
+                           [operations[i].target_size for i in indexes])
+    results = engine.map_cpu(transform_and_encode, [operations[i].transform for i in indexes], images,
+                             [operations[i].image_format for i in indexes],
+                             [operations[i].encoder_options for i in indexes])
+    for i, encoded in zip(indexes, results):
+        observe_encoded(encoded)
+        media[i] = encoded.data
 
-    # Открываем изображение как поток байтов
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
 
-    # Изменяем размер изображения для стикера
-    resized_image = resize_for_sticker(image)
+def album_media_group(media, operations, indexes):
+    """
+    Собирает одну группу send_media_group из результатов альбома.
 
-    # Сохраняем результат в поток байтов
-    output_stream = io.BytesIO()
-    resized_image.save(output_stream, format="PNG")  # Стикер должен быть в формате PNG
-    output_stream.seek(0)
+    Потоки байтов создаются заново при каждом вызове, поэтому группу можно отправить повторно.
+
+    :param media: file_id или байты результата для каждого фото.
+    :param operations: Операция (PhotoOperation) для каждого фото.
+    :param indexes: Номера фото группы.
+    :return: Список InputMediaPhoto или InputMediaDocument.
+    """
+    group = []
+    for i in indexes:
+        item, file_name = media[i], operations[i].file_name
+        if isinstance(item, bytes):
+            item = types.InputFile(io.BytesIO(item), file_name) if file_name else io.BytesIO(item)
+        group.append(types.InputMediaDocument(item) if file_name else types.InputMediaPhoto(item))
+    return group
 
-    # Отправляем переработанное изображение обратно пользователю
-    bot.send_document(
-        message.chat.id,
-        output_stream,
-        visible_file_name="sticker_image.png",  # Здесь указываем имя файла
-        )
 
+@metrics.track("random_joke")
 def random_joke_and_send(call):
     """
     Отправляет случайную шутку пользователю.
@@ -450,7 +1139,105 @@ def random_joke_and_send(call):
     :param call: Объект callback-запроса.
     """
     joke = random.choice(JOKES)  # Выбираем случайную шутку из списка
-    bot.send_message(call.message.chat.id, joke)  # Отправляем шутку пользователю
+    with metrics.stage("send"):
+        bot.send_message(call.message.chat.id, joke)  # Отправляем шутку пользователю
+
+
+def cache_metrics():
+    """
+    Возвращает текущее заполнение кэша фотографий и лимита памяти изображений для метрик.
+
+    :return: Словарь {имя метрики: значение}.
+    """
+    stats = photo_cache.stats()
+    budget = image_guard.budget.stats()
+    return {"bot_photo_cache_items": stats['items'], "bot_photo_cache_bytes": stats['bytes'],
+            "bot_image_memory_bytes": budget['used'], "bot_image_memory_limit_bytes": budget['max']}
+
+
+def engine_metrics():
+    """
+    Возвращает состояние очереди обработки для метрик.
+
+    :return: Словарь {имя метрики: значение}.
+    """
+    stats = engine.stats()
+    return {"bot_queue_depth": stats['queue_depth'], "bot_tasks_running": stats['running'],
+            "bot_tasks_rejected": stats['rejected']}
 
 
-bot.polling(none_stop=True)
\ No newline at end of file
+def outbound_metrics(scheduler=None):
+    """
+    Возвращает состояние планировщика исходящих запросов для метрик.
+
+    :param scheduler: Планировщик (None — планировщик этого бота).
+    :return: Словарь {имя метрики: значение}.
+    """
+    stats = (scheduler or outbound).stats()
+    return {"bot_api_waiting_requests": stats['waiting'], "bot_api_limited_chats": stats['chats'],
+            "bot_api_coalesced_answers": stats['coalesced']}
+
+
+def create_stores():
+    """
+    Создает хранилище состояний, лимиты памяти изображений и кэши — то, что общее у bot.py и async_bot.py.
+    """
+    global user_states, image_guard, photo_cache, result_cache
+    if user_states is not None:
+        return
+    if STATE_DB_FILE:
+        user_states = SQLiteStateStore(STATE_DB_FILE, ttl=STATE_TTL, max_items=STATE_MAX_ITEMS)
+    else:
+        user_states = MemoryStateStore(ttl=STATE_TTL, max_items=STATE_MAX_ITEMS)
+    image_guard = ImageGuard(max_pixels=MAX_IMAGE_PIXELS, max_file_bytes=MAX_DOWNLOAD_BYTES,
+                             budget_bytes=IMAGE_MEMORY_BUDGET, budget_wait=IMAGE_BUDGET_WAIT)
+    photo_cache = PhotoCache(max_bytes=PHOTO_CACHE_MAX_BYTES, max_items=PHOTO_CACHE_MAX_ITEMS,
+                             disk_dir=PHOTO_CACHE_DIR, guard=image_guard)
+    result_cache = ResultCache(ttl=RESULT_CACHE_TTL, max_items=RESULT_CACHE_MAX_ITEMS)
+
+
+def create_app():
+    """
+    Создает бота: читает токен, открывает хранилище состояний и кэши, запускает очередь обработки
+    и планировщик исходящих запросов и регистрирует обработчики. Повторный вызов возвращает того же бота.
+
+    Это делается при запуске, а не при импорте модуля: процессы пула преобразований (spawn) заново
+    импортируют главный модуль, и каждый из них иначе открывал бы базу, создавал свою очередь и кэши.
+
+    :return: Объект TeleBot.
+    """
+    global TOKEN, bot, engine, outbound
+    if bot is not None:
+        return bot
+    TOKEN = read_token_from_file(TOKEN_FILE)
+    create_stores()
+    engine = TaskEngine(io_workers=IO_WORKERS, cpu_workers=CPU_WORKERS, max_queue=MAX_QUEUE,
+                        on_wait=metrics.queue_wait)
+    outbound = OutboundScheduler(global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                                 chat_burst=OUTBOUND_BURST, group_rate=OUTBOUND_GROUP_RATE,
+                                 group_burst=OUTBOUND_BURST, max_retries=OUTBOUND_MAX_RETRIES,
+                                 max_retry_after=OUTBOUND_MAX_RETRY_AFTER,
+                                 on_wait=metrics.api_wait, on_retry=metrics.api_retry)
+    outbound.install()
+
+    # Обновления разбираются по одному в потоке опроса, в порядке поступления: с пулом потоков telebot
+    # два нажатия одного чата могли бы обработаться в обратном порядке. Долгая работа и отправка
+    # сообщений выполняются в очереди чата (engine), а не в потоке опроса
+    bot = telebot.TeleBot(TOKEN, threaded=False)
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(send_stats, commands=['stats'])
+    bot.register_message_handler(handle_photo, content_types=['photo'])
+    bot.register_message_handler(
+        handle_ascii_chars, func=lambda message: user_states.get(message.chat.id, {}).get('waiting_for_chars', False))
+    bot.register_callback_query_handler(callback_query, func=lambda call: True)
+    return bot
+
+
+if __name__ == "__main__":
+    create_app()
+    if METRICS_PORT:
+        metrics.add_collector(cache_metrics)
+        metrics.add_collector(engine_metrics)
+        metrics.add_collector(outbound_metrics)
+        metrics.serve(METRICS_HOST, METRICS_PORT)
+    bot.polling(none_stop=True)
\ No newline at end of file
@@ -0,0 +1,304 @@
+import io
+import math
+import threading
+import time
+import weakref
+
+from PIL import Image, ImageMode
+
+
+class ImageTooLargeError(ValueError):
+    """
+    Файл или изображение превышает допустимые размеры и не может быть обработано.
+    """
+
+
+class ImageBudgetError(RuntimeError):
+    """
+    Общий лимит памяти для изображений исчерпан и не освободился за время ожидания.
+    """
+
+
+def pixel_bytes(mode):
+    """
+    Возвращает, сколько байтов памяти Pillow занимает один пиксель изображения в режиме mode.
+
+    Многоканальные 8-битные режимы (RGB, YCbCr, LA и другие) Pillow хранит по 4 байта на пиксель,
+    сколько бы каналов в них ни было; одноканальные — по размеру канала (L и P — 1, I и F — 4).
+
+    :param mode: Режим изображения PIL, например "RGB".
+    :return: Количество байтов.
+    """
+    image_mode = ImageMode.getmode(mode)
+    if len(image_mode.bands) > 1:
+        return 4
+    return int(image_mode.typestr[-1])
+
+
+def image_memory_size(image):
+    """
+    Оценивает объем памяти, занимаемый пикселями изображения после декодирования.
+
+    :param image: Изображение (PIL.Image), в том числе еще не загруженное.
+    :return: Количество байтов.
+    """
+    return image.width * image.height * pixel_bytes(image.mode)
+
+
+class MemoryBudget:
+    """
+    Общий лимит памяти для декодированных изображений всех запросов.
+
+    Резерв привязан к объекту изображения и освобождается, когда изображение удаляется
+    сборщиком мусора, поэтому лимит учитывает все живые изображения, включая те, что
+    лежат в кэше фотографий.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: Лимит памяти в байтах.
+        """
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def available(self):
+        """
+        :return: Сколько байтов можно зарезервировать сейчас.
+        """
+        with self._condition:
+            return self.max_bytes - self._used
+
+    def reserve(self, size, timeout=0):
+        """
+        Резервирует память, при необходимости ожидая, пока другие изображения освободят ее.
+
+        :param size: Количество байтов.
+        :param timeout: Сколько секунд ждать освобождения памяти.
+        :return: True, если память зарезервирована, False, если лимит не освободился.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._used + size > self.max_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or size > self.max_bytes:
+                    return False
+                self._condition.wait(remaining)
+            self._used += size
+            return True
+
+    def release(self, size):
+        """
+        Возвращает память в лимит.
+
+        :param size: Количество байтов.
+        """
+        with self._condition:
+            self._used -= size
+            self._condition.notify_all()
+
+    def attach(self, image, size):
+        """
+        Освобождает резерв, когда изображение будет удалено.
+
+        :param image: Изображение (PIL.Image), для которого зарезервирована память.
+        :param size: Количество зарезервированных байтов.
+        """
+        weakref.finalize(image, self.release, size)
+
+    def stats(self):
+        """
+        :return: Словарь с занятыми байтами и лимитом.
+        """
+        with self._condition:
+            return {'used': self._used, 'max': self.max_bytes}
+
+
+class ImageGuard:
+    """
+    Защищенная загрузка изображений с ограничением памяти.
+
+    - Скачивание идет потоком и прерывается, как только файл превысил max_file_bytes,
+      поэтому в памяти никогда не оказывается больше max_file_bytes байтов файла.
+    - Размеры проверяются по заголовку до декодирования пикселей.
+    - Изображение больше max_pixels не отклоняется, а декодируется в уменьшенном виде
+      (для JPEG — прямо в декодере, см. PIL.Image.draft); отклоняются только изображения,
+      которые нельзя уменьшить до лимита.
+    - Все декодированные изображения делят общий лимит памяти budget; когда он почти
+      исчерпан, изображения декодируются еще меньше, а если места нет совсем — запрос
+      ждет освобождения памяти до budget_wait секунд.
+    """
+
+    # JPEG можно уменьшить при декодировании не более чем в 8 раз по каждой стороне
+    MAX_DRAFT_SCALE = 8
+
+    def __init__(self, max_pixels=16_000_000, max_file_bytes=20 * 1024 * 1024,
+                 budget_bytes=256 * 1024 * 1024, budget_wait=10):
+        """
+        :param max_pixels: Лимит пикселей одного декодированного изображения.
+        :param max_file_bytes: Лимит размера скачиваемого файла.
+        :param budget_bytes: Общий лимит памяти для всех декодированных изображений.
+        :param budget_wait: Сколько секунд ждать освобождения общего лимита.
+        """
+        self.max_pixels = max_pixels
+        self.max_file_bytes = max_file_bytes
+        self.budget = MemoryBudget(budget_bytes)
+        self.budget_wait = budget_wait
+
+    def check_file_size(self, size):
+        """
+        Проверяет размер файла до скачивания (например, по file_size из getFile).
+
+        :param size: Размер файла в байтах или None, если он неизвестен.
+        :raises ImageTooLargeError: Если файл больше лимита.
+        """
+        if size and size > self.max_file_bytes:
+            raise ImageTooLargeError(f"Файл {size} байт больше лимита {self.max_file_bytes} байт")
+
+    def download(self):
+        """
+        Создает приемник для потокового скачивания.
+
+        :return: Download; данные записываются методом write, результат возвращает finish.
+        """
+        return Download(self)
+
+    def open(self, data, target_size=None):
+        """
+        Открывает изображение и выбирает разрешение декодирования, не декодируя пиксели.
+
+        :param data: Байты изображения.
+        :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+        :return: Открытое, но еще не загруженное изображение (PIL.Image).
+        :raises ImageTooLargeError: Если изображение нельзя уменьшить до лимита пикселей.
+        """
+        image = self.open_header(io.BytesIO(data))
+        width, height = image.size
+        is_jpeg = image.format == "JPEG"
+        if not is_jpeg and width * height > self.max_pixels:
+            raise ImageTooLargeError(f"Изображение {width}x{height} больше лимита {self.max_pixels} пикселей")
+
+        allowed = min(self.max_pixels, max(self.budget.available() // pixel_bytes(image.mode), 1))
+        scale = self._draft_scale(width, height, allowed) if is_jpeg else 1
+        if target_size and min(target_size) > 0 and is_jpeg:
+            # Уменьшаем сильнее, если операции достаточно target_size
+            scale = max(scale, self._target_scale(width, height, target_size))
+        if scale > 1:
+            image.draft(image.mode, (math.ceil(width / scale), math.ceil(height / scale)))
+        return image
+
+    def open_header(self, fp):
+        """
+        Открывает изображение, прочитав только заголовок, и проверяет его размеры.
+
+        :param fp: Файловый объект с изображением.
+        :return: Открытое, но еще не загруженное изображение (PIL.Image).
+        :raises ImageTooLargeError: Если изображение не получится уменьшить до лимита даже при декодировании.
+        """
+        try:
+            image = Image.open(fp)
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(str(e)) from e
+        width, height = image.size
+        limit = self.max_pixels * self.MAX_DRAFT_SCALE ** 2 if image.format == "JPEG" else self.max_pixels
+        if width * height > limit:
+            raise ImageTooLargeError(f"Изображение {width}x{height} больше лимита {limit} пикселей")
+        return image
+
+    def load(self, image):
+        """
+        Декодирует открытое изображение в пределах общего лимита памяти.
+
+        :param image: Изображение, которое вернул open.
+        :return: То же изображение, загруженное; резерв памяти освободится вместе с ним.
+        :raises ImageBudgetError: Если общий лимит не освободился за budget_wait секунд.
+        """
+        size = image_memory_size(image)
+        if not self.budget.reserve(size, self.budget_wait):
+            raise ImageBudgetError(f"Нет памяти для изображения {image.width}x{image.height}")
+        try:
+            image.load()
+        except BaseException:
+            self.budget.release(size)
+            raise
+        self.budget.attach(image, size)
+        return image
+
+    def reserve_decoding(self, data):
+        """
+        Резервирует в общем лимите память для изображения, которое декодируется не через load,
+        например в пуле процессов (image_processing.mirror_jpeg без jpegtran).
+
+        Изображения больше max_pixels ничего не резервируют: такой код должен отказываться
+        их декодировать, и они обрабатываются обычным путем через open и load.
+
+        :param data: Байты изображения.
+        :return: Сколько байтов зарезервировано; после декодирования их нужно вернуть через budget.release.
+        :raises ImageTooLargeError: Если изображение больше лимитов image_guard.
+        :raises ImageBudgetError: Если общий лимит не освободился за budget_wait секунд.
+        """
+        image = self.open_header(io.BytesIO(data))
+        size = image_memory_size(image) if image.width * image.height <= self.max_pixels else 0
+        if not self.budget.reserve(size, self.budget_wait):
+            raise ImageBudgetError(f"Нет памяти для изображения {image.width}x{image.height}")
+        return size
+
+    def _draft_scale(self, width, height, max_pixels):
+        # Наименьшее уменьшение из 1, 2, 4, 8, при котором изображение укладывается в лимит
+        scale = 1
+        while scale < self.MAX_DRAFT_SCALE and (width // scale) * (height // scale) > max_pixels:
+            scale *= 2
+        return scale
+
+    def _target_scale(self, width, height, target_size):
+        # Наибольшее уменьшение из 1, 2, 4, 8, при котором изображение не меньше target_size
+        scale = 1
+        while (scale < self.MAX_DRAFT_SCALE
+               and width // (scale * 2) >= target_size[0] and height // (scale * 2) >= target_size[1]):
+            scale *= 2
+        return scale
+
+
+class Download:
+    """
+    Приемник потокового скачивания с лимитом размера ImageGuard.max_file_bytes.
+
+    Файл собирается в памяти: кэш фотографий и преобразования все равно работают с байтами,
+    а лимит (для ботов Telegram отдает файлы не больше 20 МБ) ограничивает их объем.
+    """
+
+    def __init__(self, guard):
+        self._guard = guard
+        self._file = io.BytesIO()
+        self._size = 0
+
+    def write(self, chunk):
+        """
+        Дописывает часть файла.
+
+        :param chunk: Байты.
+        :raises ImageTooLargeError: Если файл превысил лимит; скачивание нужно прервать.
+        """
+        self._size += len(chunk)
+        self._guard.check_file_size(self._size)
+        self._file.write(chunk)
+
+    def finish(self):
+        """
+        Проверяет заголовок скачанного изображения и возвращает его байты.
+
+        :return: Байты изображения.
+        :raises ImageTooLargeError: Если изображение нельзя обработать в пределах лимитов.
+        """
+        try:
+            self._file.seek(0)
+            self._guard.open_header(self._file)
+            return self._file.getvalue()  # без копирования буфера
+        finally:
+            self._file.close()
+
+    def close(self):
+        """
+        Освобождает буфер, если скачивание прервано.
+        """
+        self._file.close()
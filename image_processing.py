@@ -0,0 +1,522 @@
+import functools
+import io
+import math
+import shutil
+import subprocess
+import time
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont, JpegImagePlugin
+
+# набор символов из которых составляем изображение
+ASCII_CHARS = '@%#*+=-:. '
+
+# ASCII-арт текстом: символ примерно вдвое выше, чем шире, а одно сообщение Telegram вмещает до 4096 символов
+ASCII_CHAR_ASPECT = 0.55
+ASCII_MESSAGE_LIMIT = 4000
+
+# ASCII-арт картинкой: моноширинный шрифт (ищется в системных каталогах шрифтов; если его нет,
+# используется шрифт Pillow по умолчанию, а символы все равно выравниваются по сетке)
+ASCII_FONT = "DejaVuSansMono.ttf"
+ASCII_FONT_SIZE = 14
+
+# Результат transform_and_encode: байты файла, размер результата и время этапов в секундах
+EncodedImage = namedtuple('EncodedImage', ['data', 'size', 'transform_seconds', 'encode_seconds'])
+
+# Настройки кодировщика по операциям. optimize строит таблицы Хаффмана под изображение:
+# файл на 10–35% меньше при тех же пикселях ценой нескольких миллисекунд кодирования.
+# PNG стикеров сжимается с уровнем 4: вдвое быстрее уровня по умолчанию, а файл больше на несколько процентов.
+PHOTO_JPEG_OPTIONS = {'quality': 75, 'subsampling': "4:2:0", 'optimize': True}
+STICKER_PNG_OPTIONS = {'compress_level': 4}
+
+# Режимы, которые JPEG сохраняет без преобразования
+JPEG_MODES = ("L", "RGB", "CMYK")
+
+# jpegtran (libjpeg-turbo) отражает JPEG без декодирования; если его нет, используется запасной путь
+JPEGTRAN = shutil.which("jpegtran")
+JPEGTRAN_TIMEOUT = 30
+
+_INVERT_LUT = [255 - value for value in range(256)]
+_IDENTITY_LUT = list(range(256))
+
+
+def resize_image(image, new_width=100):
+    """
+    Изменяет размер изображения, сохраняя соотношение сторон.
+
+    :param image: Исходное изображение (PIL.Image).
+    :param new_width: Новая ширина изображения.
+    :return: Изображение с измененным размером (PIL.Image).
+    """
+    width, height = image.size
+    ratio = height / width
+    new_height = int(new_width * ratio)
+    return image.resize((new_width, new_height))
+
+
+def grayify(image):
+    """
+    Преобразует изображение в оттенки серого.
+
+    :param image: Исходное изображение (PIL.Image).
+    :return: Изображение в оттенках серого (PIL.Image).
+    """
+    return image.convert("L")
+
+
+def ascii_source_size(new_width=40):
+    """
+    Возвращает разрешение, которого достаточно для ASCII-арта шириной new_width символов.
+
+    Берем вдвое больше символов, чтобы уменьшение до new_width сглаживало детали.
+
+    :param new_width: Ширина ASCII-арта (количество символов в строке).
+    :return: Размер (ширина, высота); высота фактически не ограничивается.
+    """
+    return new_width * 2, 1
+
+
+def ascii_size(size, max_width=None, min_width=24, limit=ASCII_MESSAGE_LIMIT, max_messages=3):
+    """
+    Подбирает размер ASCII-арта в символах под пропорции изображения и лимит сообщения.
+
+    Наибольшая ширина выводится из лимита сообщения и пропорций: берется самая широкая
+    строка, при которой арт (ширина + перевод строки, умноженные на высоту) помещается
+    в одно сообщение. Горизонтальные фото получаются шире, а панорама из нескольких строк
+    может занять почти все сообщение. Если даже при min_width арт выше одного сообщения
+    (очень вытянутое по высоте изображение), он займет несколько сообщений, но не больше
+    max_messages: лишнее сжимается по высоте.
+
+    :param size: Размер изображения (ширина, высота) в пикселях.
+    :param max_width: Дополнительное ограничение ширины (символов в строке), например чтобы
+        строки не переносились в клиенте; None — только лимит сообщения.
+    :param min_width: Наименьшая ширина арта.
+    :param limit: Сколько символов помещается в одно сообщение.
+    :param max_messages: На сколько сообщений можно разбить арт.
+    :return: Размер арта (ширина, высота) в символах.
+    """
+    aspect = size[1] / size[0] * ASCII_CHAR_ASPECT
+    # Арт в одну строку занимает width + 1 символ, поэтому шире limit - 1 он не бывает
+    widest = limit - 1 if max_width is None else min(max_width, limit - 1)
+    for width in range(widest, min_width - 1, -1):
+        height = max(int(width * aspect), 1)
+        if (width + 1) * height <= limit:
+            return width, height
+    width = min(min_width, widest)
+    return width, min(max(int(width * aspect), 1), limit // (width + 1) * max_messages)
+
+
+def image_to_ascii(image_stream, new_width=None, ascii_chars=ASCII_CHARS, new_height=None):
+    """
+    Преобразует изображение в ASCII-арт.
+
+    :param image_stream: Поток байтов изображения или уже открытое изображение (PIL.Image).
+    :param new_width: Ширина ASCII-арта (количество символов в строке);
+        None — подобрать по пропорциям изображения (см. ascii_size).
+    :param ascii_chars: Набор символов для создания ASCII-арта.
+    :param new_height: Высота ASCII-арта в строках; None — по пропорциям изображения.
+    :return: Строка, содержащая ASCII-арт; длинный арт вызывающий код разбивает на сообщения по строкам.
+    """
+    # Переводим в оттенки серого
+    if isinstance(image_stream, Image.Image):
+        image = image_stream.convert('L')
+    else:
+        image = Image.open(image_stream).convert('L')
+
+    # меняем размер сохраняя отношение сторон
+    if new_width is None:
+        new_width, new_height = ascii_size(image.size)
+    elif new_height is None:
+        new_height = max(int(image.height / image.width * new_width * ASCII_CHAR_ASPECT), 1)
+    img_resized = image.resize((new_width, new_height))
+
+    # Переводим пиксели в символы и склеиваем строки за один проход
+    return "".join(row + "\n" for row in _ascii_rows(np.asarray(img_resized), ascii_chars))
+
+
+def image_to_ascii_image(image_stream, new_width=100, ascii_chars=ASCII_CHARS):
+    """
+    Рисует ASCII-арт картинкой: черные символы моноширинным шрифтом на белом фоне.
+
+    Символы не рисуются по одному: каждый глиф набора рисуется один раз (см. _glyph_atlas),
+    а картинка собирается из готовых глифов целиком в numpy.
+
+    :param image_stream: Поток байтов изображения или уже открытое изображение (PIL.Image).
+    :param new_width: Ширина арта в символах.
+    :param ascii_chars: Набор символов, от самого темного к самому светлому.
+    :return: Изображение в оттенках серого (PIL.Image).
+    """
+    if isinstance(image_stream, Image.Image):
+        image = image_stream.convert('L')
+    else:
+        image = Image.open(image_stream).convert('L')
+
+    atlas = _glyph_atlas(ascii_chars)
+    cell_height, cell_width = atlas.shape[1:]
+    # Пропорции сохраняются точно: высота в символах учитывает реальный размер ячейки шрифта
+    new_height = max(int(image.height / image.width * new_width * cell_width / cell_height), 1)
+    pixels = np.asarray(image.resize((new_width, new_height)), dtype=np.intp)
+    glyphs = atlas[pixels * len(ascii_chars) // 256]  # (строки, столбцы, высота ячейки, ширина ячейки)
+    ink = glyphs.transpose(0, 2, 1, 3).reshape(new_height * cell_height, new_width * cell_width)
+    return Image.fromarray(255 - ink)
+
+
+@functools.lru_cache(maxsize=256)
+def sort_ascii_chars(ascii_chars):
+    """
+    Упорядочивает пользовательский набор символов от самого «плотного» к самому светлому.
+
+    Плотность — доля закрашенных пикселей глифа в моноширинном шрифте; повторы и
+    непечатаемые символы отбрасываются. Результат запоминается для каждого набора.
+
+    :param ascii_chars: Набор символов в любом порядке.
+    :return: Набор символов, готовый для image_to_ascii; ASCII_CHARS, если печатаемых символов нет.
+    """
+    chars = "".join(char for char in dict.fromkeys(ascii_chars) if char.isprintable())
+    if not chars:
+        return ASCII_CHARS
+    density = _glyph_atlas(chars).mean(axis=(1, 2))
+    return "".join(chars[i] for i in sorted(range(len(chars)), key=lambda i: -density[i]))
+
+
+@functools.lru_cache(maxsize=None)
+def _ascii_font():
+    try:
+        return ImageFont.truetype(ASCII_FONT, ASCII_FONT_SIZE)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=64)
+def _glyph_atlas(ascii_chars):
+    # Глифы набора в ячейках одного размера: массив (символ, высота, ширина) с покрытием 0..255.
+    # Ячейка — по самому широкому символу, поэтому сетка моноширинная для любого шрифта.
+    font = _ascii_font()
+    cell_width = max(1, math.ceil(max(font.getlength(char) for char in ascii_chars + "M")))
+    if hasattr(font, "getmetrics"):
+        cell_height = sum(font.getmetrics())
+    else:
+        cell_height = font.getbbox("Ag")[3]
+    atlas = np.zeros((len(ascii_chars), cell_height, cell_width), dtype=np.uint8)
+    for i, char in enumerate(ascii_chars):
+        glyph = Image.new("L", (cell_width, cell_height))
+        ImageDraw.Draw(glyph).text((0, 0), char, fill=255, font=font)
+        atlas[i] = np.asarray(glyph)
+    return atlas
+
+
+def pixels_to_ascii(image, ascii_chars):
+    """
+    Преобразует пиксели изображения в символы ASCII.
+
+    :param image: Изображение в оттенках серого (PIL.Image).
+    :param ascii_chars: Набор символов для преобразования.
+    :return: Строка символов, представляющая изображение.
+    """
+    return "".join(_ascii_rows(np.asarray(image), ascii_chars))
+
+
+@functools.lru_cache(maxsize=64)
+def _ascii_lut(ascii_chars):
+    # Таблица на все 256 уровней яркости: тот же символ, что ascii_chars[pixel * len(ascii_chars) // 256]
+    return np.array([ascii_chars[pixel * len(ascii_chars) // 256] for pixel in range(256)])
+
+
+def _ascii_rows(pixels, ascii_chars):
+    # pixels — массив яркостей (высота, ширина); каждая строка массива символов
+    # просматривается как одна строка numpy шириной в изображение
+    if pixels.size == 0:
+        return []
+    characters = _ascii_lut(ascii_chars)[pixels]
+    return characters.view(f"<U{pixels.shape[1]}").ravel().tolist()
+
+
+# Огрубляем изображение
+def pixelate_image(image, pixel_size, source_size=None):
+    """
+    Огрубляет изображение, создавая эффект пикселизации.
+
+    :param image: Исходное изображение (PIL.Image).
+    :param pixel_size: Размер пикселя для огрубления.
+    :param source_size: Полный размер фотографии, если image декодировано в уменьшенном
+        разрешении; результат все равно получается в полном размере.
+    :return: Пикселизированное изображение (PIL.Image).
+    """
+    width, height = source_size or image.size
+    image = image.resize(
+        (max(width // pixel_size, 1), max(height // pixel_size, 1)),
+        Image.NEAREST
+    )
+    image = image.resize(
+        (image.size[0] * pixel_size, image.size[1] * pixel_size),
+        Image.NEAREST
+    )
+    return image
+
+
+def pixelate_source_size(size, pixel_size):
+    """
+    Возвращает разрешение, которого достаточно для пикселизации: по точке на каждый блок.
+
+    :param size: Полный размер фотографии (ширина, высота).
+    :param pixel_size: Размер пикселя для огрубления.
+    :return: Размер (ширина, высота); не меньше одной точки по каждой стороне.
+    """
+    return max(size[0] // pixel_size, 1), max(size[1] // pixel_size, 1)
+
+
+def invert_colors(image):
+    """
+    Инвертирует цвета изображения.
+
+    Каналы инвертируются одной таблицей (Image.point) без разделения на отдельные
+    изображения, прозрачность сохраняется. У изображений с палитрой инвертируется
+    только палитра. Остальные режимы (CMYK, 16-битные и т.п.) сначала переводятся в RGB или L.
+
+    :param image: Исходное изображение (PIL.Image).
+    :return: Изображение с инвертированными цветами (PIL.Image).
+    """
+    if image.mode == 'P':
+        inverted = image.copy()
+        inverted.putpalette([255 - value for value in image.getpalette()])
+        return inverted
+    if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        if 'A' in image.getbands() or 'transparency' in image.info:
+            image = image.convert('RGBA')
+        else:
+            image = image.convert('L' if len(image.getbands()) == 1 else 'RGB')
+    # Таблица на все каналы подряд: цветовые инвертируются, альфа-канал остается как есть
+    lut = []
+    for band in image.getbands():
+        lut += _IDENTITY_LUT if band == 'A' else _INVERT_LUT
+    return image.point(lut)
+
+
+def mirror_image(image, direction="horizontal"):
+    """
+    Создает отражение изображения.
+
+    :param image: Исходное изображение (PIL.Image).
+    :param direction: Направление: 'horizontal' или 'vertical'.
+    :return: Отраженное изображение (PIL.Image).
+    """
+    if direction == "horizontal":
+        return image.transpose(Image.FLIP_LEFT_RIGHT)
+    elif direction == "vertical":
+        return image.transpose(Image.FLIP_TOP_BOTTOM)
+    else:
+        raise ValueError("Invalid direction! Use 'horizontal' or 'vertical'.")
+
+
+def gradient(*colors):
+    """
+    Описывает градиент из равномерно расположенных цветов.
+
+    :param colors: Цвета от темных областей к светлым: названия или "#rrggbb" (см. PIL.ImageColor).
+    :return: Список пар (позиция от 0 до 1, цвет) для build_colormap.
+    """
+    return [(i / (len(colors) - 1), color) for i, color in enumerate(colors)]
+
+
+def build_colormap(stops):
+    """
+    Строит палитру из 256 цветов линейной интерполяцией между опорными цветами.
+
+    :param stops: Список пар (позиция от 0 до 1, цвет) по возрастанию позиции.
+    :return: Палитра для Image.putpalette: 768 чисел R, G, B.
+    """
+    positions = [position for position, _ in stops]
+    colors = np.array([ImageColor.getrgb(color)[:3] for _, color in stops], dtype=float)
+    levels = np.linspace(0, 1, 256)
+    channels = [np.interp(levels, positions, colors[:, i]) for i in range(3)]
+    return np.rint(np.stack(channels, axis=1)).astype(np.uint8).ravel().tolist()
+
+
+# Опорные цвета палитр тепловой карты, от холодных (темных) областей к теплым (светлым)
+COLORMAP_STOPS = {
+    "heatmap": gradient("blue", "red"),
+    "jet": [(0, "#00007f"), (0.125, "#0000ff"), (0.375, "#00ffff"), (0.625, "#ffff00"), (0.875, "#ff0000"),
+            (1, "#7f0000")],
+    "viridis": gradient("#440154", "#482878", "#3e4a89", "#31688e", "#26828e", "#1f9e89", "#35b779",
+                        "#6dcd59", "#b4de2c", "#fde725"),
+    "inferno": gradient("#000004", "#1b0c41", "#4a0c6b", "#781c6d", "#a52c60", "#cf4446", "#ed6925",
+                        "#fb9b06", "#f7d13d", "#fcffa4"),
+    "fire": gradient("black", "red", "yellow"),
+    "ocean": gradient("navy", "aquamarine"),
+}
+
+# Палитры строятся один раз при импорте, применение палитры к изображению — один проход по пикселям
+COLORMAPS = {name: build_colormap(stops) for name, stops in COLORMAP_STOPS.items()}
+
+
+def apply_colormap(image, colormap="heatmap"):
+    """
+    Раскрашивает изображение палитрой по яркости пикселей.
+
+    :param image: Исходное изображение (PIL.Image).
+    :param colormap: Название палитры из COLORMAPS.
+    :return: Раскрашенное изображение в режиме RGB (PIL.Image).
+    """
+    # Яркость используется как номер цвета в палитре: режим L становится режимом P
+    indexed = image.convert("L")
+    indexed.putpalette(COLORMAPS[colormap])
+    return indexed.convert("RGB")
+
+
+def convert_to_heatmap(image):
+    """
+    Преобразовывает изображение в тепловую карту: от синего (холодные области) до красного (теплые).
+
+    :param image: Исходное изображение (PIL.Image).
+    :return: Изображение в виде тепловой карты (PIL.Image).
+    """
+    return apply_colormap(image, "heatmap")
+
+
+def resize_for_sticker(image, max_size=512):
+    """
+    Изменяет размер изображения до максимально допустимого размера для стикеров Telegram.
+
+    :param image: Исходное изображение (PIL.Image).
+    :param max_size: Максимальная длина одной из сторон (по умолчанию 512 пикселей).
+    :return: Изображение подходящего размера (PIL.Image).
+    """
+    new_size = sticker_size(image.size, max_size)
+    if new_size != image.size:
+        # Меняем размер изображения
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+    return image
+
+
+def sticker_size(size, max_size=512):
+    """
+    Вычисляет размер стикера: длинная сторона не больше max_size, пропорции сохраняются.
+
+    :param size: Текущий размер изображения (ширина, высота).
+    :param max_size: Максимальная длина одной из сторон.
+    :return: Размер (ширина, высота).
+    """
+    width, height = size
+
+    # Пропорциональное изменение сторон
+    if width > max_size or height > max_size:
+        if width > height:
+            new_width = max_size
+            new_height = int((height / width) * new_width)
+        else:
+            new_height = max_size
+            new_width = int((width / height) * new_height)
+        return new_width, new_height
+    return width, height
+
+
+def apply_pipeline(image, transforms):
+    """
+    Последовательно применяет несколько преобразований к одному изображению.
+
+    :param image: Исходное изображение (PIL.Image).
+    :param transforms: Последовательность функций, принимающих и возвращающих изображение.
+    :return: Результат последнего преобразования (PIL.Image).
+    """
+    for transform in transforms:
+        image = transform(image)
+    return image
+
+
+def encode_image(image, image_format="JPEG", options=None):
+    """
+    Сохраняет изображение в байты указанного формата.
+
+    Изображения с прозрачностью или палитрой перед сохранением в JPEG переводятся в RGB.
+
+    :param image: Изображение (PIL.Image).
+    :param image_format: Формат файла, например "JPEG" или "PNG".
+    :param options: Настройки кодировщика (параметры Image.save), например PHOTO_JPEG_OPTIONS.
+    :return: Байты закодированного изображения.
+    """
+    if image_format == "JPEG" and image.mode not in JPEG_MODES:
+        image = image.convert("RGB")
+    output_stream = io.BytesIO()
+    image.save(output_stream, format=image_format, **(options or {}))
+    return output_stream.getvalue()
+
+
+def mirror_jpeg(data, direction="horizontal", max_pixels=None):
+    """
+    Отражает JPEG, не перекодируя его заново.
+
+    Если установлен jpegtran, отражение выполняется над коэффициентами DCT без потерь
+    и без декодирования пикселей. Если jpegtran нет или размер изображения не кратен
+    блоку (тогда отражение без потерь невозможно), пиксели отражаются и сохраняются
+    с таблицами квантования и прореживанием цвета исходника, чтобы повторное сжатие
+    почти не добавляло потерь. Память для такого декодирования вызывающий код резервирует
+    заранее (ImageGuard.reserve_decoding): в пуле процессов общий лимит недоступен.
+
+    :param data: Байты исходного изображения.
+    :param direction: Направление: 'horizontal' или 'vertical'.
+    :param max_pixels: Наибольшее количество пикселей, которое можно декодировать (None — без ограничения).
+    :return: EncodedImage или None, если это не JPEG или он больше max_pixels; тогда нужна обычная обработка.
+    """
+    started = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    if image.format != "JPEG" or (max_pixels and image.width * image.height > max_pixels):
+        return None
+    if direction not in ("horizontal", "vertical"):
+        raise ValueError("Invalid direction! Use 'horizontal' or 'vertical'.")
+
+    if JPEGTRAN:
+        try:
+            result = subprocess.run([JPEGTRAN, "-flip", direction, "-perfect", "-copy", "none", "-optimize"],
+                                    input=data, capture_output=True, timeout=JPEGTRAN_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            result = None
+        if result is not None and result.returncode == 0 and result.stdout:
+            return EncodedImage(result.stdout, image.size, time.perf_counter() - started, 0.0)
+
+    options = {'qtables': image.quantization, 'subsampling': JpegImagePlugin.get_sampling(image), 'optimize': True}
+    mirrored = mirror_image(image, direction)
+    transformed = time.perf_counter()
+    encoded = encode_image(mirrored, "JPEG", options)
+    return EncodedImage(encoded, mirrored.size, transformed - started, time.perf_counter() - transformed)
+
+
+def preview_image(image, transform, max_side):
+    """
+    Применяет преобразование и уменьшает результат для превью.
+
+    :param image: Исходное изображение (PIL.Image), обычно маленький вариант фото.
+    :param transform: Функция, принимающая и возвращающая изображение (PIL.Image).
+    :param max_side: Наибольшая сторона превью в пикселях.
+    :return: Превью (PIL.Image).
+    """
+    result = transform(image)
+    scale = max_side / max(result.size)
+    if scale < 1:
+        # Например, пикселизация возвращает результат в полном размере фото
+        result = result.resize((max(1, round(result.width * scale)), max(1, round(result.height * scale))),
+                               Image.BILINEAR, reducing_gap=2.0)
+    return result
+
+
+def transform_and_encode(transform, image, image_format="JPEG", options=None):
+    """
+    Применяет преобразование и кодирует результат.
+
+    Вся CPU-нагрузка обработчика собрана в одной функции, чтобы ее можно было
+    выполнить в пуле процессов: transform должна быть функцией уровня модуля
+    (или functools.partial от нее), иначе ее не получится передать в процесс.
+    Время преобразования и кодирования измеряется здесь же и возвращается вместе
+    с результатом, потому что в процессе-обработчике метрики бота недоступны.
+
+    :param transform: Функция, принимающая и возвращающая изображение (PIL.Image).
+    :param image: Исходное изображение (PIL.Image).
+    :param image_format: Формат, в котором сохраняется результат.
+    :param options: Настройки кодировщика (см. encode_image).
+    :return: EncodedImage с байтами закодированного результата.
+    """
+    started = time.perf_counter()
+    result = transform(image)
+    transformed = time.perf_counter()
+    data = encode_image(result, image_format, options)
+    return EncodedImage(data, result.size, transformed - started, time.perf_counter() - transformed)
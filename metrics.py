@@ -0,0 +1,391 @@
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(9))  # от 1 КБ до 64 МБ
+PIXELS_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+# Описание метрик: имя -> (тип, описание, корзины гистограммы)
+DEFINITIONS = {
+    "bot_requests_total": ("counter", "Обработанные запросы по операциям.", None),
+    "bot_errors_total": ("counter", "Запросы, завершившиеся исключением, по операциям и типам ошибок.", None),
+    "bot_slow_requests_total": ("counter", "Запросы дольше порога медленного запроса.", None),
+    "bot_request_seconds": ("histogram", "Полное время обработки запроса.", SECONDS_BUCKETS),
+    "bot_stage_seconds": ("histogram", "Время этапов обработки: get_file, download, decode, transform, "
+                                       "encode, send.", SECONDS_BUCKETS),
+    "bot_queue_wait_seconds": ("histogram", "Время ожидания задачи в очереди до начала обработки.",
+                               SECONDS_BUCKETS),
+    "bot_bytes_total": ("counter", "Байты, скачанные из Telegram (in) и загруженные в Telegram (out).", None),
+    "bot_transfer_bytes": ("histogram", "Размер одного скачанного или загруженного файла.", BYTES_BUCKETS),
+    "bot_image_width_pixels": ("histogram", "Ширина исходных (input) и готовых (output) изображений.",
+                               PIXELS_BUCKETS),
+    "bot_image_height_pixels": ("histogram", "Высота исходных (input) и готовых (output) изображений.",
+                                PIXELS_BUCKETS),
+    "bot_webhook_updates_total": ("counter", "Обновления webhook: accepted, duplicate, forwarded, rejected.",
+                                  None),
+    "bot_api_wait_seconds": ("histogram", "Ожидание лимита частоты Telegram перед отправкой, по методам Bot API.",
+                             SECONDS_BUCKETS),
+    "bot_api_retries_total": ("counter", "Повторы запросов к Bot API: flood (429), server (5xx), connection.", None),
+}
+
+# Операция, которую сейчас обрабатывает поток или задача asyncio; ею помечаются этапы
+current_operation = contextvars.ContextVar("current_operation", default="unknown")
+
+
+class Metrics:
+    """
+    Метрики бота в формате Prometheus.
+
+    Обработчики оборачиваются декоратором track, а этапы внутри них — контекстным
+    менеджером stage; операция, к которой относится этап, берется из контекста
+    выполнения, поэтому общие функции (скачивание, отправка) не нужно параметризовать.
+    Метрики отдаются по HTTP (см. serve) в текстовом формате Prometheus.
+    """
+
+    def __init__(self, slow_request_seconds=None, profiler=None):
+        """
+        :param slow_request_seconds: Порог медленного запроса в секундах (None — не отслеживать).
+        :param profiler: SamplingProfiler для записи стеков медленных запросов (None — без профилирования).
+        """
+        self.slow_request_seconds = slow_request_seconds
+        self.profiler = profiler
+        self._counters = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счетчики корзин, сумма, количество]
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Увеличивает счетчик.
+
+        :param name: Имя метрики из DEFINITIONS.
+        :param value: Приращение.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Добавляет наблюдение в гистограмму.
+
+        :param name: Имя метрики из DEFINITIONS.
+        :param value: Наблюдаемое значение.
+        """
+        buckets = DEFINITIONS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def observe_stage(self, stage, seconds):
+        """
+        Записывает время этапа текущей операции, измеренное в другом месте (например, в пуле процессов).
+
+        :param stage: Название этапа.
+        :param seconds: Длительность в секундах.
+        """
+        self.observe("bot_stage_seconds", seconds, operation=current_operation.get(), stage=stage)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Измеряет время этапа текущей операции.
+
+        :param stage: Название этапа, например "download" или "send".
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def transfer(self, direction, size):
+        """
+        Учитывает скачанный (in) или загруженный (out) файл текущей операции.
+
+        :param direction: "in" или "out".
+        :param size: Размер в байтах.
+        """
+        operation = current_operation.get()
+        self.inc("bot_bytes_total", size, operation=operation, direction=direction)
+        self.observe("bot_transfer_bytes", size, operation=operation, direction=direction)
+
+    def image(self, kind, size):
+        """
+        Учитывает размеры изображения текущей операции.
+
+        :param kind: "input" для исходного изображения или "output" для результата.
+        :param size: Размер (ширина, высота).
+        """
+        operation = current_operation.get()
+        self.observe("bot_image_width_pixels", size[0], operation=operation, kind=kind)
+        self.observe("bot_image_height_pixels", size[1], operation=operation, kind=kind)
+
+    def queue_wait(self, seconds):
+        """
+        Учитывает время ожидания задачи в очереди.
+
+        :param seconds: Длительность в секундах.
+        """
+        self.observe("bot_queue_wait_seconds", seconds)
+
+    def api_wait(self, method, seconds):
+        """
+        Учитывает время ожидания лимита частоты перед запросом к Bot API.
+
+        :param method: Метод Bot API, например "sendPhoto".
+        :param seconds: Длительность в секундах.
+        """
+        self.observe("bot_api_wait_seconds", seconds, method=method)
+
+    def api_retry(self, method, reason):
+        """
+        Учитывает повтор запроса к Bot API.
+
+        :param method: Метод Bot API.
+        :param reason: "flood", "server" или "connection".
+        """
+        self.inc("bot_api_retries_total", method=method, reason=reason)
+
+    def add_collector(self, collector):
+        """
+        Добавляет источник текущих значений (gauge), который опрашивается при каждом чтении метрик.
+
+        :param collector: Функция без аргументов, возвращающая словарь {имя метрики: число}.
+        """
+        self._collectors.append(collector)
+
+    @contextlib.contextmanager
+    def request(self, operation, profile=True):
+        """
+        Учитывает обработку одного запроса: количество, ошибки и полное время.
+
+        Этапы, измеренные внутри блока, помечаются этой операцией. Медленные запросы
+        записываются в лог, при включенном профилировщике — вместе с самыми частыми
+        стеками вызовов.
+
+        :param operation: Название операции для меток метрик.
+        :param profile: Снимать ли стеки текущего потока; в asyncio поток общий для всех
+            задач, поэтому там стеки не показательны.
+        """
+        token = current_operation.set(operation)
+        sampling = self.profiler.start() if self.profiler and profile else None
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc("bot_errors_total", operation=operation, error=type(e).__name__)
+            raise
+        finally:
+            stacks = self.profiler.stop(sampling) if sampling is not None else None
+            self._finish(operation, time.perf_counter() - started, stacks)
+            current_operation.reset(token)
+
+    def track(self, operation):
+        """
+        Декоратор обработчика (синхронного или асинхронного), см. request.
+
+        :param operation: Название операции для меток метрик.
+        """
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.request(operation, profile=False):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.request(operation):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish(self, operation, seconds, stacks):
+        self.inc("bot_requests_total", operation=operation)
+        self.observe("bot_request_seconds", seconds, operation=operation)
+        if self.slow_request_seconds is None or seconds < self.slow_request_seconds:
+            return
+        self.inc("bot_slow_requests_total", operation=operation)
+        if stacks:
+            report = "\n".join(f"{count} samples:\n  " + "\n  ".join(stack)
+                               for stack, count in stacks.most_common(self.profiler.max_stacks))
+            logger.warning("Медленный запрос %s: %.2f с. Самые частые стеки:\n%s", operation, seconds, report)
+        else:
+            logger.warning("Медленный запрос %s: %.2f с", operation, seconds)
+
+    def render(self):
+        """
+        Возвращает все метрики в текстовом формате Prometheus.
+
+        :return: Строка для ответа на запрос /metrics.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in DEFINITIONS.items():
+            samples = counters if kind == "counter" else histograms
+            keys = sorted(key for key in samples if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(samples[key])}")
+                    continue
+                bucket_counts, total, count = samples[key]
+                for bound, bucket_count in zip(buckets, bucket_counts):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} "
+                                 f"{bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for collector in self._collectors:
+            for name, value in collector().items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host="127.0.0.1", port=9108):
+        """
+        Запускает HTTP-сервер метрик в фоновом потоке: GET /metrics.
+
+        :param host: Адрес, на котором слушать; по умолчанию только локальные подключения.
+        :param port: Порт.
+        :return: Запущенный сервер (ThreadingHTTPServer).
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+
+class SamplingProfiler:
+    """
+    Выборочный профилировщик обработчиков.
+
+    Пока обработчик выполняется, фоновый поток каждые interval секунд снимает стек
+    его потока через sys._current_frames. Накладные расходы не зависят от глубины
+    вызовов и малы при интервале в несколько миллисекунд, поэтому профилировщик можно
+    держать включенным в проде; стеки попадают в лог только для медленных запросов.
+    """
+
+    def __init__(self, interval=0.01, depth=20, max_stacks=5):
+        """
+        :param interval: Интервал между выборками в секундах.
+        :param depth: Сколько верхних кадров стека сохранять.
+        :param max_stacks: Сколько самых частых стеков выводить в лог.
+        """
+        self.interval = interval
+        self.depth = depth
+        self.max_stacks = max_stacks
+        self._active = {}  # идентификатор потока -> Counter стеков
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """
+        Начинает собирать стеки текущего потока.
+
+        :return: Объект для передачи в stop или None, если стеки потока уже собираются
+            (вложенный запрос учитывается во внешнем).
+        """
+        samples = Counter()
+        with self._condition:
+            if threading.get_ident() in self._active:
+                return None
+            self._active[threading.get_ident()] = samples
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return samples
+
+    def stop(self, samples):
+        """
+        Заканчивает сбор стеков текущего потока.
+
+        :param samples: Значение, которое вернул start.
+        :return: Counter стеков (кортежей строк "файл:строка функция").
+        """
+        with self._condition:
+            self._active.pop(threading.get_ident(), None)
+        return samples
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._active:
+                    self._condition.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._condition:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[self._stack(frame)] += 1
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.depth:
+            code = frame.f_code
+            stack.append(f"{code.co_filename}:{frame.f_lineno} {code.co_name}")
+            frame = frame.f_back
+        return tuple(stack)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,565 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Методы, которые Telegram считает отправкой сообщений и ограничивает по частоте
+LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+# Приоритеты запросов: меньше — раньше получает место в общем лимите
+PRIORITY_TEXT = 0
+PRIORITY_UPLOAD = 1
+
+
+class TokenBucket:
+    """
+    Ограничение частоты «ведро токенов»: rate токенов в секунду, не больше capacity подряд.
+
+    Потокобезопасность обеспечивает вызывающий код (планировщик держит общую блокировку).
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: Сколько токенов добавляется в секунду.
+        :param capacity: Сколько токенов можно накопить (размер всплеска).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def delay(self, now):
+        """
+        :param now: Текущее время (time.monotonic).
+        :return: Через сколько секунд появится токен (0, если он есть сейчас).
+        """
+        self._refill(now)
+        wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+        return max(wait, self._blocked_until - now)
+
+    def take(self, now):
+        """
+        Забирает один токен; перед этим нужно убедиться, что delay вернул 0.
+
+        :param now: Текущее время (time.monotonic).
+        """
+        self._refill(now)
+        self._tokens -= 1
+
+    def block(self, until):
+        """
+        Не выдает токены до указанного момента (ответ Telegram с retry_after) и сбрасывает накопленные,
+        чтобы после паузы запросы не ушли всплеском.
+
+        :param until: Момент времени (time.monotonic).
+        """
+        self._blocked_until = max(self._blocked_until, until)
+        self._tokens = 0
+        self._updated = max(self._updated, until)
+
+    def idle(self, now):
+        """
+        :return: True, если ведро полное и не заблокировано, то есть его можно удалить без потери состояния.
+        """
+        self._refill(now)
+        return self._tokens >= self.capacity and self._blocked_until <= now
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+
+class _FloodLimits:
+    """
+    Лимиты Telegram и очередь запросов к общему лимиту — общая часть синхронного и асинхронного планировщиков.
+
+    Сам класс не ждет и не блокирует: планировщик вызывает его методы под своей блокировкой
+    (threading.Condition или asyncio.Condition) и ждет столько, сколько вернул advance.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst, group_rate, group_burst, max_chats):
+        # Общий лимит без всплесков: сообщения уходят равномерно, как рекомендует Telegram
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_chats = max_chats
+        self.chats = {}  # chat_id -> TokenBucket
+        self.ready = []  # отсортированные (приоритет, номер) запросов, которые ждут только общий лимит
+        self.waiting = 0
+        self.retries = 0
+        self.coalesced = 0
+        self._sequence = itertools.count()
+
+    def ticket(self, priority):
+        """
+        :return: Место запроса в очереди к общему лимиту: (приоритет, номер).
+        """
+        return priority, next(self._sequence)
+
+    def advance(self, ticket, bucket, now, notify):
+        """
+        Один шаг ожидания лимитов. Сначала запрос ждет лимит своего чата, затем — очередь к общему
+        лимиту в порядке приоритета. Ожидание лимита чата не держит общую очередь: другие чаты
+        тем временем отправляют свое.
+
+        :param ticket: Место запроса (см. ticket).
+        :param bucket: Лимит чата или None.
+        :param now: Текущее время (time.monotonic).
+        :param notify: Функция, которая будит остальные запросы, когда меняется очередь.
+        :return: 0, если токены выданы; иначе сколько секунд ждать (None — до вызова notify).
+        """
+        index = bisect.bisect_left(self.ready, ticket)
+        ready = index < len(self.ready) and self.ready[index] == ticket
+        chat_wait = bucket.delay(now) if bucket else 0
+        if chat_wait > 0:
+            if ready:
+                del self.ready[index]
+                notify()
+            return chat_wait
+        if not ready:
+            self.ready.insert(index, ticket)
+            notify()
+        global_wait = self.global_bucket.delay(now)
+        if self.ready[0] == ticket and global_wait <= 0:
+            self.global_bucket.take(now)
+            if bucket:
+                bucket.take(now)
+            del self.ready[0]
+            notify()
+            return 0
+        return global_wait if global_wait > 0 else None
+
+    def leave(self, ticket, notify):
+        """
+        Убирает запрос из очереди к общему лимиту, если он еще там (ожидание прервано).
+        """
+        index = bisect.bisect_left(self.ready, ticket)
+        if index < len(self.ready) and self.ready[index] == ticket:
+            del self.ready[index]
+            notify()
+
+    def chat_bucket(self, chat_id, now):
+        """
+        :return: Лимит чата (создается при первом запросе) или None для запросов без чата.
+        """
+        if chat_id is None:
+            return None
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                self.chats = {key: value for key, value in self.chats.items() if not value.idle(now)}
+            if _is_group(chat_id):
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    def block(self, chat_id, seconds):
+        """
+        Приостанавливает чат или, если чата нет, весь бот (ответ 429 с retry_after).
+        """
+        now = time.monotonic()
+        (self.chat_bucket(chat_id, now) or self.global_bucket).block(now + seconds)
+
+    def stats(self):
+        return {'waiting': self.waiting, 'chats': len(self.chats), 'retries': self.retries,
+                'coalesced': self.coalesced}
+
+
+class OutboundScheduler:
+    """
+    Планировщик исходящих запросов к Bot API с учетом ограничений Telegram.
+
+    Устанавливается как apihelper.CUSTOM_REQUEST_SENDER (см. install) и пропускает через себя
+    все запросы синхронного telebot:
+    - отправка сообщений ограничена общим лимитом бота и лимитом каждого чата (для групп — строже);
+      запрос ждет своей очереди, а не получает ошибку 429;
+    - когда лимит исчерпан, место в общем лимите первыми получают короткие текстовые запросы,
+      а загрузки файлов ждут;
+    - answerCallbackQuery не занимает лимит сообщений, а повторный ответ на тот же callback
+      не отправляется: возвращается результат первого;
+    - на ответ 429 отправка сообщения повторяется после retry_after (на это время приостанавливается
+      чат или, если чата нет, весь бот); остальные запросы, например answerCallbackQuery из потока,
+      который разбирает обновления, получают ответ 429 сразу, а отправка сообщений всего бота
+      приостанавливается на retry_after;
+    - на ошибки сервера и соединения запрос повторяется с экспоненциальной задержкой;
+      отправка сообщений повторяется, только если соединение не удалось установить: оборванное
+      соединение могло оборваться уже после того, как Telegram принял сообщение, и повтор создал бы дубль.
+
+    Ожидание лимита блокирует вызывающий поток, поэтому сообщения нужно отправлять из потоков задач
+    (в bot.py — через очередь чата), а не из потока, который разбирает обновления: иначе один чат,
+    исчерпавший свой лимит, задержит обновления всех остальных.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=3,
+                 max_retries=5, max_retry_after=30, backoff=0.5, max_chats=10000, on_wait=None, on_retry=None):
+        """
+        :param global_rate: Сообщений в секунду для всего бота.
+        :param chat_rate: Сообщений в секунду в один личный чат.
+        :param chat_burst: Сколько сообщений подряд можно отправить в личный чат без паузы.
+        :param group_rate: Сообщений в секунду в одну группу или канал.
+        :param group_burst: Сколько сообщений подряд можно отправить в группу без паузы.
+        :param max_retries: Сколько раз повторять запрос после 429, ошибки сервера или соединения.
+        :param max_retry_after: Если Telegram просит ждать дольше (секунд), ошибка возвращается сразу.
+        :param backoff: Первая задержка перед повтором после ошибки сервера или соединения, секунд.
+        :param max_chats: Сколько лимитов чатов хранить; неактивные лимиты удаляются сверх этого числа.
+        :param on_wait: Функция (метод, секунды), получающая время ожидания лимита каждым запросом.
+        :param on_retry: Функция (метод, причина), вызываемая при каждом повторе:
+            причина "flood" (429), "server" (5xx) или "connection".
+        """
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.backoff = backoff
+        self.max_chats = max_chats
+        self.on_wait = on_wait
+        self.on_retry = on_retry
+        self._limits = _FloodLimits(global_rate, chat_rate, chat_burst, group_rate, group_burst, max_chats)
+        self._condition = threading.Condition()
+        self._answers = OrderedDict()  # callback_query_id -> Future ответа
+        self._answers_lock = threading.Lock()
+
+    def install(self):
+        """
+        Направляет все запросы синхронного telebot через этот планировщик.
+        """
+        from telebot import apihelper
+
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+
+    def set_global_rate(self, rate):
+        """
+        Меняет общий лимит, например когда бот работает в нескольких процессах и делит лимит между ними.
+
+        :param rate: Сообщений в секунду.
+        """
+        with self._condition:
+            self._limits.global_bucket = TokenBucket(rate, 1)
+
+    def send(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """
+        Выполняет HTTP-запрос к Bot API (сигнатура apihelper.CUSTOM_REQUEST_SENDER).
+
+        :param method: HTTP-метод.
+        :param url: Адрес метода Bot API.
+        :param params: Параметры запроса.
+        :param files: Загружаемые файлы.
+        :param timeout: Таймаут requests (соединение, чтение).
+        :param proxies: Прокси requests.
+        :return: requests.Response.
+        """
+        api_method = urlsplit(url).path.rsplit("/", 1)[-1]
+        request = (method, url, params, files, timeout, proxies)
+        if api_method == "answerCallbackQuery" and params and "callback_query_id" in params:
+            return self._answer_once(api_method, params["callback_query_id"], request)
+        return self._send(api_method, request)
+
+    def stats(self):
+        """
+        :return: Словарь: запросов, ждущих лимита, отслеживаемых чатов, повторов и объединенных ответов на callback.
+        """
+        with self._condition:
+            return self._limits.stats()
+
+    def _answer_once(self, api_method, query_id, request):
+        with self._answers_lock:
+            future = self._answers.get(query_id)
+            first = future is None
+            if first:
+                future = self._answers[query_id] = Future()
+                while len(self._answers) > self.max_chats:
+                    self._answers.popitem(last=False)
+            else:
+                self._limits.coalesced += 1
+        if not first:
+            return future.result()
+        try:
+            response = self._send(api_method, request)
+        except BaseException as e:
+            future.set_exception(e)
+            with self._answers_lock:
+                self._answers.pop(query_id, None)  # после ошибки соединения следующий ответ можно отправить
+            raise
+        future.set_result(response)
+        return response
+
+    def _send(self, api_method, request):
+        method, url, params, files, timeout, proxies = request
+        limited = api_method.startswith(LIMITED_PREFIXES)
+        chat_id = params.get("chat_id") if params else None
+        priority = PRIORITY_UPLOAD if files else PRIORITY_TEXT
+        attempt = 0
+        while True:
+            if limited:
+                waited = self._acquire(chat_id, priority)
+                if self.on_wait:
+                    self.on_wait(api_method, waited)
+            try:
+                from telebot import apihelper
+
+                response = apihelper._get_req_session().request(
+                    method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.max_retries or (limited and not _connect_failed(e)):
+                    raise
+                delay = _backoff(self.backoff, attempt)
+                reason = "connection"
+            else:
+                if response.status_code == 429:
+                    retry_after = _retry_after(response)
+                    if not limited:
+                        # Не спим retry_after в вызывающем потоке: он может разбирать обновления всех чатов
+                        self._block(None, retry_after)
+                        return response
+                    if attempt >= self.max_retries or retry_after > self.max_retry_after:
+                        return response
+                    self._block(chat_id, retry_after)
+                    delay = 0  # запрос дождется паузы в _acquire
+                    reason = "flood"
+                elif response.status_code >= 500 and attempt < self.max_retries:
+                    delay = _backoff(self.backoff, attempt)
+                    reason = "server"
+                else:
+                    return response
+            attempt += 1
+            with self._condition:
+                self._limits.retries += 1
+            if self.on_retry:
+                self.on_retry(api_method, reason)
+            logger.debug("Повтор %s (%s), попытка %d, через %.2f с", api_method, reason, attempt, delay)
+            if delay:
+                time.sleep(delay)
+            _rewind(files)
+
+    def _acquire(self, chat_id, priority):
+        limits = self._limits
+        ticket = limits.ticket(priority)
+        started = time.monotonic()
+        with self._condition:
+            limits.waiting += 1
+            bucket = limits.chat_bucket(chat_id, started)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = limits.advance(ticket, bucket, now, self._condition.notify_all)
+                    if wait == 0:
+                        return now - started
+                    self._condition.wait(wait)
+            finally:
+                limits.waiting -= 1
+                limits.leave(ticket, self._condition.notify_all)
+
+    def _block(self, chat_id, seconds):
+        with self._condition:
+            self._limits.block(chat_id, seconds)
+            self._condition.notify_all()
+
+
+class AsyncOutboundScheduler:
+    """
+    Планировщик исходящих запросов для асинхронного бота (AsyncTeleBot) с теми же правилами,
+    что у OutboundScheduler: общий лимит и лимиты чатов, текст раньше загрузок, один ответ
+    на callback и повтор после 429.
+
+    Устанавливается оберткой над telebot.asyncio_helper._process_request (см. install) и ждет лимитов,
+    не блокируя цикл событий. Создавать и использовать планировщик нужно в одном цикле событий.
+
+    asyncio_helper превращает любую ошибку соединения в RequestTimeout, не сообщая, успел ли сервер
+    получить запрос, поэтому после нее повторяются только запросы, которые не отправляют сообщения.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=3,
+                 max_retries=5, max_retry_after=30, backoff=0.5, max_chats=10000, on_wait=None, on_retry=None):
+        """
+        Параметры — как у OutboundScheduler.
+        """
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.backoff = backoff
+        self.max_chats = max_chats
+        self.on_wait = on_wait
+        self.on_retry = on_retry
+        self._limits = _FloodLimits(global_rate, chat_rate, chat_burst, group_rate, group_burst, max_chats)
+        self._condition = asyncio.Condition()
+        self._answers = OrderedDict()  # callback_query_id -> asyncio.Future ответа
+        self._process_request = None
+
+    def install(self):
+        """
+        Направляет все запросы асинхронного telebot через этот планировщик.
+        """
+        from telebot import asyncio_helper
+
+        if self._process_request is None:
+            self._process_request = asyncio_helper._process_request
+            asyncio_helper._process_request = self.send
+
+    async def send(self, token, url, method='get', params=None, files=None, **kwargs):
+        """
+        Выполняет запрос к Bot API (сигнатура asyncio_helper._process_request).
+
+        :param token: Токен бота.
+        :param url: Метод Bot API, например "sendMessage".
+        :param method: HTTP-метод.
+        :param params: Параметры запроса.
+        :param files: Загружаемые файлы.
+        :return: Поле result ответа Telegram.
+        """
+        def request():
+            # _process_request забирает из params таймаут, поэтому каждой попытке — своя копия
+            return self._process_request(token, url, method, dict(params) if params else params, files, **kwargs)
+
+        if url == "answerCallbackQuery" and params and "callback_query_id" in params:
+            return await self._answer_once(url, params["callback_query_id"], params, files, request)
+        return await self._send(url, params, files, request)
+
+    def stats(self):
+        """
+        :return: Словарь, как у OutboundScheduler.stats.
+        """
+        return self._limits.stats()
+
+    async def _answer_once(self, api_method, query_id, params, files, request):
+        future = self._answers.get(query_id)
+        if future is not None:
+            self._limits.coalesced += 1
+            return await asyncio.shield(future)
+        future = self._answers[query_id] = asyncio.get_running_loop().create_future()
+        while len(self._answers) > self.max_chats:
+            self._answers.popitem(last=False)
+        try:
+            result = await self._send(api_method, params, files, request)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # ошибку получает вызывающий; повторных ответов может и не быть
+            self._answers.pop(query_id, None)
+            raise
+        future.set_result(result)
+        return result
+
+    async def _send(self, api_method, params, files, request):
+        from telebot import asyncio_helper
+
+        limited = api_method.startswith(LIMITED_PREFIXES)
+        chat_id = params.get("chat_id") if params else None
+        priority = PRIORITY_UPLOAD if files else PRIORITY_TEXT
+        attempt = 0
+        while True:
+            if limited:
+                waited = await self._acquire(chat_id, priority)
+                if self.on_wait:
+                    self.on_wait(api_method, waited)
+            try:
+                return await request()
+            except asyncio_helper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                    if attempt >= self.max_retries or retry_after > self.max_retry_after:
+                        raise
+                    await self._block(chat_id if limited else None, retry_after)
+                    delay = 0 if limited else retry_after  # лимитированный запрос дождется паузы в _acquire
+                    reason = "flood"
+                elif e.error_code >= 500 and attempt < self.max_retries:
+                    delay = _backoff(self.backoff, attempt)
+                    reason = "server"
+                else:
+                    raise
+            except asyncio_helper.ApiHTTPException as e:
+                if e.result.status < 500 or attempt >= self.max_retries:
+                    raise
+                delay = _backoff(self.backoff, attempt)
+                reason = "server"
+            except asyncio_helper.RequestTimeout:
+                if limited or attempt >= self.max_retries:
+                    raise
+                delay = _backoff(self.backoff, attempt)
+                reason = "connection"
+            attempt += 1
+            self._limits.retries += 1
+            if self.on_retry:
+                self.on_retry(api_method, reason)
+            logger.debug("Повтор %s (%s), попытка %d, через %.2f с", api_method, reason, attempt, delay)
+            if delay:
+                await asyncio.sleep(delay)
+            _rewind(files)
+
+    async def _acquire(self, chat_id, priority):
+        limits = self._limits
+        ticket = limits.ticket(priority)
+        started = time.monotonic()
+        async with self._condition:
+            limits.waiting += 1
+            bucket = limits.chat_bucket(chat_id, started)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = limits.advance(ticket, bucket, now, self._condition.notify_all)
+                    if wait == 0:
+                        return now - started
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                limits.waiting -= 1
+                limits.leave(ticket, self._condition.notify_all)
+
+    async def _block(self, chat_id, seconds):
+        async with self._condition:
+            self._limits.block(chat_id, seconds)
+            self._condition.notify_all()
+
+
+def _backoff(backoff, attempt):
+    return backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+
+
+def _retry_after(response):
+    try:
+        return response.json().get("parameters", {}).get("retry_after", 1)
+    except ValueError:
+        return 1
+
+
+def _is_group(chat_id):
+    # У групп и каналов отрицательные идентификаторы, у каналов бывают и имена вида @channel
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return True
+
+
+def _connect_failed(error):
+    # Соединение не установлено (таймаут соединения, отказ, ошибка DNS) — сервер точно не получил запрос.
+    # Остальные ошибки соединения (RemoteDisconnected, сброс соединения) возможны и после того, как он его принял
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def _rewind(files):
+    # Перед повтором загружаемые файлы нужно перемотать: HTTP-клиент уже прочитал их до конца
+    for value in (files or {}).values():
+        file = value[1] if isinstance(value, tuple) else value
+        file = getattr(file, "file", file)  # types.InputFile
+        if hasattr(file, "seek"):
+            file.seek(0)
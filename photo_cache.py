@@ -0,0 +1,263 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from image_guard import image_memory_size
+
+
+class CachedPhoto:
+    """
+    Запись кэша: исходные байты фотографии и уже декодированные из них изображения.
+
+    Одну фотографию можно декодировать в нескольких разрешениях (см. open_photo),
+    поэтому изображения хранятся по размеру. Декодированные изображения общие для всех
+    обработчиков, их нельзя изменять на месте — преобразования возвращают новое изображение.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.images = {}  # (ширина, высота) -> PIL.Image
+        # Байты файла плюс примерный объем пикселей после декодирования
+        self.size = len(data)
+
+
+def open_photo(data, target_size=None):
+    """
+    Открывает фотографию, не декодируя пиксели.
+
+    Если указан target_size, для JPEG включается режим draft: декодер сразу уменьшает
+    изображение в 2, 4 или 8 раз, но не меньше target_size. Это намного быстрее полного
+    декодирования и требует меньше памяти. Для остальных форматов draft ничего не делает.
+
+    :param data: Байты изображения.
+    :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+    :return: Открытое, но еще не загруженное изображение (PIL.Image).
+    """
+    image = Image.open(io.BytesIO(data))
+    if target_size and image.format == "JPEG":
+        image.draft(image.mode, target_size)
+    return image
+
+
+class PhotoCache:
+    """
+    Ограниченный LRU-кэш скачанных фотографий с ключом file_unique_id.
+
+    Хранит в памяти байты и декодированные изображения, вытесняя самые давно
+    использованные записи при превышении лимита по количеству или по байтам.
+    Если указан каталог disk_dir, вытесненные из памяти байты остаются на диске
+    и при следующем обращении декодируются без повторного скачивания.
+    Если указан guard (image_guard.ImageGuard), декодирование идет в пределах его лимитов
+    пикселей и памяти.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_items=128, disk_dir=None,
+                 disk_max_bytes=512 * 1024 * 1024, guard=None):
+        """
+        :param max_bytes: Лимит памяти для всех записей (в байтах).
+        :param max_items: Максимальное количество записей в памяти.
+        :param disk_dir: Каталог для дискового уровня кэша (None — отключен).
+        :param disk_max_bytes: Лимит размера дискового уровня (в байтах).
+        :param guard: Защищенный загрузчик изображений (None — декодировать без ограничений).
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.guard = guard
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key, target_size=None):
+        """
+        Возвращает декодированную фотографию, поднимая ее из дискового уровня при необходимости.
+
+        :param key: file_unique_id фотографии.
+        :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+        :return: Изображение (PIL.Image) или None, если фотографии нет в кэше.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            data = self._read_disk(key)
+            if data is None:
+                return None
+            entry = self._store(key, data, write_disk=False)
+        return self._decode(key, entry, target_size)
+
+    def get_data(self, key):
+        """
+        Возвращает исходные байты фотографии, если они есть в кэше.
+
+        :param key: file_unique_id фотографии.
+        :return: Байты изображения или None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry.data
+        return self._read_disk(key)
+
+    def put_data(self, key, data):
+        """
+        Кладет в кэш исходные байты фотографии, не декодируя их.
+
+        :param key: file_unique_id фотографии.
+        :param data: Байты изображения.
+        """
+        self._store(key, data, write_disk=True)
+
+    def put(self, key, data, target_size=None):
+        """
+        Кладет фотографию в кэш и декодирует ее.
+
+        :param key: file_unique_id фотографии.
+        :param data: Байты изображения.
+        :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+        :return: Изображение (PIL.Image).
+        """
+        entry = self._store(key, data, write_disk=True)
+        return self._decode(key, entry, target_size)
+
+    def get_or_load(self, key, loader, target_size=None):
+        """
+        Возвращает фотографию из кэша или скачивает ее через loader.
+
+        :param key: file_unique_id фотографии.
+        :param loader: Функция без аргументов, возвращающая байты изображения.
+        :param target_size: Минимальный нужный размер (ширина, высота) или None для полного размера.
+        :return: Изображение (PIL.Image).
+        """
+        image = self.get(key, target_size)
+        if image is None:
+            image = self.put(key, loader(), target_size)
+        return image
+
+    def get_or_load_data(self, key, loader):
+        """
+        Возвращает исходные байты фотографии из кэша или скачивает их через loader, не декодируя.
+
+        :param key: file_unique_id фотографии.
+        :param loader: Функция без аргументов, возвращающая байты изображения.
+        :return: Байты изображения.
+        """
+        data = self.get_data(key)
+        if data is None:
+            data = loader()
+            self.put_data(key, data)
+        return data
+
+    def stats(self):
+        """
+        Возвращает текущее заполнение кэша в памяти.
+
+        :return: Словарь с количеством записей и занятыми байтами.
+        """
+        with self._lock:
+            return {'items': len(self._entries), 'bytes': self._bytes}
+
+    def _store(self, key, data, write_disk):
+        entry = CachedPhoto(data)
+        if write_disk:
+            self._write_disk(key, data)
+        if entry.size > self.max_bytes:
+            # Слишком большая фотография не кэшируется в памяти, чтобы не вытеснить все остальные
+            return entry
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._evict()
+        return entry
+
+    def _decode(self, key, entry, target_size):
+        if self.guard:
+            image = self.guard.open(entry.data, target_size)
+        else:
+            image = open_photo(entry.data, target_size)
+        with self._lock:
+            cached = entry.images.get(image.size)
+        if cached is not None:
+            return cached
+
+        if self.guard:
+            self.guard.load(image)
+        else:
+            image.load()
+        image_bytes = image_memory_size(image)
+        if entry.size + image_bytes > self.max_bytes:
+            return image  # Не кэшируем изображение, которое вытеснило бы из памяти все остальные
+        with self._lock:
+            if image.size in entry.images:
+                return entry.images[image.size]  # Параллельный запрос успел декодировать раньше
+            entry.images[image.size] = image
+            entry.size += image_bytes
+            if self._entries.get(key) is entry:
+                self._bytes += image_bytes
+                self._evict()
+        return image
+
+    def _evict(self):
+        while len(self._entries) > self.max_items or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def _disk_path(self, key):
+        # file_unique_id состоит из символов base64url, но на всякий случай чистим ключ
+        safe_key = "".join(ch for ch in key if ch.isalnum() or ch in "-_")
+        return os.path.join(self.disk_dir, safe_key)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        os.utime(path)  # Обновляем время доступа для LRU на диске
+        return data
+
+    def _write_disk(self, key, data):
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Кэш результатов обработки: ключ (file_unique_id исходника, операция, параметры),
+    значение — file_id, который Telegram вернул при первой отправке результата.
+
+    Повторный запрос той же операции над тем же изображением отправляется по file_id,
+    без вычислений и без повторной загрузки байтов. Записи живут не дольше ttl секунд,
+    а при превышении max_items вытесняются самые давно использованные.
+    """
+
+    def __init__(self, ttl=24 * 60 * 60, max_items=4096):
+        """
+        :param ttl: Время жизни записи в секундах.
+        :param max_items: Максимальное количество записей.
+        """
+        self.ttl = ttl
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Возвращает file_id готового результата.
+
+        :param key: Кортеж (file_unique_id, операция, параметры).
+        :return: file_id или None, если результата нет или он устарел.
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            file_id, expires_at = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return file_id
+
+    def put(self, key, file_id):
+        """
+        Запоминает file_id отправленного результата.
+
+        :param key: Кортеж (file_unique_id, операция, параметры).
+        :param file_id: file_id, полученный от Telegram.
+        """
+        with self._lock:
+            self._entries[key] = (file_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """
+        Удаляет запись, например если Telegram больше не принимает сохраненный file_id.
+
+        :param key: Кортеж (file_unique_id, операция, параметры).
+        """
+        with self._lock:
+            self._entries.pop(key, None)
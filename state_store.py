@@ -0,0 +1,219 @@
+import copy
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryStateStore:
+    """
+    Состояние пользователей в памяти процесса: LRU с ограничением количества чатов и TTL.
+
+    Подходит для разработки и для одного процесса; после перезапуска состояние теряется.
+    """
+
+    def __init__(self, ttl=7 * 24 * 60 * 60, max_items=100000):
+        """
+        :param ttl: Сколько секунд хранить состояние чата после последнего изменения.
+        :param max_items: Максимальное количество чатов; самые давние вытесняются.
+        """
+        self.ttl = ttl
+        self.max_items = max_items
+        self._states = OrderedDict()  # chat_id -> (время истечения, состояние)
+        self._lock = threading.Lock()
+
+    def get(self, chat_id, default=None):
+        """
+        Возвращает копию состояния чата.
+
+        :param chat_id: Идентификатор чата.
+        :param default: Значение, если состояния нет или оно устарело.
+        :return: Словарь состояния или default.
+        """
+        with self._lock:
+            item = self._states.get(chat_id)
+            if item is None:
+                return default
+            expires_at, state = item
+            if expires_at < time.time():
+                del self._states[chat_id]
+                return default
+            self._states.move_to_end(chat_id)
+            return copy.deepcopy(state)
+
+    def set(self, chat_id, state):
+        """
+        Полностью заменяет состояние чата.
+
+        :param chat_id: Идентификатор чата.
+        :param state: Словарь состояния (только JSON-совместимые значения).
+        """
+        with self._lock:
+            self._put(chat_id, copy.deepcopy(state))
+
+    def update(self, chat_id, **fields):
+        """
+        Атомарно изменяет отдельные поля состояния чата.
+
+        :param chat_id: Идентификатор чата.
+        :return: Новое состояние или None, если состояния чата нет.
+        """
+        return self.modify(chat_id, lambda state: state.update(fields))
+
+    def modify(self, chat_id, func, default=None):
+        """
+        Атомарно изменяет состояние чата функцией func.
+
+        :param chat_id: Идентификатор чата.
+        :param func: Функция, которая получает копию состояния и изменяет ее на месте.
+        :param default: Начальное состояние, если состояния чата нет; None — ничего не менять.
+        :return: Новое состояние или None, если состояния чата нет и default не задан.
+        """
+        with self._lock:
+            item = self._states.get(chat_id)
+            if item is None or item[0] < time.time():
+                if default is None:
+                    return None
+                item = (None, default)
+            state = copy.deepcopy(item[1])
+            func(state)
+            self._put(chat_id, state)
+            return copy.deepcopy(state)
+
+    def delete(self, chat_id):
+        """
+        Удаляет состояние чата.
+
+        :param chat_id: Идентификатор чата.
+        """
+        with self._lock:
+            self._states.pop(chat_id, None)
+
+    def _put(self, chat_id, state):
+        self._states[chat_id] = (time.time() + self.ttl, state)
+        self._states.move_to_end(chat_id)
+        while len(self._states) > self.max_items:
+            self._states.popitem(last=False)
+
+
+class SQLiteStateStore:
+    """
+    Состояние пользователей в файле SQLite.
+
+    Переживает перезапуск и может использоваться несколькими процессами бота одновременно
+    (журнал WAL, изменения выполняются в транзакциях). Состояние хранится компактно —
+    одной строкой JSON на чат. Устаревшие записи и записи сверх max_items удаляются
+    периодически при записи.
+    """
+
+    CLEANUP_EVERY = 500  # через сколько записей запускать очистку
+
+    def __init__(self, path, ttl=7 * 24 * 60 * 60, max_items=100000):
+        """
+        :param path: Путь к файлу базы данных.
+        :param ttl: Сколько секунд хранить состояние чата после последнего изменения.
+        :param max_items: Максимальное количество чатов; самые давние удаляются.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_items = max_items
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS user_states ("
+                         "chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS user_states_updated_at ON user_states (updated_at)")
+
+    def get(self, chat_id, default=None):
+        """
+        Возвращает состояние чата.
+
+        :param chat_id: Идентификатор чата.
+        :param default: Значение, если состояния нет или оно устарело.
+        :return: Словарь состояния или default.
+        """
+        row = self._connection().execute(
+            "SELECT state FROM user_states WHERE chat_id = ? AND updated_at > ?",
+            (chat_id, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, chat_id, state):
+        """
+        Полностью заменяет состояние чата.
+
+        :param chat_id: Идентификатор чата.
+        :param state: Словарь состояния (только JSON-совместимые значения).
+        """
+        with self._connection() as conn:
+            self._write(conn, chat_id, state)
+        self._maybe_cleanup()
+
+    def update(self, chat_id, **fields):
+        """
+        Атомарно изменяет отдельные поля состояния чата.
+
+        :param chat_id: Идентификатор чата.
+        :return: Новое состояние или None, если состояния чата нет.
+        """
+        return self.modify(chat_id, lambda state: state.update(fields))
+
+    def modify(self, chat_id, func, default=None):
+        """
+        Атомарно изменяет состояние чата функцией func, в том числе из разных процессов.
+
+        :param chat_id: Идентификатор чата.
+        :param func: Функция, которая получает состояние и изменяет его на месте.
+        :param default: Начальное состояние, если состояния чата нет; None — ничего не менять.
+        :return: Новое состояние или None, если состояния чата нет и default не задан.
+        """
+        conn = self._connection()
+        with conn:
+            # IMMEDIATE блокирует запись сразу, чтобы другой процесс не изменил состояние между чтением и записью
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT state FROM user_states WHERE chat_id = ? AND updated_at > ?",
+                               (chat_id, time.time() - self.ttl)).fetchone()
+            if row is None:
+                if default is None:
+                    return None
+                state = json.loads(json.dumps(default))
+            else:
+                state = json.loads(row[0])
+            func(state)
+            self._write(conn, chat_id, state)
+        self._maybe_cleanup()
+        return state
+
+    def delete(self, chat_id):
+        """
+        Удаляет состояние чата.
+
+        :param chat_id: Идентификатор чата.
+        """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM user_states WHERE chat_id = ?", (chat_id,))
+
+    def _connection(self):
+        # sqlite3.Connection нельзя использовать из разных потоков, поэтому у каждого потока свое соединение
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _write(conn, chat_id, state):
+        conn.execute("INSERT OR REPLACE INTO user_states (chat_id, state, updated_at) VALUES (?, ?, ?)",
+                     (chat_id, json.dumps(state, ensure_ascii=False, separators=(',', ':')), time.time()))
+
+    def _maybe_cleanup(self):
+        self._writes += 1
+        if self._writes % self.CLEANUP_EVERY:
+            return
+        with self._connection() as conn:
+            conn.execute("DELETE FROM user_states WHERE updated_at <= ?", (time.time() - self.ttl,))
+            conn.execute("DELETE FROM user_states WHERE chat_id IN ("
+                         "SELECT chat_id FROM user_states ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                         (self.max_items,))
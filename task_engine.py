@@ -0,0 +1,191 @@
+import contextvars
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class TaskEngine:
+    """
+    Исполнитель обработчиков вне цикла опроса Telegram.
+
+    Задачи выполняются в пуле потоков (скачивание и отправка), а тяжелые
+    преобразования изображений — в пуле процессов через run_cpu. Задачи одного
+    чата выполняются строго по очереди, в порядке поступления. Общее количество
+    ожидающих и выполняемых задач ограничено: когда очередь заполнена, submit
+    возвращает False, и вызывающий код должен попросить пользователя повторить позже.
+    """
+
+    def __init__(self, io_workers=8, cpu_workers=None, max_queue=100, on_wait=None):
+        """
+        :param io_workers: Количество потоков для задач с вводом-выводом.
+        :param cpu_workers: Количество процессов для преобразований изображений
+            (None — по числу ядер, 0 — выполнять преобразования в потоке задачи).
+        :param max_queue: Максимальное количество ожидающих и выполняемых задач.
+        :param on_wait: Функция, которая получает время ожидания каждой задачи в очереди (в секундах).
+        """
+        self.max_queue = max_queue
+        self.on_wait = on_wait
+        self._io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="bot-io")
+        # Отдельный пул для параллельных скачиваний внутри задачи: если бы задача ждала
+        # подзадачи в своем же пуле, при полной загрузке пула они бы никогда не запустились
+        self._fetch_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="bot-fetch")
+        self._cpu_pool = None
+        if cpu_workers != 0:
+            # spawn вместо fork: процессы создаются из работающего многопоточного бота
+            self._cpu_pool = ProcessPoolExecutor(max_workers=cpu_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        self._chats = {}  # chat_id -> очередь задач этого чата, пока по нему идет обработка
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._rejected = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """
+        Ставит задачу в очередь чата.
+
+        :param chat_id: Идентификатор чата; задачи одного чата не выполняются параллельно.
+        :param func: Выполняемая функция.
+        :return: True, если задача принята, False, если очередь заполнена.
+        """
+        return self._enqueue(chat_id, func, args, kwargs, limited=True)
+
+    def post(self, chat_id, func, *args, **kwargs):
+        """
+        Ставит в очередь чата короткую задачу, например ответ пользователю, даже если очередь заполнена.
+
+        Так ответ сохраняет порядок с задачами чата и не выполняется в вызывающем потоке.
+
+        :param chat_id: Идентификатор чата; задачи одного чата не выполняются параллельно.
+        :param func: Выполняемая функция.
+        """
+        self._enqueue(chat_id, func, args, kwargs, limited=False)
+
+    def _enqueue(self, chat_id, func, args, kwargs, limited):
+        with self._lock:
+            if limited and self._pending >= self.max_queue:
+                self._rejected += 1
+                return False
+            self._pending += 1
+            job = (time.monotonic(), func, args, kwargs)
+            queue = self._chats.get(chat_id)
+            if queue is not None:
+                queue.append(job)  # Задача запустится после уже поставленных задач этого чата
+                return True
+            self._chats[chat_id] = deque([job])
+        self._io_pool.submit(self._run_next, chat_id)
+        return True
+
+    def run_cpu(self, func, *args):
+        """
+        Выполняет CPU-нагрузку в пуле процессов и ждет результат.
+
+        :param func: Функция уровня модуля; аргументы и результат должны сериализоваться pickle.
+        :return: Результат функции.
+        """
+        if self._cpu_pool is None:
+            return func(*args)
+        return self._cpu_pool.submit(func, *args).result()
+
+    def map_io(self, func, *iterables):
+        """
+        Параллельно выполняет func для каждого набора аргументов, например скачивания фото альбома.
+
+        Функция выполняется в контексте вызывающего потока (contextvars), как если бы
+        ее вызвали напрямую.
+
+        :param func: Выполняемая функция.
+        :return: Список результатов в порядке аргументов.
+        """
+        call = functools.partial(_run_in_context, contextvars.copy_context(), func)
+        return list(self._fetch_pool.map(call, *iterables))
+
+    def start_io(self, func, *args):
+        """
+        Запускает func в фоне, например, чтобы скачать полное фото, пока готовится превью.
+
+        Функция выполняется в контексте вызывающего потока (contextvars), как в map_io.
+
+        :param func: Выполняемая функция.
+        :return: concurrent.futures.Future с результатом.
+        """
+        return self._fetch_pool.submit(_run_in_context, contextvars.copy_context(), func, *args)
+
+    def map_cpu(self, func, *iterables):
+        """
+        Параллельно выполняет CPU-нагрузку в пуле процессов для каждого набора аргументов.
+
+        :param func: Функция уровня модуля; аргументы и результат должны сериализоваться pickle.
+        :return: Список результатов в порядке аргументов.
+        """
+        if self._cpu_pool is None:
+            return list(map(func, *iterables))
+        return list(self._cpu_pool.map(func, *iterables))
+
+    def stats(self):
+        """
+        Возвращает состояние очереди.
+
+        :return: Словарь с глубиной очереди, числом выполняемых, отклоненных и выполненных
+            задач, а также средним и максимальным временем ожидания в секундах.
+        """
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                'queue_depth': self._pending - self._running,
+                'running': self._running,
+                'rejected': self._rejected,
+                'completed': self._completed,
+                'wait_avg': self._wait_total / started if started else 0.0,
+                'wait_max': self._wait_max,
+            }
+
+    def shutdown(self):
+        """
+        Дожидается выполнения задач и останавливает пулы.
+        """
+        self._io_pool.shutdown(wait=True)
+        self._fetch_pool.shutdown(wait=True)
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown(wait=True)
+
+    def _run_next(self, chat_id):
+        with self._lock:
+            queued_at, func, args, kwargs = self._chats[chat_id].popleft()
+            wait = time.monotonic() - queued_at
+            self._running += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+        try:
+            if self.on_wait is not None:
+                self.on_wait(wait)
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Ошибка при обработке задачи чата %s", chat_id)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._pending -= 1
+                self._completed += 1
+                has_more = bool(self._chats[chat_id])
+                if not has_more:
+                    del self._chats[chat_id]
+            if has_more:
+                # Следующая задача чата встает в конец общего пула, чтобы не занимать поток
+                # одним активным чатом в ущерб остальным
+                self._io_pool.submit(self._run_next, chat_id)
+
+
+def _run_in_context(context, func, *args):
+    # Один объект Context нельзя запустить одновременно в нескольких потоках, поэтому копия на вызов
+    return context.copy().run(func, *args)
@@ -0,0 +1,393 @@
+"""
+Запуск бота в режиме webhook: python webhook_server.py
+
+Telegram присылает обновления POST-запросами на встроенный HTTP-сервер. Повторные
+доставки одного обновления (по update_id) отбрасываются, а обновления распределяются
+по процессам-обработчикам по chat_id: все обновления одного чата обрабатывает один
+процесс и строго по очереди, поэтому нажатия одного пользователя не переставляются.
+
+Несколько экземпляров за балансировщиком нагрузки указываются в --peers (один и тот
+же список на всех экземплярах) и --instance (номер текущего). Экземпляр, получивший
+обновление чужого чата, пересылает его владельцу, поэтому порядок и дедупликация
+сохраняются, куда бы балансировщик ни направил запрос.
+
+HTTPS обычно завершается на балансировщике или обратном прокси; для разработки
+по-прежнему можно запускать python bot.py с опросом.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = None  # публичный адрес, например "https://example.com/telegram"; None — не вызывать setWebhook
+WEBHOOK_WORKERS = 2  # процессов-обработчиков; 0 — обрабатывать в процессе сервера
+WEBHOOK_THREADS = 8  # потоков разбора обновлений в каждом обработчике
+WEBHOOK_QUEUE = 1000  # обновлений в очереди каждого обработчика; при переполнении Telegram повторит доставку
+DEDUP_TTL = 60 * 60  # сколько секунд помнить update_id
+DEDUP_MAX_ITEMS = 100000
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+FORWARDED_HEADER = "X-Bot-Forwarded"  # обновление уже переслал другой экземпляр
+
+
+class UpdateDeduplicator:
+    """
+    Множество недавно полученных update_id с ограничением по времени и количеству.
+
+    Telegram повторяет доставку, если не получил ответ 200, поэтому одно обновление
+    может прийти несколько раз, в том числе одновременно.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL, max_items=DEDUP_MAX_ITEMS):
+        """
+        :param ttl: Сколько секунд помнить update_id.
+        :param max_items: Максимальное количество запоминаемых update_id.
+        """
+        self.ttl = ttl
+        self.max_items = max_items
+        self._seen = OrderedDict()  # update_id -> время истечения
+        self._lock = threading.Lock()
+
+    def add(self, update_id):
+        """
+        Запоминает update_id.
+
+        :param update_id: Идентификатор обновления.
+        :return: True, если обновление новое, False, если оно уже было.
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._seen and next(iter(self._seen.values())) < now:
+                self._seen.popitem(last=False)
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = now + self.ttl
+            while len(self._seen) > self.max_items:
+                self._seen.popitem(last=False)
+            return True
+
+    def discard(self, update_id):
+        """
+        Забывает update_id, например если обновление не удалось поставить в очередь.
+
+        :param update_id: Идентификатор обновления.
+        """
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+
+def update_chat_id(update):
+    """
+    Возвращает идентификатор чата, к которому относится обновление.
+
+    :param update: Обновление Telegram (словарь из JSON).
+    :return: chat_id, id пользователя для обновлений без чата или 0.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+def webhook_secret(token):
+    """
+    Возвращает секрет для заголовка X-Telegram-Bot-Api-Secret-Token.
+
+    Секрет выводится из токена, поэтому одинаков на всех экземплярах без отдельной настройки.
+
+    :param token: Токен бота.
+    :return: Строка из символов, разрешенных Telegram.
+    """
+    return hashlib.sha256(f"webhook:{token}".encode("utf-8")).hexdigest()
+
+
+def configure_api(api_url):
+    """
+    Направляет запросы telebot на другой сервер Bot API (локальный сервер или фейковый для проверки).
+
+    :param api_url: Адрес вида "http://127.0.0.1:8081" или None, чтобы ничего не менять.
+    """
+    if api_url:
+        from telebot import apihelper
+
+        apihelper.API_URL = api_url + "/bot{0}/{1}"
+        apihelper.FILE_URL = api_url + "/file/bot{0}/{1}"
+
+
+class UpdateDispatcher:
+    """
+    Обрабатывает обновления в текущем процессе: обновления одного чата по очереди,
+    разных чатов — параллельно.
+    """
+
+    def __init__(self, threads=WEBHOOK_THREADS, api_url=None):
+        """
+        :param threads: Количество потоков разбора обновлений.
+        :param api_url: Адрес сервера Bot API (None — api.telegram.org).
+        """
+        configure_api(api_url)
+        import bot as app
+        from task_engine import TaskEngine
+
+        self.app = app
+        # Бот создается без пула потоков telebot: обработчики выполняются в потоке очереди чата,
+        # иначе два обновления одного чата могли бы обработаться в обратном порядке
+        app.create_app()
+        self._engine = TaskEngine(io_workers=threads, cpu_workers=0, max_queue=WEBHOOK_QUEUE)
+
+    def dispatch(self, chat_id, payload):
+        """
+        Ставит обновление в очередь его чата.
+
+        :param chat_id: Идентификатор чата обновления.
+        :param payload: JSON обновления (строка).
+        :return: True, если обновление принято, False, если очередь заполнена.
+        """
+        return self._engine.submit(chat_id, self._process, payload)
+
+    def _process(self, payload):
+        from telebot import types
+
+        self.app.bot.process_new_updates([types.Update.de_json(payload)])
+
+    def shutdown(self):
+        """
+        Дожидается обработки принятых обновлений и задач, которые они поставили боту.
+        """
+        self._engine.shutdown()
+        # Пул процессов бота нужно остановить явно: при выходе дочернего процесса multiprocessing
+        # ждет свои дочерние процессы раньше, чем concurrent.futures успевает остановить пул
+        self.app.engine.shutdown()
+
+
+def _worker_main(queue, threads, api_url, metrics_port, processes):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # останавливает процесс сервер, отправляя None в очередь
+    dispatcher = UpdateDispatcher(threads, api_url)
+    # Чат всегда обрабатывает один процесс, поэтому лимиты чатов соблюдаются и так, а общий лимит бота делится
+    # между всеми процессами
+    dispatcher.app.outbound.set_global_rate(dispatcher.app.OUTBOUND_GLOBAL_RATE / processes)
+    if metrics_port:
+        dispatcher.app.metrics.serve(dispatcher.app.METRICS_HOST, metrics_port)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        chat_id, payload = item
+        while not dispatcher.dispatch(chat_id, payload):
+            time.sleep(0.01)  # очередь чатов заполнена: ждем, пока освободится место
+    dispatcher.shutdown()
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Telegram держит до max_connections одновременных соединений; очередь по умолчанию (5) их сбрасывает
+    request_queue_size = 128
+
+
+class WebhookServer:
+    """
+    HTTP-сервер, принимающий обновления Telegram и распределяющий их по обработчикам.
+    """
+
+    def __init__(self, token, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, workers=WEBHOOK_WORKERS,
+                 threads=WEBHOOK_THREADS, peers=None, instance=0, api_url=None, metrics=None, metrics_port=None):
+        """
+        :param token: Токен бота, из него выводится секрет webhook.
+        :param workers: Количество процессов-обработчиков (0 — обрабатывать в этом процессе).
+        :param threads: Количество потоков разбора обновлений в каждом обработчике.
+        :param peers: Адреса всех экземпляров за балансировщиком, например ["http://10.0.0.1:8443"];
+            None — единственный экземпляр.
+        :param instance: Номер текущего экземпляра в peers.
+        :param api_url: Адрес сервера Bot API для обработчиков (None — api.telegram.org).
+        :param metrics: Metrics для счетчиков обновлений (None — не учитывать).
+        :param metrics_port: Порт метрик сервера; обработчики отдают свои метрики на следующих портах.
+        """
+        self.path = path
+        self.secret = webhook_secret(token)
+        self.peers = peers or []
+        self.instance = instance
+        self.metrics = metrics
+        self.deduplicator = UpdateDeduplicator()
+        self._dispatcher = None
+        self._queues = []
+        self._workers = []
+        if workers:
+            context = multiprocessing.get_context("spawn")
+            for i in range(workers):
+                queue = context.Queue(maxsize=WEBHOOK_QUEUE)
+                process = context.Process(target=_worker_main, name=f"webhook-worker-{i}",
+                                          args=(queue, threads, api_url, metrics_port + 1 + i if metrics_port else None,
+                                                workers * max(len(self.peers), 1)))
+                process.start()
+                self._queues.append(queue)
+                self._workers.append(process)
+        else:
+            self._dispatcher = UpdateDispatcher(threads, api_url)
+        self._httpd = _HTTPServer((host, port), self._make_handler())
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def serve_forever(self):
+        """
+        Принимает обновления до вызова shutdown.
+        """
+        self._httpd.serve_forever()
+
+    def shutdown(self):
+        """
+        Останавливает прием обновлений и дожидается обработки уже принятых.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._workers:
+            process.join()
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown()
+
+    def handle_update(self, body, forwarded=False):
+        """
+        Принимает одно обновление.
+
+        :param body: Тело запроса (JSON обновления в байтах).
+        :param forwarded: Обновление переслано другим экземпляром и не пересылается дальше.
+        :return: HTTP-статус ответа Telegram: при ответе не 200 Telegram повторит доставку.
+        """
+        try:
+            update = json.loads(body)
+            update_id = update["update_id"]
+        except (ValueError, KeyError, TypeError):
+            return 400
+        chat_id = update_chat_id(update)
+
+        if self.peers and not forwarded:
+            owner = chat_id % len(self.peers)
+            if owner != self.instance:
+                self._count("forwarded")
+                return self._forward(self.peers[owner], body)
+
+        if not self.deduplicator.add(update_id):
+            self._count("duplicate")
+            return 200
+        if not self._enqueue(chat_id, body.decode("utf-8")):
+            self.deduplicator.discard(update_id)  # Telegram повторит доставку, ее нельзя счесть дубликатом
+            self._count("rejected")
+            return 503
+        self._count("accepted")
+        return 200
+
+    def _enqueue(self, chat_id, payload):
+        if self._dispatcher is not None:
+            return self._dispatcher.dispatch(chat_id, payload)
+        # Один чат — всегда один обработчик: его обновления обрабатываются по порядку
+        queue = self._queues[chat_id % len(self._queues)]
+        try:
+            queue.put((chat_id, payload), timeout=1)
+        except Exception:  # queue.Full из multiprocessing
+            return False
+        return True
+
+    def _forward(self, peer, body):
+        request = urllib.request.Request(peer.rstrip("/") + self.path, data=body, method="POST",
+                                         headers={"Content-Type": "application/json", SECRET_HEADER: self.secret,
+                                                  FORWARDED_HEADER: "1"})
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except OSError:
+            logger.warning("Экземпляр %s недоступен, Telegram повторит доставку", peer)
+            return 503
+
+    def _count(self, result):
+        if self.metrics is not None:
+            self.metrics.inc("bot_webhook_updates_total", result=result)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                # Проверка работоспособности для балансировщика
+                self._respond(200 if self.path == "/healthz" else 404)
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._respond(404)
+                    return
+                if self.headers.get(SECRET_HEADER) != server.secret:
+                    self._respond(403)
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                self._respond(server.handle_update(body, forwarded=bool(self.headers.get(FORWARDED_HEADER))))
+
+            def _respond(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бот в режиме webhook")
+    parser.add_argument("--host", default=WEBHOOK_HOST)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--url", default=WEBHOOK_URL, help="публичный адрес webhook для setWebhook")
+    parser.add_argument("--workers", type=int, default=WEBHOOK_WORKERS)
+    parser.add_argument("--peers", nargs="*", default=None, help="адреса всех экземпляров за балансировщиком")
+    parser.add_argument("--instance", type=int, default=0, help="номер этого экземпляра в --peers")
+    parser.add_argument("--api-url", default=None, help="адрес сервера Bot API, например локального")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    configure_api(args.api_url)
+    import bot as app
+    from telebot import apihelper
+
+    # Процесс сервера только распределяет обновления: бот, очередь задач и планировщик отправки
+    # создаются в обработчиках (UpdateDispatcher), а здесь нужны лишь токен и метрики
+    token = app.read_token_from_file(app.TOKEN_FILE)
+    server = WebhookServer(token, args.host, args.port, workers=args.workers, peers=args.peers,
+                           instance=args.instance, api_url=args.api_url, metrics=app.metrics,
+                           metrics_port=app.METRICS_PORT)
+    if app.METRICS_PORT:
+        app.metrics.serve(app.METRICS_HOST, app.METRICS_PORT)
+    if args.url:
+        apihelper.set_webhook(token, url=args.url, secret_token=server.secret, max_connections=100)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    logger.info("Webhook слушает %s:%s%s", args.host, server.port, WEBHOOK_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()